@@ -0,0 +1,456 @@
+"""Micro-benchmarks for the weather display hot paths.
+
+Run on the Pi with:
+
+    python3 benchmark.py
+
+Where there is a reference implementation, the optimised path is checked
+to produce exactly the same output before it is timed. The spi benchmark
+drives the panel, so it needs the display attached, or --backend sim to
+run it against the simulated panel. The panel benchmark always uses the
+simulated panel and runs on any machine. The render benchmark shows how
+the daemon's render pool scales with the number of cores, and the
+download benchmark what each forecast product costs on the wire. The
+service benchmark load-tests renderservice.py with many clients polling
+it, against a stand-in for api.met.no serving the --forecast file.
+"""
+
+
+import argparse
+import collections
+import email.utils
+import http.client
+import http.server
+import json
+import multiprocessing
+import os
+import re
+import tempfile
+import threading
+import time
+import timeit
+import tracemalloc
+from PIL import Image
+import epd2in7
+import epdif
+import epdsim
+import forecast
+import metapi
+
+
+def _testImages(epd):
+    """A few mode '1' frames: blank, solid, and dithered noise."""
+    size = (epd.width, epd.height)
+    return {
+        'white': Image.new('1', size, 255),
+        'black': Image.new('1', size, 0),
+        'noise': Image.effect_noise(size, 64).convert('1'),
+    }
+
+
+def benchFrameBuffer(args):
+    """Compares get_frame_buffer against the pixel-by-pixel loop."""
+    repeat = args.repeat
+    epd = epd2in7.EPD()
+    print('Frame buffer packing ({} bytes, best of {}):'.format(
+        epd.width * epd.height // 8, repeat))
+    for name, image in _testImages(epd).items():
+        packed = epd.get_frame_buffer(image)
+        reference = epd.pack_pixels(image)
+        if packed != reference:
+            raise AssertionError('{}: packed buffer differs from the '
+                                 'reference loop'.format(name))
+        loop = min(timeit.repeat(lambda: epd.pack_pixels(image),
+                                 number=1, repeat=repeat))
+        bulk = min(timeit.repeat(lambda: epd.get_frame_buffer(image),
+                                 number=1, repeat=repeat))
+        print('  {:6} loop {:8.2f} ms   bulk {:8.3f} ms   {:7.0f}x'.format(
+            name, loop * 1000, bulk * 1000, loop / bulk))
+    image = _testImages(epd)['noise']
+    landscape = image.rotate(90, expand=True)
+    print('Turned while packing vs rotate() then packing:')
+    for orientation in epd2in7.ORIENTATIONS:
+        turned = epd2in7.EPD(orientation=orientation)
+        source = landscape if orientation in (90, 270) else image
+        packed = turned.get_frame_buffer(source)
+        if packed != epd.get_frame_buffer(source.rotate(orientation,
+                                                        expand=True)):
+            raise AssertionError('{} degrees: packed buffer differs from '
+                                 'the rotated image'.format(orientation))
+        rotated = min(timeit.repeat(
+            lambda: epd.get_frame_buffer(source.rotate(orientation,
+                                                       expand=True)),
+            number=1, repeat=repeat))
+        packing = min(timeit.repeat(lambda: turned.get_frame_buffer(source),
+                                    number=1, repeat=repeat))
+        print('  {:3} degrees  rotate {:8.3f} ms   packing {:8.3f} ms'.format(
+            orientation, rotated * 1000, packing * 1000))
+
+
+def benchSpi(args):
+    """Measures SPI throughput, its host CPU cost and time per frame."""
+    repeat = args.repeat
+    epd = epd2in7.EPD()
+    epd.init()
+    image = _testImages(epd)['noise']
+    frameBuffer = epd.get_frame_buffer(image)
+
+    # Raw link speed, per byte versus bulk, without triggering a refresh.
+    # The link is timed on the panel's clock, like the frame stats below
+    # (the simulated panel's runs on its modelled SPI speed), and the CPU
+    # it costs on the host separately.
+    epd.send_command(epd2in7.DATA_START_TRANSMISSION_2)
+    print('SPI plane transfer ({} bytes, best of {}):'.format(
+        len(frameBuffer), repeat))
+    for name, send in (
+            ('per byte', lambda: [epd.send_data(b) for b in frameBuffer]),
+            ('bulk', lambda: epd.send_data_bulk(frameBuffer))):
+        link = cpu = float('inf')
+        for _ in range(repeat):
+            start, started = epdif.epd_clock(), time.process_time()
+            send()
+            cpu = min(cpu, time.process_time() - started)
+            link = min(link, epdif.epd_clock() - start)
+        print('  {:8} link {:8.1f} ms {:10.0f} B/s   host CPU {:8.2f} ms'
+              .format(name, link * 1000, len(frameBuffer) / link,
+                      cpu * 1000))
+
+    print('Full frames:')
+    for _ in range(repeat):
+        epd.display_frame(frameBuffer)
+        stats = epd.frame_stats
+        print('  {} bytes at {:.0f} B/s, refresh {:.2f} s, '
+              'total {:.2f} s'.format(
+                  stats.bytes, stats.bytes / stats.transfer_seconds,
+                  stats.refresh_seconds, stats.total_seconds))
+    epd.sleep()
+
+
+def _tracedMemory(function):
+    """Runs function under tracemalloc.
+
+    Returns its result, the memory still held by the result and the peak
+    allocated while it ran.
+    """
+    tracemalloc.start()
+    try:
+        result = function()
+        kept, peak = tracemalloc.get_traced_memory()
+        return result, kept, peak
+    finally:
+        tracemalloc.stop()
+
+
+def benchParse(args):
+    """Compares json.load of the whole forecast with forecast.read."""
+    if not args.forecast:
+        print('parse: skipped, needs --forecast FILE (a locationforecast '
+              'document, e.g. the .body file the cache keeps)')
+        return
+
+    def loadAll():
+        with open(args.forecast, 'rb') as f:
+            return json.load(f)
+
+    def readSteps():
+        with open(args.forecast, 'rb') as f:
+            return forecast.read(f)
+
+    document, fullKept, fullPeak = _tracedMemory(loadAll)
+    compact, streamKept, streamPeak = _tracedMemory(readSteps)
+    full = min(timeit.repeat(loadAll, number=1, repeat=args.repeat))
+    stream = min(timeit.repeat(readSteps, number=1, repeat=args.repeat))
+    print('Forecast parsing ({} timeseries entries, best of {}):'.format(
+        len(document['properties']['timeseries']), args.repeat))
+    print('  json.load      {:7.2f} ms   peak {:7.1f} KiB   kept {:7.1f} KiB'
+          .format(full * 1000, fullPeak / 1024, fullKept / 1024))
+    print('  forecast.read  {:7.2f} ms   peak {:7.1f} KiB   kept {:7.1f} KiB'
+          .format(stream * 1000, streamPeak / 1024, streamKept / 1024))
+
+
+def benchPanel(args):
+    """Times EPD.init, display_frame, update_frame and the power modes.
+
+    Runs anywhere. The times are what the driver and the command stream
+    cost the host; the simulated clock says how long the real panel would
+    have been busy on top of that.
+    """
+    repeat = args.repeat
+    panel = epdsim.SimulatedPanel(record=False, image_path=None)
+    previous = epdif.set_backend(panel)
+    try:
+        epd = epd2in7.EPD(full_refresh_interval=repeat * 2 + 1)
+        image = _testImages(epd)['noise']
+        frames = [epd.get_frame_buffer(image)]
+        # The same frame with a box drawn over it, for partial refreshes
+        image.paste(0, (24, 40, 88, 72))
+        frames.append(epd.get_frame_buffer(image))
+
+        def update():
+            frames.reverse()
+            return epd.update_frame(frames[0])
+
+        print('Simulated panel (best of {}):'.format(repeat))
+        for name, function in (
+                ('init', epd.init),
+                ('display_frame', lambda: epd.display_frame(frames[0])),
+                ('update_frame', update)):
+            clock = panel.now
+            seconds = min(timeit.repeat(function, number=1, repeat=repeat))
+            simulated = (panel.now - clock) / repeat
+            print('  {:14} {:8.3f} ms host {:8.1f}/s   panel busy {:6.2f} s'
+                  .format(name, seconds * 1000, 1 / seconds, simulated))
+        if bytes(panel.screen) != bytes(frames[0]) or panel.errors:
+            raise AssertionError('Simulated panel shows the wrong frame: {}'
+                                 .format(panel.errors))
+
+        print('Refresh cycles by power mode (partial updates, after the '
+              'first):')
+        for mode in epd2in7.POWER_MODES:
+            epd = epd2in7.EPD(full_refresh_interval=repeat * 2 + 1,
+                              power_mode=mode)
+            epd.init()
+            epd.update_frame(frames[0])
+            received, clock = panel.bytes_received, panel.now
+            wake = 0.0
+            for _ in range(repeat):
+                update()
+                wake += epd.frame_stats.wake_seconds
+            print('  {:6} wake {:6.3f} s   cycle {:6.2f} s   {:6.0f} bytes'
+                  .format(str(mode), wake / repeat,
+                          (panel.now - clock) / repeat,
+                          (panel.bytes_received - received) / repeat))
+            if bytes(panel.screen) != bytes(frames[0]) or panel.errors:
+                raise AssertionError('Simulated panel shows the wrong frame: '
+                                     '{}'.format(panel.errors))
+    finally:
+        epdif.set_backend(previous)
+
+
+def benchRender(args):
+    """Frames per second drawn by daemon's render pool, by worker count."""
+    if not args.forecast:
+        print('render: skipped, needs --forecast FILE')
+        return
+    import daemon
+    import renderer
+    with open(args.forecast, 'rb') as f:
+        data = forecast.read(f)
+    frames = 8 * (os.cpu_count() or 1)
+    print('Render pool ({} frames, best of {}):'.format(frames, args.repeat))
+    workers = 1
+    while True:
+        pool = daemon.makeRenderPool(workers)
+        try:
+            def renderAll():
+                futures = [pool.submit(renderer.renderFrame, data, 'Status',
+                                       '01.01.70 00:00')
+                           for _ in range(frames)]
+                for future in futures:
+                    future.result()
+            renderAll()  # start the workers
+            seconds = min(timeit.repeat(renderAll, number=1,
+                                        repeat=args.repeat))
+        finally:
+            pool.shutdown()
+        print('  {:3} workers {:8.1f} frames/s'.format(workers,
+                                                      frames / seconds))
+        if workers >= (os.cpu_count() or 1):
+            break
+        workers = min(workers * 2, os.cpu_count() or 1)
+
+
+def benchDownload(args):
+    """Bytes on the wire per forecast download, by product and encoding.
+
+    Makes real requests to api.met.no (or $MET_API_URL).
+    """
+    client = metapi.HttpClient()
+    print('Forecast download (bytes on the wire):')
+    for product in ('complete', 'compact'):
+        url = metapi.forecastUrl(args.latitude, args.longitude, product)
+        for encoding in ('identity', 'gzip'):
+            headers = {'User-Agent': metapi.USER_AGENT,
+                       'Accept-Encoding': encoding}
+            try:
+                with client.get(url, headers) as response:
+                    body = len(response.read())
+                    wire = response.wireBytes
+            except OSError as e:
+                print('download: skipped, {}'.format(e))
+                return
+            print('  {:8} {:8} {:8} bytes ({} decompressed)'.format(
+                product, encoding, wire, body))
+
+
+def _serveForecast(path):
+    """A stand-in for api.met.no serving the forecast in path for any
+    location, and the bundled legend. Returns the server and a list with
+    a path per request."""
+    bodies = {}
+    for name, filename in (('locationforecast', path),
+                           ('legends', metapi.BUNDLED_LEGEND)):
+        with open(filename, 'rb') as f:
+            bodies[name] = f.read()
+    lastModified = email.utils.formatdate(usegmt=True)
+    requests = []
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            requests.append(self.path)
+            body = next((body for name, body in bodies.items()
+                         if name in self.path), None)
+            if body is None:
+                self.send_response(404)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header('Last-Modified', lastModified)
+            self.send_header('Expires', email.utils.formatdate(
+                time.time() + 3600, usegmt=True))
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, requests
+
+
+def _runService(apiUrl, cacheDirectory, ready):
+    import renderservice
+    metapi.API_URL = apiUrl
+    cache = metapi.ResponseCache(cacheDirectory)
+    service = renderservice.RenderService(
+        cache, metapi.Legend(cache, apiUrl + '/weathericon/2.0/legends'))
+    server = renderservice.RenderServer(('127.0.0.1', 0), service)
+    ready.put(server.server_address[1])
+    server.serve_forever()
+
+
+def _poll(port, paths, until, latencies, statuses):
+    """Polls paths in turn like a display would, with If-None-Match."""
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    etags = {}
+    index = 0
+    while time.perf_counter() < until:
+        path = paths[index % len(paths)]
+        index += 1
+        headers = {}
+        if path in etags:
+            headers['If-None-Match'] = etags[path]
+        started = time.perf_counter()
+        connection.request('GET', path, headers=headers)
+        response = connection.getresponse()
+        response.read()
+        latencies.append(time.perf_counter() - started)
+        statuses.append(response.status)
+        if response.status == 200:
+            etags[path] = response.getheader('ETag')
+    connection.close()
+
+
+def benchService(args):
+    """Requests per second and latency of renderservice.py under load.
+
+    The service runs in a process of its own, the clients in threads of
+    this one, each polling a few locations over a kept-alive connection.
+    """
+    if not args.forecast:
+        print('service: skipped, needs --forecast FILE')
+        return
+    stub, apiRequests = _serveForecast(args.forecast)
+    apiUrl = 'http://127.0.0.1:{}/weatherapi'.format(stub.server_port)
+    ready = multiprocessing.Queue()
+    with tempfile.TemporaryDirectory() as cacheDirectory:
+        service = multiprocessing.Process(
+            target=_runService, args=(apiUrl, cacheDirectory, ready),
+            daemon=True)
+        service.start()
+        try:
+            port = ready.get(timeout=60)
+            paths = ['/frame?lat={}&lon=5.7166&format={}'.format(
+                58 + location / 10, 'png' if location % 2 else 'raw')
+                for location in range(args.locations)]
+            latencies = []
+            statuses = []
+            until = time.perf_counter() + args.seconds
+            clients = [threading.Thread(
+                target=_poll, args=(port, paths[i % len(paths):] +
+                                    paths[:i % len(paths)], until,
+                                    latencies, statuses))
+                for i in range(args.clients)]
+            started = time.perf_counter()
+            for client in clients:
+                client.start()
+            for client in clients:
+                client.join()
+            seconds = time.perf_counter() - started
+            connection = http.client.HTTPConnection('127.0.0.1', port)
+            connection.request('GET', '/metrics')
+            exported = connection.getresponse().read().decode()
+            connection.close()
+        finally:
+            service.terminate()
+            service.join()
+    stub.shutdown()
+    renders = re.search(r'^weather_display_service_renders_total (\S+)$',
+                        exported, re.MULTILINE)
+    latencies.sort()
+    print('Render service ({} clients, {} locations, {} s):'.format(
+        args.clients, args.locations, args.seconds))
+    print('  {:8.0f} requests/s, {}'.format(
+        len(latencies) / seconds, ', '.join(
+            '{} x {}'.format(count, status)
+            for status, count in sorted(
+                collections.Counter(statuses).items()))))
+    print('  latency p50 {:.1f} ms, p99 {:.1f} ms'.format(
+        latencies[len(latencies) // 2] * 1000,
+        latencies[len(latencies) * 99 // 100] * 1000))
+    print('  {} frames drawn, {} forecast requests to the API'.format(
+        float(renders.group(1)) if renders else '?',
+        sum('locationforecast' in path for path in apiRequests)))
+
+
+BENCHMARKS = {
+    'framebuffer': benchFrameBuffer,
+    'spi': benchSpi,
+    'parse': benchParse,
+    'panel': benchPanel,
+    'render': benchRender,
+    'download': benchDownload,
+    'service': benchService,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('benchmarks', nargs='*', metavar='benchmark',
+                        help='one of {} (default: all)'.format(
+                            ', '.join(BENCHMARKS)))
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--forecast', metavar='FILE',
+                        help='locationforecast JSON for the parse, render '
+                             'and service benchmarks')
+    parser.add_argument('--latitude', type=float, default=58.8474,
+                        help='location for the download benchmark')
+    parser.add_argument('--longitude', type=float, default=5.7166)
+    parser.add_argument('--clients', type=int, default=200,
+                        help='clients polling in the service benchmark')
+    parser.add_argument('--locations', type=int, default=4)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--backend', choices=('spidev', 'sim'),
+                        help='panel backend for the spi benchmark '
+                             '(default: $EPD_BACKEND or spidev)')
+    args = parser.parse_args()
+    if args.backend:
+        epdif.set_backend(args.backend)
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error('unknown benchmark {!r}'.format(name))
+    for name in args.benchmarks or BENCHMARKS:
+        BENCHMARKS[name](args)
@@ -0,0 +1,319 @@
+"""Runs several weather displays from one process.
+
+Each display is a location and an output: the e-paper panel on this Pi
+or a PNG file, e.g. for a web page or a display fed over the network.
+Instead of one weather_display.py process per display, they all share
+
+* one HTTP client with kept-alive connections and one response cache,
+  so displays at the same coordinates make one request between them and
+  each host costs one TLS handshake,
+* one parsed forecast per location,
+* the fonts, icons and static layer in renderer, loaded once before the
+  render workers are forked (which is done before any other thread is
+  started, so no worker starts with a lock some thread held),
+* a pool of render worker processes, one per core by default, so
+  drawing many displays scales with the cores instead of queueing on
+  the GIL.
+
+Configure DISPLAYS below, or pass a JSON file with a list like it:
+
+    python3 daemon.py displays.json
+"""
+
+
+import argparse
+import asyncio
+import concurrent.futures
+import hashlib
+import json
+import multiprocessing
+import os
+import threading
+import time
+import epd2in7
+import forecast
+import history
+import metapi
+import metrics
+import renderer
+import scheduler
+
+
+# name: used in log messages and metrics
+# output: 'panel' for the display attached to this Pi (at most one), or
+# the path of a PNG file to keep up to date
+DISPLAYS = [
+    {'name': 'home', 'latitude': 58.8474, 'longitude': 5.7166,
+     'output': 'panel'},
+]
+# Processes drawing frames, None for one per core
+RENDER_WORKERS = None
+TIMESTAMP_FORMAT = '%d.%m.%y %H:%M'
+# Same meaning as in weather_display.py
+MIN_UPDATE_INTERVAL = 60
+MAX_UPDATE_INTERVAL = 600
+FULL_REFRESH_INTERVAL = 6
+POWER_MODE = 'sleep'
+METRICS_PORT = None
+# Forecast history per location, see history.py. None keeps none.
+HISTORY_FILE = 'cache/history-{latitude:.4f}-{longitude:.4f}.bin'
+HISTORY_DAYS = 31
+# Fingerprint of the frame each display shows, so a restart does not
+# refresh displays that already show the right frame
+LAST_FRAME_FILE = 'cache/last_frame-{name}.sha1'
+
+stageSeconds = metrics.REGISTRY.histogram(
+    'weather_display_daemon_stage_seconds',
+    'Time spent in each stage of an update, per display.',
+    ('display', 'stage'))
+forecastRequests = metrics.REGISTRY.counter(
+    'weather_display_forecast_requests_total',
+    'Forecast lookups by result: cached, not_modified, downloaded or '
+    'stale.',
+    ('result',))
+wireBytes = metrics.REGISTRY.counter(
+    'weather_display_wire_bytes_total',
+    'Bytes forecast requests took on the wire, headers included.')
+refreshes = metrics.REGISTRY.counter(
+    'weather_display_daemon_refreshes_total',
+    'Frames shown per display, by kind of refresh.', ('display', 'kind'))
+errors = metrics.REGISTRY.counter(
+    'weather_display_daemon_errors_total',
+    'Updates that failed, by display and step.', ('display', 'step'))
+
+
+class Location:
+    """A place to forecast, shared by every display showing it."""
+
+    def __init__(self, cache, latitude, longitude):
+        self.cache = cache
+        self.url = metapi.forecastUrl(latitude, longitude,
+                                      renderer.FORECAST_PRODUCT)
+        self.historyPath = None if HISTORY_FILE is None else (
+            HISTORY_FILE.format(latitude=latitude, longitude=longitude))
+        self.history = None
+        # (forecast, stale), replaced in one assignment so a display
+        # never reads a new forecast with the old flag or the other way
+        self.current = (None, False)
+        self.expires = 0
+        self._lock = threading.Lock()
+
+    def update(self):
+        """Fetches the forecast if it has expired and returns it.
+
+        Parsed once per new forecast, however many displays ask.
+        """
+        with self._lock:
+            response = self.cache.fetch(self.url)
+            forecastRequests.inc(result=response.status)
+            wireBytes.inc(response.wireBytes)
+            self.expires = response.expires
+            if response.stale:
+                print('Could not refresh {} ({}), showing the last '
+                      'forecast'.format(self.url, response.error))
+            data = self.current[0]
+            if response.modified or data is None:
+                with response.open() as f:
+                    data = forecast.read(f, renderer.FORECAST_STEPS)
+                self._recordHistory(data)
+            self.current = (data, response.stale)
+            return data
+
+    def _recordHistory(self, data):
+        if self.historyPath is None:
+            return
+        try:
+            if self.history is None:
+                self.history = history.History(self.historyPath)
+            self.history.append(data)
+            self.history.expire(HISTORY_DAYS)
+        except (OSError, ValueError) as e:
+            print('Could not save the forecast history: {}'.format(e))
+
+
+class PanelOutput:
+    """The e-paper display attached to this Pi."""
+
+    def __init__(self):
+        self.epd = epd2in7.EPD(full_refresh_interval=FULL_REFRESH_INTERVAL,
+                               power_mode=POWER_MODE,
+                               profile=renderer.panel)
+
+    def show(self, frameBuffer):
+        return self.epd.update_frame(frameBuffer)
+
+
+class ImageOutput:
+    """A PNG file showing what the display would."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def show(self, frameBuffer):
+        # Written next to it and renamed, so readers never see half a file
+        temporary = self.path + '.tmp.png'
+        renderer.frameImage(frameBuffer).save(temporary)
+        os.replace(temporary, self.path)
+        return 'full'
+
+
+class Display:
+    """One location on one output, with the steps the Scheduler runs."""
+
+    def __init__(self, name, location, output, legend, pool):
+        self.name = name
+        self.location = location
+        self.output = output
+        self.legend = legend
+        self.pool = pool
+        self.drawn = None
+        self.drawnStale = False
+        self.fingerprintPath = LAST_FRAME_FILE.format(name=name)
+        self.fingerprint = self.loadFingerprint()
+
+    def fetch(self):
+        self.location.update()
+        data, stale = self.location.current
+        changed = data is not self.drawn or stale != self.drawnStale
+        return changed, self.location.expires
+
+    def render(self):
+        data, stale = self.location.current
+        if data is None:
+            return None
+        status = self.legend.description(data.steps[0].symbol1h)
+        with stageSeconds.time(display=self.name, stage='render'):
+            frameBuffer, timings = self.pool.submit(
+                renderInWorker, data, status,
+                time.strftime(TIMESTAMP_FORMAT), stale).result()
+        for stage, seconds in timings:
+            renderer.stageSeconds.observe(seconds, stage=stage)
+        self.drawn, self.drawnStale = data, stale
+        return frameBuffer
+
+    def show(self, frameBuffer):
+        fingerprint = hashlib.sha1(frameBuffer).hexdigest()
+        if fingerprint == self.fingerprint:
+            refreshes.inc(display=self.name, kind='skipped')
+            return
+        with stageSeconds.time(display=self.name, stage='display'):
+            refresh = self.output.show(frameBuffer)
+        refreshes.inc(display=self.name, kind=refresh)
+        self.fingerprint = fingerprint
+        self.saveFingerprint()
+        print('{}: refreshed ({}) at {}'.format(
+            self.name, refresh, time.strftime('%d%m%y-%H:%M:%S')))
+
+    def loadFingerprint(self):
+        """Returns the fingerprint of the frame last sent to the output."""
+        try:
+            with open(self.fingerprintPath) as f:
+                return f.read().strip()
+        except OSError:
+            return None
+
+    def saveFingerprint(self):
+        os.makedirs(os.path.dirname(self.fingerprintPath), exist_ok=True)
+        with open(self.fingerprintPath + '.tmp', 'w') as f:
+            f.write(self.fingerprint)
+        os.replace(self.fingerprintPath + '.tmp', self.fingerprintPath)
+
+    def onError(self, e, step):
+        errors.inc(display=self.name, step=step)
+        print('{}: {} failed: {}'.format(self.name, step, e))
+
+
+def loadDisplays(path):
+    if path is None:
+        return DISPLAYS
+    with open(path) as f:
+        return json.load(f)
+
+
+def renderInWorker(data, status, lastUpdated, stale):
+    """renderer.renderFrame, in a render worker.
+
+    Returns the frame buffer and [(stage, seconds)] for drawing and
+    packing it. What renderer records itself stays in the worker's copy
+    of the metrics, so the daemon records these instead.
+    """
+    start = time.perf_counter()
+    mask = renderer.drawFrame(data, status, lastUpdated, stale)
+    drawn = time.perf_counter()
+    frameBuffer = renderer.packFrame(mask)
+    return frameBuffer, [('draw', drawn - start),
+                         ('pack', time.perf_counter() - drawn)]
+
+
+def makeRenderPool(workers):
+    # Forked workers start with renderer's fonts and icons already loaded
+    # (and share the memory), spawned ones would load their own. Forking
+    # is only safe while this is the only thread, since a worker gets
+    # every lock as it was (logging's, urllib's, the metrics registry's)
+    # and nobody to release one that was held. So the workers are all
+    # started here, before the caller starts any threads; with fork the
+    # pool never starts more later.
+    if 'fork' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('fork')
+    else:
+        context = multiprocessing.get_context()
+    workers = workers or os.cpu_count() or 1
+    pool = concurrent.futures.ProcessPoolExecutor(workers, mp_context=context)
+    for future in [pool.submit(os.getpid) for _ in range(workers)]:
+        future.result()
+    return pool
+
+
+def makeDisplays(configs, cache, legend, pool):
+    locations = {}
+    displays = []
+    panels = 0
+    for config in configs:
+        location = Location(cache, config['latitude'], config['longitude'])
+        # Same coordinates (to 4 decimals), same Location
+        location = locations.setdefault(location.url, location)
+        if config['output'] == 'panel':
+            panels += 1
+            if panels > 1:
+                raise ValueError('Only one display can use the panel')
+            output = PanelOutput()
+        else:
+            output = ImageOutput(config['output'])
+        displays.append(Display(config['name'], location, output, legend,
+                                pool))
+    return displays
+
+
+async def runDisplays(displays):
+    # Every display can have a fetch and a render waiting at once
+    asyncio.get_running_loop().set_default_executor(
+        concurrent.futures.ThreadPoolExecutor(2 * len(displays) + 2))
+    await asyncio.gather(*(
+        scheduler.Scheduler(
+            display.fetch, display.render, display.show, display.onError,
+            redrawInterval=MAX_UPDATE_INTERVAL,
+            minFetchInterval=MIN_UPDATE_INTERVAL).run()
+        for display in displays))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('config', nargs='?',
+                        help='JSON list of displays (default: DISPLAYS)')
+    parser.add_argument('--workers', type=int, default=RENDER_WORKERS,
+                        help='render processes (default: one per core)')
+    args = parser.parse_args()
+    # First, while there are no other threads (see makeRenderPool)
+    pool = makeRenderPool(args.workers)
+    cache = metapi.ResponseCache()
+    legend = metapi.Legend(cache)
+    renderer.icons.validate(legend.symbolCodes())
+    displays = makeDisplays(loadDisplays(args.config), cache, legend, pool)
+    if METRICS_PORT is not None:
+        metrics.REGISTRY.serve(METRICS_PORT)
+    try:
+        asyncio.run(runDisplays(displays))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        pool.shutdown()
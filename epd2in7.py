@@ -25,16 +25,18 @@
  #
 
 import epdif
+import panels
 from PIL import Image
 from PIL import ImageFont
 from PIL import ImageDraw
-import RPi.GPIO as GPIO
+from collections import namedtuple
 
-# Display resolution
+# Display resolution of the 2.7 inch panel, see panels.py for the others
 EPD_WIDTH       = 176
 EPD_HEIGHT      = 264
 
-# EPD2IN7 commands
+# EPD2IN7 commands. The driver takes the ones it sends from the panel
+# profile, so other controllers can use other codes.
 PANEL_SETTING                               = 0x00
 POWER_SETTING                               = 0x01
 POWER_OFF                                   = 0x02
@@ -73,68 +75,123 @@ PROGRAM_MODE                                = 0xA0
 ACTIVE_PROGRAM                              = 0xA1
 READ_OTP_DATA                               = 0xA2
 
+# Longest the panel may stay busy, in seconds. A refresh takes about 5 s.
+BUSY_TIMEOUT = 30
+
+# Timings of the last frame sent to the panel, all on the backend's clock
+# (epdif.epd_clock, simulated on the simulated panel). transfer_seconds only
+# counts the time spent in bulk SPI writes, so bytes / transfer_seconds is the
+# link throughput; total_seconds is the time for the whole frame. windows is
+# the number of partial refresh windows, 0 for a full refresh.
+# wake_seconds is how long it took to get the panel out of its low power
+# state first, 0 if it was already up.
+FrameStats = namedtuple('FrameStats', [
+    'bytes', 'transfer_seconds', 'refresh_seconds', 'total_seconds',
+    'windows', 'wake_seconds'], defaults=[0.0])
+
+# Low power states for EPD.rest(), see EPD.__init__
+POWER_MODES = (None, 'off', 'sleep')
+
+# How images given to get_frame_buffer are turned (counter-clockwise, like
+# PIL's Image.rotate) to sit the way the panel is mounted. 90 and 270 take
+# landscape images, as wide as the panel is high.
+ORIENTATIONS = (0, 90, 180, 270)
+# Image.ROTATE_90 and friends moved to Image.Transpose in Pillow 9.1
+_TRANSPOSE = getattr(Image, 'Transpose', Image)
+# Orientation -> the transpose that turns an image by that much
+_TURN = {90: _TRANSPOSE.ROTATE_90, 180: _TRANSPOSE.ROTATE_180,
+         270: _TRANSPOSE.ROTATE_270}
+
+def row_bytes(width):
+    # Bytes per row of a frame buffer. Rows start on a byte, so a width
+    # that is not a multiple of 8 leaves the last byte of each partly
+    # unused, as in Waveshare's drivers for those panels (and in PIL's
+    # mode 1 images).
+    return (width + 7) // 8
+
+def dirty_rectangles(old_buffer, new_buffer, width, height, merge_gap=8):
+    # Compares two frame buffers and returns the areas that differ as a list
+    # of (x, y, w, l) windows, with x and w in whole bytes (multiples of 8
+    # pixels). Changed rows up to merge_gap rows apart share one window,
+    # since every window costs a refresh of its own.
+    if old_buffer == new_buffer:
+        return []
+    stride = row_bytes(width)
+    bands = []
+    for row in range(height):
+        start = row * stride
+        diff = (int.from_bytes(old_buffer[start:start + stride], 'big') ^
+                int.from_bytes(new_buffer[start:start + stride], 'big'))
+        if not diff:
+            continue
+        # The highest set bit is in the leftmost changed byte, the lowest
+        # set bit in the rightmost one.
+        first = stride - 1 - (diff.bit_length() - 1) // 8
+        last = stride - 1 - ((diff & -diff).bit_length() - 1) // 8
+        if bands and row - bands[-1][1] <= merge_gap:
+            band = bands[-1]
+            band[1] = row
+            band[2] = min(band[2], first)
+            band[3] = max(band[3], last)
+        else:
+            bands.append([row, row, first, last])
+    return [(first * 8, top, (last - first + 1) * 8, bottom - top + 1)
+            for top, bottom, first, last in bands]
+
+def bounding_window(rectangles):
+    # The one (x, y, w, l) window around all the rectangles
+    left = min(x for x, y, w, l in rectangles)
+    top = min(y for x, y, w, l in rectangles)
+    right = max(x + w for x, y, w, l in rectangles)
+    bottom = max(y + l for x, y, w, l in rectangles)
+    return left, top, right - left, bottom - top
+
 class EPD:
-    def __init__(self):
+    # power_mode is what update_frame does with the panel after a refresh:
+    # None leaves it powered on, 'off' switches the booster off but keeps
+    # the registers and LUTs, and 'sleep' puts it in deep sleep, which
+    # draws the least but loses everything. update_frame wakes it again
+    # with as little as it needs to send, see wake().
+    # profile is the panels.PanelProfile of the panel connected, by
+    # default the 2.7 inch one; its resolution, commands, registers and
+    # LUTs are all the driver needs to know of it.
+    def __init__(self, full_refresh_interval=10, partial_area_limit=0.5,
+                 power_mode=None, orientation=0, profile=None):
+        if power_mode not in POWER_MODES:
+            raise ValueError('power_mode must be one of {}'.format(
+                POWER_MODES))
+        if orientation not in ORIENTATIONS:
+            raise ValueError('orientation must be one of {}'.format(
+                ORIENTATIONS))
         self.reset_pin = epdif.RST_PIN
         self.dc_pin = epdif.DC_PIN
         self.busy_pin = epdif.BUSY_PIN
-        self.width = EPD_WIDTH
-        self.height = EPD_HEIGHT
-
-    lut_vcom_dc = [
-        0x00, 0x00,
-        0x00, 0x0F, 0x0F, 0x00, 0x00, 0x05,
-        0x00, 0x32, 0x32, 0x00, 0x00, 0x02,
-        0x00, 0x0F, 0x0F, 0x00, 0x00, 0x05,
-        0x00, 0x00, 0x00, 0x00, 0x00, 0x00,
-        0x00, 0x00, 0x00, 0x00, 0x00, 0x00,
-        0x00, 0x00, 0x00, 0x00, 0x00, 0x00,
-        0x00, 0x00, 0x00, 0x00, 0x00, 0x00,
-    ]
-
-    # R21H
-    lut_ww = [
-        0x50, 0x0F, 0x0F, 0x00, 0x00, 0x05,
-        0x60, 0x32, 0x32, 0x00, 0x00, 0x02,
-        0xA0, 0x0F, 0x0F, 0x00, 0x00, 0x05,
-        0x00, 0x00, 0x00, 0x00, 0x00, 0x00,
-        0x00, 0x00, 0x00, 0x00, 0x00, 0x00,
-        0x00, 0x00, 0x00, 0x00, 0x00, 0x00,
-        0x00, 0x00, 0x00, 0x00, 0x00, 0x00,
-    ]
-
-    # R22H    r
-    lut_bw = [
-        0x50, 0x0F, 0x0F, 0x00, 0x00, 0x05,
-        0x60, 0x32, 0x32, 0x00, 0x00, 0x02,
-        0xA0, 0x0F, 0x0F, 0x00, 0x00, 0x05,
-        0x00, 0x00, 0x00, 0x00, 0x00, 0x00,
-        0x00, 0x00, 0x00, 0x00, 0x00, 0x00,
-        0x00, 0x00, 0x00, 0x00, 0x00, 0x00,
-        0x00, 0x00, 0x00, 0x00, 0x00, 0x00,
-    ]
-
-    # R24H    b
-    lut_bb = [
-        0xA0, 0x0F, 0x0F, 0x00, 0x00, 0x05,
-        0x60, 0x32, 0x32, 0x00, 0x00, 0x02,
-        0x50, 0x0F, 0x0F, 0x00, 0x00, 0x05,
-        0x00, 0x00, 0x00, 0x00, 0x00, 0x00,
-        0x00, 0x00, 0x00, 0x00, 0x00, 0x00,
-        0x00, 0x00, 0x00, 0x00, 0x00, 0x00,
-        0x00, 0x00, 0x00, 0x00, 0x00, 0x00,
-    ]
-
-    # R23H    w
-    lut_wb = [
-        0xA0, 0x0F, 0x0F, 0x00, 0x00, 0x05,
-        0x60, 0x32, 0x32, 0x00, 0x00, 0x02,
-        0x50, 0x0F, 0x0F, 0x00, 0x00, 0x05,
-        0x00, 0x00, 0x00, 0x00, 0x00, 0x00,
-        0x00, 0x00, 0x00, 0x00, 0x00, 0x00,
-        0x00, 0x00, 0x00, 0x00, 0x00, 0x00,
-        0x00, 0x00, 0x00, 0x00, 0x00, 0x00,
-    ]
+        if profile is None:
+            profile = panels.profile(panels.DEFAULT_PANEL)
+        self.profile = profile
+        self.commands = profile.commands
+        self.width = profile.width
+        self.height = profile.height
+        # get_frame_buffer turns images by this many degrees
+        self.orientation = orientation
+        self.frame_stats = None
+        # Partial refresh state for update_frame. full_refresh_interval = 0
+        # turns partial refreshes off.
+        self.full_refresh_interval = full_refresh_interval
+        self.partial_area_limit = partial_area_limit
+        self.partial_count = 0
+        self.last_frame = None
+        self.busy_timeout = BUSY_TIMEOUT
+        # How long the last wait_until_idle took, in seconds
+        self.last_busy_seconds = None
+        # Power state, and the register values the controller holds now
+        # (command -> data). Registers already holding the right value are
+        # not sent again; a reset or deep sleep clears them.
+        self.power_mode = power_mode
+        self.initialized = False
+        self.powered = False
+        self.asleep = False
+        self.registers = {}
 
     def digital_write(self, pin, value):
         epdif.epd_digital_write(pin, value)
@@ -146,145 +203,280 @@ class EPD:
         epdif.epd_delay_ms(delaytime)
 
     def send_command(self, command):
-        self.digital_write(self.dc_pin, GPIO.LOW)
+        self.digital_write(self.dc_pin, epdif.LOW)
         # the parameter type is list but not int
         # so use [command] instead of command
         epdif.spi_transfer([command])
 
     def send_data(self, data):
-        self.digital_write(self.dc_pin, GPIO.HIGH)
+        self.digital_write(self.dc_pin, epdif.HIGH)
         # the parameter type is list but not int
         # so use [data] instead of data
         epdif.spi_transfer([data])
 
+    def send_data_bulk(self, data):
+        # Same as send_data for a whole buffer: DC is set once and the
+        # bytes are streamed in as few SPI transfers as possible.
+        self.digital_write(self.dc_pin, epdif.HIGH)
+        epdif.spi_transfer_bulk(data)
+
+    def send_register(self, command, data, key=None):
+        # Sends command with data unless the controller already holds it.
+        # key tells apart writes that share a command, like the 0xF8 ones.
+        # Returns whether anything was sent.
+        key = command if key is None else key
+        if not isinstance(data, bytes):
+            data = bytes(data)
+        if self.registers.get(key) == data:
+            return False
+        self.send_command(command)
+        self.send_data_bulk(data)
+        self.registers[key] = data
+        return True
+
     def init(self):
         if (epdif.epd_init() != 0):
             return -1
         # EPD hardware init start
         self.reset()
-        self.send_command(POWER_SETTING)
-        self.send_data(0x03)                  # VDS_EN, VDG_EN
-        self.send_data(0x00)                  # VCOM_HV, VGHL_LV[1], VGHL_LV[0]
-        self.send_data(0x2b)                  # VDH
-        self.send_data(0x2b)                  # VDL
-        self.send_data(0x09)                  # VDHR
-        self.send_command(BOOSTER_SOFT_START)
-        self.send_data(0x07)
-        self.send_data(0x07)
-        self.send_data(0x17)
-        # Power optimization
-        self.send_command(0xF8)
-        self.send_data(0x60)
-        self.send_data(0xA5)
-        # Power optimization
-        self.send_command(0xF8)
-        self.send_data(0x89)
-        self.send_data(0xA5)
-        # Power optimization
-        self.send_command(0xF8)
-        self.send_data(0x90)
-        self.send_data(0x00)
-        # Power optimization
-        self.send_command(0xF8)
-        self.send_data(0x93)
-        self.send_data(0x2A)
-        # Power optimization
-        self.send_command(0xF8)
-        self.send_data(0xA0)
-        self.send_data(0xA5)
-        # Power optimization
-        self.send_command(0xF8)
-        self.send_data(0xA1)
-        self.send_data(0x00)
-        # Power optimization
-        self.send_command(0xF8)
-        self.send_data(0x73)
-        self.send_data(0x41)
-        self.send_command(PARTIAL_DISPLAY_REFRESH)
-        self.send_data(0x00)
-        self.send_command(POWER_ON)
+        self.configure()
+        # EPD hardware init end
+        self.initialized = True
+        return 0
+
+    def configure(self):
+        # Powers the panel on and sets up every register. After a reset that
+        # sends everything; when the panel was only powered off, all that is
+        # left to send is POWER_ON.
+        # The values are the profile's, compiled to bytes when it was made.
+        for register in self.profile.powerOnRegisters:
+            self.send_register(*register)
+        self.send_command(self.commands['powerOn'])
         self.wait_until_idle()
+        self.powered = True
 
-        self.send_command(PANEL_SETTING)
-        self.send_data(0xAF)        # KW-BF   KWR-AF    BWROTP 0f
-        self.send_command(PLL_CONTROL)
-        self.send_data(0x3A)        # 3A 100HZ   29 150Hz 39 200HZ    31 171HZ
-        self.send_command(VCM_DC_SETTING_REGISTER)
-        self.send_data(0x12)
+        for register in self.profile.registers:
+            self.send_register(*register)
         self.delay_ms(2)
         self.set_lut()
-        # EPD hardware init end
-        return 0
 
-    def wait_until_idle(self):
-        while(self.digital_read(self.busy_pin) == 0):      # 0: busy, 1: idle
-            self.delay_ms(100)
+    def wake(self):
+        # Gets the panel ready for a refresh from whatever state rest() left
+        # it in, and returns how long that took. Deep sleep can only be left
+        # through a reset, which clears every register, but the reset pulse
+        # itself only has to be a few ms long (5 ms in Waveshare's later
+        # drivers) rather than init's 200 ms.
+        start = epdif.epd_clock()
+        if not self.initialized:
+            self.init()
+        elif self.asleep:
+            self.reset(low_ms=5)
+            self.configure()
+        elif not self.powered:
+            self.configure()
+        return epdif.epd_clock() - start
+
+    def rest(self):
+        # Puts the panel in the low power state set by power_mode.
+        if self.power_mode == 'sleep':
+            self.sleep()
+        elif self.power_mode == 'off':
+            self.power_off()
+
+    def power_off(self):
+        # Switches the booster and panel drivers off. The controller keeps
+        # its registers and LUTs, so configure() only needs POWER_ON.
+        self.send_command(self.commands['powerOff'])
+        self.wait_until_idle()
+        self.powered = False
 
-    def reset(self):
-        self.digital_write(self.reset_pin, GPIO.LOW)         # module reset
-        self.delay_ms(200)
-        self.digital_write(self.reset_pin, GPIO.HIGH)
+    def wait_until_idle(self):
+        # Sleeps until the BUSY pin goes high (0: busy, 1: idle), woken by
+        # its edge rather than polling, and returns how long that took.
+        seconds = epdif.epd_wait_for_idle(self.busy_pin, self.busy_timeout)
+        if seconds is None:
+            raise TimeoutError('Display still busy after {} s'.format(
+                self.busy_timeout))
+        self.last_busy_seconds = seconds
+        return seconds
+
+    def reset(self, low_ms=200):
+        self.digital_write(self.reset_pin, epdif.LOW)         # module reset
+        self.delay_ms(low_ms)
+        self.digital_write(self.reset_pin, epdif.HIGH)
         self.delay_ms(200)    
+        self.registers = {}
+        self.powered = False
+        self.asleep = False
 
     def set_lut(self):
-        self.send_command(LUT_FOR_VCOM)               # vcom
-        for count in range(0, 44):
-            self.send_data(self.lut_vcom_dc[count])
-        self.send_command(LUT_WHITE_TO_WHITE)         # ww --
-        for count in range(0, 42):
-            self.send_data(self.lut_ww[count])
-        self.send_command(LUT_BLACK_TO_WHITE)         # bw r
-        for count in range(0, 42):
-            self.send_data(self.lut_bw[count])
-        self.send_command(LUT_WHITE_TO_BLACK)         # wb w
-        for count in range(0, 42):
-            self.send_data(self.lut_bb[count])
-        self.send_command(LUT_BLACK_TO_BLACK)         # bb b
-        for count in range(0, 42):
-            self.send_data(self.lut_wb[count])
+        for register in self.profile.luts:
+            self.send_register(*register)
+
+    def image_size(self):
+        # (width, height) of the images get_frame_buffer takes
+        if self.orientation in (90, 270):
+            return self.height, self.width
+        return self.width, self.height
 
     def get_frame_buffer(self, image):
-        buf = [0x00] * (self.width * self.height // 8)
-        # Set buffer to value of Python Imaging Library image.
-        # Image must be in mode 1.
+        # Set buffer to value of Python Imaging Library image, turned by
+        # self.orientation degrees. Image must be in mode 1.
         image_monocolor = image.convert('1')
-        imwidth, imheight = image_monocolor.size
-        if imwidth != self.width or imheight != self.height:
+        if image_monocolor.size != self.image_size():
             raise ValueError('Image must be same dimensions as display \
-                ({0}x{1}).' .format(self.width, self.height))
-
+                ({0}x{1}).' .format(*self.image_size()))
+
+        # Mode 1 images are stored one bit per pixel, MSB first, with white
+        # (non-zero) pixels set and each row padded to a whole byte. That
+        # is exactly the layout the controller expects, whatever the width,
+        # so PIL can do the packing in C. transpose turns the image without
+        # resampling, a landscape one costs about the same as a portrait.
+        if self.orientation:
+            image_monocolor = image_monocolor.transpose(
+                _TURN[self.orientation])
+        return bytearray(image_monocolor.tobytes())
+
+    def get_image(self, frame_buffer):
+        # The image get_frame_buffer would turn into frame_buffer. Its rows
+        # are padded to whole bytes like a mode 1 image's, whatever the
+        # width, so PIL can unpack it as it is.
+        image = Image.frombytes('1', (self.width, self.height),
+                                bytes(frame_buffer))
+        if self.orientation == 0:
+            return image
+        return image.transpose(_TURN[360 - self.orientation])
+
+    def pack_pixels(self, image_monocolor):
+        # Reference pixel-by-pixel packing, the baseline benchmark.py
+        # checks get_frame_buffer against. Each row starts on a byte, see
+        # row_bytes.
+        stride = row_bytes(self.width)
+        buf = bytearray(stride * self.height)
         pixels = image_monocolor.load()
         for y in range(self.height):
             for x in range(self.width):
                 # Set the bits for the column of pixels at the current position.
                 if pixels[x, y] != 0:
-                    buf[(x + y * self.width) // 8] |= (0x80 >> (x % 8))
+                    buf[y * stride + x // 8] |= (0x80 >> (x % 8))
         return buf
 
     def display_frame(self, frame_buffer):
         if (frame_buffer != None):
-            self.send_command(DATA_START_TRANSMISSION_1)           
+            snapshot = self._frame_started()
+            self.send_command(self.commands['dataStart1'])
+            self.delay_ms(2)
+            self.send_data_bulk(self.profile.whitePlane)
+            self.delay_ms(2)
+            self.send_command(self.commands['dataStart2'])
             self.delay_ms(2)
-            for i in range(0, self.width * self.height // 8):
-                self.send_data(0xFF)  
-            self.delay_ms(2)                  
-            self.send_command(DATA_START_TRANSMISSION_2)
+            self.send_data_bulk(frame_buffer)
             self.delay_ms(2)
-            for i in range(0, self.width * self.height // 8):
-                self.send_data(frame_buffer[i])  
-            self.delay_ms(2)        
-            self.send_command(DISPLAY_REFRESH) 
-            self.wait_until_idle()
+            self.send_command(self.commands['refresh'])
+            refresh_seconds = self.wait_until_idle()
+            self._frame_finished(snapshot, refresh_seconds, 0)
+            self.last_frame = bytes(frame_buffer)
+            self.partial_count = 0
+
+    def display_partial_frame(self, old_buffer, frame_buffer, x, y, w, l):
+        # Refreshes only the window at x, y of size w x l. x and w must be
+        # multiples of 8, the controller ignores the low 3 bits. The old data
+        # lets the controller pick the right waveform for each pixel.
+        header = bytes([
+            x >> 8, x & 0xf8,
+            y >> 8, y & 0xff,
+            w >> 8, w & 0xf8,
+            l >> 8, l & 0xff,
+        ])
+        self.send_command(self.commands['partialDataStart1'])
+        self.send_data_bulk(header)
+        self.delay_ms(2)
+        self.send_data_bulk(self.get_window(old_buffer, x, y, w, l))
+        self.delay_ms(2)
+        self.send_command(self.commands['partialDataStart2'])
+        self.send_data_bulk(header)
+        self.delay_ms(2)
+        self.send_data_bulk(self.get_window(frame_buffer, x, y, w, l))
+        self.delay_ms(2)
+        self.send_command(self.commands['partialRefresh'])
+        self.send_data_bulk(header)
+        # No longer the value configure() sets
+        self.registers.pop(self.commands['partialRefresh'], None)
+        return self.wait_until_idle()
+
+    def get_window(self, frame_buffer, x, y, w, l):
+        # Cuts the w x l window at x, y out of a full frame buffer.
+        stride = row_bytes(self.width)
+        first = x // 8
+        last = (x + w) // 8
+        return b''.join(frame_buffer[row * stride + first:row * stride + last]
+                        for row in range(y, y + l))
+
+    def update_frame(self, frame_buffer):
+        # Shows frame_buffer with the cheapest refresh that will do: nothing
+        # if it is already on screen, partial refreshes of the areas that
+        # changed, or a full refresh. Every full_refresh_interval partial
+        # updates (or when most of the screen changed) a full refresh is
+        # forced to clear the ghosting partial updates leave behind, and
+        # panels whose profile has no partial refresh always get a full one.
+        # A partial refresh runs the whole waveform, as long as a full one,
+        # however small its window, so the changed areas are refreshed in
+        # one window around them all rather than one after the other.
+        # The panel is woken up for the refresh and put back to rest after
+        # it, as power_mode says. Returns 'none', 'partial' or 'full'.
+        frame_buffer = bytes(frame_buffer)
+        last = self.last_frame
+        if last == frame_buffer:
+            # Already on screen, whatever the partial refresh budget says
+            return 'none'
+        window = None
+        if (last is not None and self.profile.partial
+                and self.partial_count < self.full_refresh_interval):
+            window = bounding_window(dirty_rectangles(
+                last, frame_buffer, self.width, self.height))
+            x, y, w, l = window
+            if w * l > self.width * self.height * self.partial_area_limit:
+                window = None
+        wake_seconds = self.wake()
+        if window is None:
+            self.display_frame(frame_buffer)
+        else:
+            snapshot = self._frame_started()
+            refresh_seconds = self.display_partial_frame(last, frame_buffer,
+                                                         *window)
+            self._frame_finished(snapshot, refresh_seconds, 1)
+            self.last_frame = frame_buffer
+            self.partial_count += 1
+        self.frame_stats = self.frame_stats._replace(wake_seconds=wake_seconds)
+        self.rest()
+        return 'full' if window is None else 'partial'
+
+    def _frame_started(self):
+        # Everything is timed on the backend's clock, which on the
+        # simulated panel is the simulated one
+        return epdif.epd_clock(), epdif.spi_bytes_sent, epdif.spi_seconds
+
+    def _frame_finished(self, snapshot, refresh_seconds, windows):
+        start, sent_before, spi_before = snapshot
+        self.frame_stats = FrameStats(
+            epdif.spi_bytes_sent - sent_before,
+            epdif.spi_seconds - spi_before,
+            refresh_seconds,
+            epdif.epd_clock() - start,
+            windows)
 
     # After this command is transmitted, the chip would enter the deep-sleep
     # mode to save power. The deep sleep mode would return to standby by
     # hardware reset. The only one parameter is a check code, the command would
-    # be executed if check code = 0xA5. 
+    # be executed if check code = 0xA5 (the profile's deepSleepCheck).
     # Use EPD::Reset() to awaken and use EPD::Init() to initialize.
     def sleep(self):
-        self.send_command(DEEP_SLEEP)
+        self.send_command(self.commands['deepSleep'])
         self.delay_ms(2)
-        self.send_data(0xa5)
+        self.send_data(self.profile.deepSleepCheck)
+        self.registers = {}
+        self.powered = False
+        self.asleep = True
 
 ### END OF FILE ###
 
@@ -24,8 +24,8 @@
  # THE SOFTWARE.
  #
 
-import spidev
-import RPi.GPIO as GPIO
+import os
+import threading
 import time
 
 # Pin definition
@@ -34,35 +34,164 @@ DC_PIN          = 25
 CS_PIN          = 8
 BUSY_PIN        = 24
 
+# Pin levels, same values as RPi.GPIO.LOW and RPi.GPIO.HIGH
+LOW             = 0
+HIGH            = 1
+
 # Display resolution
 EPD_WIDTH       = 176
 EPD_HEIGHT      = 264
 
-# SPI device, bus = 0, device = 0
-SPI = spidev.SpiDev(0, 0)
+# SPI clock, in Hz
+SPI_SPEED_HZ    = 2000000
+
+# Which backend drives the panel: 'spidev' for the real display on the Pi,
+# 'sim' for the simulated one in epdsim.py. Change it with set_backend()
+# before the first call into this module.
+BACKEND = os.environ.get('EPD_BACKEND', 'spidev')
+
+def _spi_buffer_size():
+    # The spidev kernel driver rejects transfers larger than its buffer,
+    # which is 4096 bytes unless raised with the bufsiz module parameter.
+    try:
+        with open('/sys/module/spidev/parameters/bufsiz') as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        return 4096
+
+class SpidevBackend:
+    # The panel on SPI bus 0, device 0 and the Pi's GPIO pins. spidev and
+    # RPi.GPIO are only imported here, so the rest of the code (and the
+    # simulated backend) works on machines that don't have them.
+    def __init__(self):
+        import spidev
+        import RPi.GPIO as GPIO
+        self.gpio = GPIO
+        self.spi = spidev.SpiDev(0, 0)
+        self.chunk_size = _spi_buffer_size()
+        # pin -> threading.Event set on every rising edge of the pin
+        self.rising_edges = {}
+
+    def init(self):
+        GPIO = self.gpio
+        GPIO.setmode(GPIO.BCM)
+        GPIO.setwarnings(False)
+        GPIO.setup(RST_PIN, GPIO.OUT)
+        GPIO.setup(DC_PIN, GPIO.OUT)
+        GPIO.setup(CS_PIN, GPIO.OUT)
+        GPIO.setup(BUSY_PIN, GPIO.IN)
+
+        self.spi.max_speed_hz = SPI_SPEED_HZ
+        self.spi.mode = 0b00
+        return 0
+
+    def digital_write(self, pin, value):
+        self.gpio.output(pin, value)
+
+    def digital_read(self, pin):
+        return self.gpio.input(pin)
+
+    def delay_ms(self, delaytime):
+        time.sleep(delaytime / 1000.0)
+
+    def clock(self):
+        return time.monotonic()
+
+    def wait_for_idle(self, pin, timeout):
+        # Blocks until pin is high, woken by the edge interrupt instead of
+        # polling. Returns the seconds waited, or None after timeout seconds.
+        GPIO = self.gpio
+        start = time.monotonic()
+        edge = self.rising_edges.get(pin)
+        if edge is None:
+            edge = self.rising_edges[pin] = threading.Event()
+            GPIO.add_event_detect(pin, GPIO.RISING,
+                                  callback=lambda channel: edge.set())
+        # Clear before reading the pin: an edge after the read still sets
+        # the event, and one before it shows up as the pin being high.
+        edge.clear()
+        if GPIO.input(pin) == HIGH or edge.wait(timeout):
+            return time.monotonic() - start
+        return None
+
+    def spi_write(self, data):
+        self.spi.writebytes(data)
+
+    def spi_write_bulk(self, view):
+        # writebytes2 takes the buffer directly; older spidev releases only
+        # have writebytes, which wants a list.
+        write = getattr(self.spi, 'writebytes2', None)
+        for offset in range(0, len(view), self.chunk_size):
+            chunk = view[offset:offset + self.chunk_size]
+            if write is not None:
+                write(chunk)
+            else:
+                self.spi.writebytes(chunk.tolist())
+
+def _create_backend(name):
+    if name == 'spidev':
+        return SpidevBackend()
+    if name == 'sim':
+        import epdsim
+        return epdsim.SimulatedPanel()
+    raise ValueError('Unknown EPD backend {!r}, expected spidev or sim'
+                     .format(name))
+
+_backend = None
+
+def set_backend(backend):
+    # backend is a name ('spidev', 'sim') or an object with the same methods
+    # as SpidevBackend, e.g. an epdsim.SimulatedPanel with custom timing.
+    # Returns the backend used until now, None if there wasn't one yet.
+    global _backend
+    previous = _backend
+    _backend = _create_backend(backend) if isinstance(backend, str) else backend
+    return previous
+
+def get_backend():
+    if _backend is None:
+        set_backend(BACKEND)
+    return _backend
+
+# Running totals for spi_transfer_bulk, used to work out throughput. The
+# seconds are on the backend's clock, like everything timing the panel.
+spi_bytes_sent = 0
+spi_seconds = 0.0
 
 def epd_digital_write(pin, value):
-    GPIO.output(pin, value)
+    get_backend().digital_write(pin, value)
 
 def epd_digital_read(pin):
-    return GPIO.input(BUSY_PIN)
+    return get_backend().digital_read(pin)
 
 def epd_delay_ms(delaytime):
-    time.sleep(delaytime / 1000.0)
+    get_backend().delay_ms(delaytime)
+
+def epd_clock():
+    # Seconds on the backend's clock, for timing the panel. The simulated
+    # panel's clock runs on its modelled delays and BUSY periods.
+    return get_backend().clock()
+
+def epd_wait_for_idle(pin, timeout):
+    # Waits for pin to go high. Returns the seconds it took, or None if it
+    # was still low after timeout seconds.
+    return get_backend().wait_for_idle(pin, timeout)
 
 def spi_transfer(data):
-    SPI.writebytes(data)
+    get_backend().spi_write(data)
+
+def spi_transfer_bulk(data):
+    # Streams a whole buffer (bytes, bytearray or list) in as few transfers
+    # as the driver allows.
+    global spi_bytes_sent, spi_seconds
+    backend = get_backend()
+    start = backend.clock()
+    view = memoryview(bytes(data) if isinstance(data, list) else data)
+    backend.spi_write_bulk(view)
+    spi_bytes_sent += len(view)
+    spi_seconds += backend.clock() - start
 
 def epd_init():
-    GPIO.setmode(GPIO.BCM)
-    GPIO.setwarnings(False)
-    GPIO.setup(RST_PIN, GPIO.OUT)
-    GPIO.setup(DC_PIN, GPIO.OUT)
-    GPIO.setup(CS_PIN, GPIO.OUT)
-    GPIO.setup(BUSY_PIN, GPIO.IN)
-
-    SPI.max_speed_hz = 2000000
-    SPI.mode = 0b00
-    return 0;
+    return get_backend().init()
 
 ### END OF FILE ###
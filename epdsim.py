@@ -0,0 +1,291 @@
+"""Simulated 2.7 inch e-paper panel, for running without a Raspberry Pi.
+
+Select it with EPD_BACKEND=sim in the environment (or
+epdif.set_backend('sim')) and it takes the place of spidev and RPi.GPIO.
+It records every SPI transfer and GPIO write, decodes the command stream
+the way the panel's controller would, and keeps the picture the panel
+would be showing, which image() returns. Set EPD_SIM_IMAGE to a file
+name to have it saved as a PNG after every refresh.
+
+BUSY is modelled as well: POWER_ON, POWER_OFF and refreshes keep it low
+for as long as the real panel would. Refreshes take as long as the
+waveform in the uploaded LUTs at the frame rate set with PLL_CONTROL,
+5 s with the LUTs in epd2in7. Time is simulated: delays and SPI transfers
+(at epdif.SPI_SPEED_HZ) move the clock forward instead of sleeping, so a
+frame costs only the host's CPU time while clock() says how long the
+panel would have needed.
+"""
+
+
+import os
+from PIL import Image
+import epd2in7
+import epdif
+
+
+# Save the screen to this PNG after every refresh, if set.
+IMAGE_PATH = os.environ.get('EPD_SIM_IMAGE')
+
+# Estimates, the datasheet only gives upper limits for these.
+POWER_ON_SECONDS = 0.08
+POWER_OFF_SECONDS = 0.02
+# Refresh time used until LUTs have been uploaded (the panel's OTP ones).
+DEFAULT_REFRESH_SECONDS = 6.0
+
+# PLL_CONTROL value -> frame rate in Hz; 0x3C is the power-on default.
+FRAME_RATES = {0x29: 150, 0x31: 171, 0x39: 200, 0x3A: 100, 0x3C: 50}
+LUT_REGISTERS = (epd2in7.LUT_WHITE_TO_WHITE, epd2in7.LUT_BLACK_TO_WHITE,
+                 epd2in7.LUT_WHITE_TO_BLACK, epd2in7.LUT_BLACK_TO_BLACK)
+# Partial transfers and refreshes start with an 8 byte x, y, w, l header.
+WINDOW_HEADER = 8
+WINDOW_COMMANDS = (epd2in7.PARTIAL_DATA_START_TRANSMISSION_1,
+                   epd2in7.PARTIAL_DATA_START_TRANSMISSION_2,
+                   epd2in7.PARTIAL_DISPLAY_REFRESH)
+
+
+def waveform_seconds(luts, frame_rate):
+    """How long a refresh with luts takes, or None if there are none.
+
+    Each LUT is a list of 6 byte phases: voltage levels, four frame
+    counts and a repeat count. The pixel LUTs run in parallel, so the
+    longest one sets the refresh time.
+    """
+    frames = [sum(sum(lut[i + 1:i + 5]) * lut[i + 5]
+                  for i in range(0, len(lut) - 5, 6))
+              for lut in luts]
+    if not frames:
+        return None
+    return max(frames) / frame_rate
+
+
+class SimulatedPanel:
+    """Stands in for the panel and its SPI/GPIO connection.
+
+    Has the same methods as epdif.SpidevBackend. With record=False the
+    transfers and GPIO writes are only counted, not kept, for long runs.
+    """
+
+    def __init__(self, width=epd2in7.EPD_WIDTH, height=epd2in7.EPD_HEIGHT,
+                 record=True, image_path=IMAGE_PATH):
+        self.width = width
+        self.height = height
+        self.record = record
+        self.image_path = image_path
+        # The controller's RAM rows are whole bytes, so windows can reach
+        # past the last pixel of a row to the end of its byte.
+        self.ram_width = epd2in7.row_bytes(width) * 8
+        self.frame_bytes = epd2in7.row_bytes(width) * height
+        # What the panel shows. E-paper keeps its picture through resets
+        # and sleep, so this is only ever changed by a refresh.
+        self.screen = bytearray(b'\xFF' * self.frame_bytes)
+        self.pins = {}
+        self.now = 0.0
+        self.busy_until = 0.0
+        self.busy_seconds = 0.0
+        self.transfers = []
+        self.gpio_writes = []
+        self.bytes_received = 0
+        self.commands = 0
+        self.refreshes = {'full': 0, 'partial': 0}
+        self.errors = []
+        self._power_cycle()
+
+    def _power_cycle(self):
+        # State the controller loses in a hardware reset or deep sleep
+        self.registers = {}
+        self.old_ram = bytearray(b'\xFF' * self.frame_bytes)
+        self.new_ram = bytearray(b'\xFF' * self.frame_bytes)
+        self.powered = False
+        self.asleep = False
+        self.command = None
+        self.data = bytearray()
+        self.ram = None
+        self.window = None
+        self.written = 0
+
+    # Backend interface, see epdif.SpidevBackend
+
+    def init(self):
+        return 0
+
+    def digital_write(self, pin, value):
+        if self.record:
+            self.gpio_writes.append((self.now, pin, value))
+        if (pin == epdif.RST_PIN and value == epdif.HIGH
+                and self.pins.get(pin) == epdif.LOW):
+            self._power_cycle()
+        self.pins[pin] = value
+
+    def digital_read(self, pin):
+        if pin == epdif.BUSY_PIN:
+            # 0: busy, 1: idle
+            return epdif.LOW if self.now < self.busy_until else epdif.HIGH
+        return self.pins.get(pin, epdif.LOW)
+
+    def delay_ms(self, delaytime):
+        self.now += delaytime / 1000.0
+
+    def clock(self):
+        return self.now
+
+    def wait_for_idle(self, pin, timeout):
+        # Jumps the clock to the end of the busy period, like an edge
+        # interrupt would wake the driver, and returns the simulated wait.
+        if self.digital_read(pin) == epdif.HIGH:
+            return 0.0
+        wait = self.busy_until - self.now
+        if wait > timeout:
+            self.now += timeout
+            return None
+        self.now = self.busy_until
+        return wait
+
+    def spi_write(self, data):
+        self.spi_write_bulk(memoryview(bytes(data)))
+
+    def spi_write_bulk(self, view):
+        dc = self.pins.get(epdif.DC_PIN, epdif.LOW)
+        if self.record:
+            self.transfers.append((dc, bytes(view)))
+        self.bytes_received += len(view)
+        self.now += len(view) * 8 / epdif.SPI_SPEED_HZ
+        if self.asleep:
+            self.errors.append('SPI transfer while in deep sleep')
+            return
+        if dc == epdif.LOW:
+            for command in view:
+                self._command(command)
+        else:
+            self._data(view)
+
+    # Controller
+
+    def image(self):
+        """The picture on the panel, as a mode '1' image."""
+        return Image.frombytes('1', (self.width, self.height),
+                               bytes(self.screen))
+
+    def save_image(self, path):
+        self.image().save(path)
+
+    def frame_rate(self):
+        pll = self.registers.get(epd2in7.PLL_CONTROL, b'\x3C')
+        return FRAME_RATES.get(pll[0], 50)
+
+    def refresh_seconds(self):
+        luts = [self.registers[register] for register in LUT_REGISTERS
+                if register in self.registers]
+        seconds = waveform_seconds(luts, self.frame_rate())
+        return DEFAULT_REFRESH_SECONDS if seconds is None else seconds
+
+    def _busy(self, seconds):
+        if self.now < self.busy_until:
+            self.errors.append('command 0x{:02X} sent while busy'.format(
+                self.command))
+        self.busy_until = self.now + seconds
+        self.busy_seconds += seconds
+
+    def _command(self, command):
+        self._end_command()
+        self.commands += 1
+        self.command = command
+        self.data = bytearray()
+        self.ram = None
+        if command == epd2in7.DATA_START_TRANSMISSION_1:
+            self._start_window(self.old_ram, (0, 0, self.ram_width, self.height))
+        elif command == epd2in7.DATA_START_TRANSMISSION_2:
+            self._start_window(self.new_ram, (0, 0, self.ram_width, self.height))
+        elif command == epd2in7.DISPLAY_REFRESH:
+            self._refresh((0, 0, self.ram_width, self.height), 'full')
+        elif command == epd2in7.POWER_ON:
+            self.powered = True
+            self._busy(POWER_ON_SECONDS)
+        elif command == epd2in7.POWER_OFF:
+            self.powered = False
+            self._busy(POWER_OFF_SECONDS)
+
+    def _end_command(self):
+        # Commands with parameters take effect once the next one starts
+        if self.command is None or self.ram is not None:
+            return
+        if self.command not in WINDOW_COMMANDS:
+            self.registers[self.command] = bytes(self.data)
+
+    def _data(self, view):
+        if self.command is None:
+            self.errors.append('data sent before any command')
+            return
+        if self.ram is not None:
+            self._write_window(view)
+            return
+        if self.command in WINDOW_COMMANDS:
+            needed = WINDOW_HEADER - len(self.data)
+            self.data += view[:needed]
+            view = view[needed:]
+            if len(self.data) == WINDOW_HEADER:
+                window = self._parse_window(self.data)
+                if self.command == epd2in7.PARTIAL_DISPLAY_REFRESH:
+                    self._refresh(window, 'partial')
+                else:
+                    ram = (self.old_ram if self.command ==
+                           epd2in7.PARTIAL_DATA_START_TRANSMISSION_1
+                           else self.new_ram)
+                    self._start_window(ram, window)
+                    self._write_window(view)
+            return
+        self.data += view
+        # The check code puts the controller to sleep straight away
+        if self.command == epd2in7.DEEP_SLEEP and self.data == b'\xA5':
+            self.asleep = True
+            self.powered = False
+
+    def _parse_window(self, header):
+        x = (header[0] << 8 | header[1]) & ~7
+        y = header[2] << 8 | header[3]
+        w = (header[4] << 8 | header[5]) & ~7
+        l = header[6] << 8 | header[7]
+        if x + w > self.ram_width or y + l > self.height:
+            self.errors.append('window {} outside the panel'.format(
+                (x, y, w, l)))
+            w = min(w, self.ram_width - x)
+            l = min(l, self.height - y)
+        return x, y, w, l
+
+    def _start_window(self, ram, window):
+        self.ram = ram
+        self.window = window
+        self.written = 0
+
+    def _write_window(self, view):
+        # Copies data into the RAM window, one row of the window at a time
+        x, y, w, l = self.window
+        row_bytes = w // 8
+        stride = epd2in7.row_bytes(self.width)
+        size = row_bytes * l
+        if self.written + len(view) > size:
+            self.errors.append('{} bytes more than the window holds'.format(
+                self.written + len(view) - size))
+            view = view[:max(size - self.written, 0)]
+        offset = 0
+        while offset < len(view):
+            row, column = divmod(self.written, row_bytes)
+            count = min(row_bytes - column, len(view) - offset)
+            start = (y + row) * stride + x // 8 + column
+            self.ram[start:start + count] = view[offset:offset + count]
+            offset += count
+            self.written += count
+
+    def _refresh(self, window, kind):
+        if not self.powered:
+            self.errors.append('refresh while the panel is powered off')
+            return
+        x, y, w, l = window
+        stride = epd2in7.row_bytes(self.width)
+        for row in range(y, y + l):
+            start = row * stride + x // 8
+            self.screen[start:start + w // 8] = (
+                self.new_ram[start:start + w // 8])
+        self.refreshes[kind] += 1
+        self._busy(self.refresh_seconds())
+        if self.image_path:
+            self.save_image(self.image_path)
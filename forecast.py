@@ -0,0 +1,167 @@
+"""Compact forecast model and a streaming reader for api.met.no JSON.
+
+The locationforecast document has around 90 timeseries entries with a
+couple of dozen values each, but the display only uses a handful of
+values from the first few hours. read() decodes the document a chunk
+at a time, keeps just those values from the first entries in small
+__slots__ objects and stops as soon as it has them, so the full
+document never has to be in memory as a string or a tree of dicts.
+"""
+
+
+import calendar
+import codecs
+import json
+import re
+import time
+
+
+# Timeseries entries the layout needs by default: the rain chart covers 12
+# hours. renderer.FORECAST_STEPS is what the configured layout needs.
+DEFAULT_STEPS = 12
+
+# ForecastStep attribute -> where it sits in a timeseries entry's "data"
+FIELDS = {
+    'airTemperature': ('instant', 'details', 'air_temperature'),
+    'windSpeed': ('instant', 'details', 'wind_speed'),
+    'windSpeedOfGust': ('instant', 'details', 'wind_speed_of_gust'),
+    'symbol1h': ('next_1_hours', 'summary', 'symbol_code'),
+    'precipitation1h': ('next_1_hours', 'details', 'precipitation_amount'),
+    'precipitationMax1h': ('next_1_hours', 'details',
+                           'precipitation_amount_max'),
+    'precipitationProbability1h': ('next_1_hours', 'details',
+                                   'probability_of_precipitation'),
+    'symbol6h': ('next_6_hours', 'summary', 'symbol_code'),
+    'precipitation6h': ('next_6_hours', 'details', 'precipitation_amount'),
+    'precipitationMax6h': ('next_6_hours', 'details',
+                           'precipitation_amount_max'),
+    'airTemperatureMax6h': ('next_6_hours', 'details',
+                            'air_temperature_max'),
+    'symbol12h': ('next_12_hours', 'summary', 'symbol_code'),
+}
+
+# FIELDS only in the 'complete' locationforecast product. The 'compact'
+# one has the rest and is a fraction of the size.
+COMPLETE_ONLY = frozenset((
+    'windSpeedOfGust', 'precipitationMax1h', 'precipitationProbability1h',
+    'airTemperatureMax6h', 'precipitationMax6h'))
+
+_TIMESERIES = re.compile(r'"timeseries"\s*:\s*\[')
+_UPDATED_AT = re.compile(r'"updated_at"\s*:\s*"([^"]*)"')
+_SEPARATOR = re.compile(r'[\s,]*')
+# Give up looking for the timeseries after this much text
+_MAX_HEADER = 1 << 20
+
+
+def parseTime(value):
+    """Returns an api.met.no timestamp (2020-06-01T12:00:00Z) as unix time."""
+    return calendar.timegm(time.strptime(value, '%Y-%m-%dT%H:%M:%SZ'))
+
+
+def product(fields):
+    """The smallest locationforecast product with all of fields."""
+    unknown = set(fields) - set(FIELDS)
+    if unknown:
+        raise ValueError('Unknown forecast fields: {}'.format(
+            ', '.join(sorted(unknown))))
+    return 'complete' if COMPLETE_ONLY.intersection(fields) else 'compact'
+
+
+class ForecastStep:
+    """The values the display uses from one timeseries entry.
+
+    Values missing from the entry (e.g. next_1_hours towards the end of
+    the forecast) are None.
+    """
+
+    __slots__ = ('time',) + tuple(FIELDS)
+
+    @classmethod
+    def fromTimeseries(cls, entry):
+        step = cls()
+        step.time = parseTime(entry['time'])
+        data = entry['data']
+        for name, (block, group, key) in FIELDS.items():
+            setattr(step, name, data.get(block, {}).get(group, {}).get(key))
+        return step
+
+
+class Forecast:
+    __slots__ = ('updatedAt', 'steps')
+
+    def __init__(self, updatedAt, steps):
+        self.updatedAt = updatedAt
+        self.steps = steps
+
+
+class _Reader:
+    """Incrementally decoded text of a binary stream."""
+
+    def __init__(self, stream, chunkSize):
+        self.stream = stream
+        self.chunkSize = chunkSize
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = ''
+        self.eof = False
+
+    def fill(self):
+        """Reads another chunk into the buffer, False at end of stream."""
+        if self.eof:
+            return False
+        chunk = self.stream.read(self.chunkSize)
+        self.eof = not chunk
+        self.buffer += self.decoder.decode(chunk, final=self.eof)
+        return not self.eof
+
+
+def read(stream, maxSteps=DEFAULT_STEPS, chunkSize=16384):
+    """Reads a Forecast from a locationforecast document in stream.
+
+    stream is a binary file object, e.g. an HTTP response or a cached
+    copy on disk. Only the first maxSteps timeseries entries are decoded.
+    """
+    reader = _Reader(stream, chunkSize)
+    while True:
+        match = _TIMESERIES.search(reader.buffer)
+        if match:
+            break
+        if len(reader.buffer) > _MAX_HEADER or not reader.fill():
+            raise ValueError('No timeseries in forecast')
+    updatedAt = _UPDATED_AT.search(reader.buffer, 0, match.start())
+    if updatedAt:
+        updatedAt = updatedAt.group(1)
+    reader.buffer = reader.buffer[match.end():]
+
+    decoder = json.JSONDecoder()
+    steps = []
+    position = 0
+    while len(steps) < maxSteps:
+        position = _SEPARATOR.match(reader.buffer, position).end()
+        if position == len(reader.buffer):
+            if not reader.fill():
+                raise ValueError('Forecast ends in the middle of timeseries')
+            continue
+        if reader.buffer[position] == ']':
+            break
+        try:
+            entry, end = decoder.raw_decode(reader.buffer, position)
+        except json.JSONDecodeError:
+            # Most likely the entry continues in the next chunk
+            if not reader.fill():
+                raise
+            continue
+        steps.append(ForecastStep.fromTimeseries(entry))
+        reader.buffer = reader.buffer[end:]
+        position = 0
+
+    # updated_at normally comes first, but JSON doesn't promise that.
+    while updatedAt is None:
+        match = _UPDATED_AT.search(reader.buffer)
+        if match:
+            updatedAt = match.group(1)
+        elif reader.eof:
+            break
+        else:
+            reader.buffer = reader.buffer[-64:]
+            reader.fill()
+    return Forecast(updatedAt, steps)
@@ -0,0 +1,267 @@
+"""Forecast history in a compact, append-only file.
+
+Every forecast the display downloads is appended as fixed-size binary
+records, one per timeseries step: when the forecast was issued, the time
+it is for, and the values the display uses. A record is 36 bytes, so a
+month of forecasts (about 48 a day of 12 steps) takes well under a MB.
+
+Records are appended in the order forecasts were issued, so a range of
+them is found by binary search on the memory-mapped file and only the
+records in it are decoded. That makes trends and forecast-vs-observed
+comparisons cheap without keeping anything in memory or asking the API
+again.
+
+    store = History('cache/history.bin')
+    store.append(forecast)
+    for record in store.validBetween(now - 86400, now):
+        ...
+
+Weather symbols are stored as small numbers; the codes they stand for
+are kept one per line in a second file next to it (history.bin.symbols).
+"""
+
+
+import math
+import mmap
+import os
+import struct
+import time
+import forecast
+
+
+MAGIC = b'WDHIST01'
+# Magic and record size, then records from HEADER_SIZE on.
+_HEADER = struct.Struct('<8sI4x')
+HEADER_SIZE = _HEADER.size
+# ForecastStep attribute -> stored as a float32, NaN for None
+VALUES = ('airTemperature', 'precipitation1h', 'precipitationMax1h',
+          'precipitationProbability1h', 'windSpeed', 'windSpeedOfGust')
+# issued, time, VALUES, symbol1h id (0 for None)
+_RECORD = struct.Struct('<II' + 'f' * len(VALUES) + 'H2x')
+RECORD_SIZE = _RECORD.size
+# Just the issued and time fields at the start of a record
+_TIME = struct.Struct('<II')
+# How far ahead forecasts reach, which bounds the search in validBetween.
+MAX_LEAD = 10 * 86400
+
+
+class HistoryRecord:
+    """One timeseries step of one forecast.
+
+    issued is when the forecast was made, time the hour it is for, both
+    unix times. The other attributes are the ForecastStep ones in VALUES
+    and symbol1h, None where the forecast had no value.
+    """
+
+    __slots__ = ('issued', 'time', 'symbol1h') + VALUES
+
+    @property
+    def lead(self):
+        """Seconds between issuing the forecast and the time it is for."""
+        return self.time - self.issued
+
+
+class History:
+    """An append-only store of HistoryRecords in one file.
+
+    Meant for a single writer. Readers in other processes see whatever
+    was appended before they last read.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.symbolsPath = path + '.symbols'
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._file = open(path, 'a+b')
+        size = os.fstat(self._file.fileno()).st_size
+        if size == 0:
+            self._file.write(_HEADER.pack(MAGIC, RECORD_SIZE))
+            self._file.flush()
+        else:
+            self._file.seek(0)
+            magic, recordSize = _HEADER.unpack(self._file.read(HEADER_SIZE))
+            if magic != MAGIC or recordSize != RECORD_SIZE:
+                raise ValueError('{} is not a forecast history file'.format(
+                    path))
+            # Drop a record cut short by a crash halfway through an append
+            whole = size - (size - HEADER_SIZE) % RECORD_SIZE
+            if whole != size:
+                self._file.truncate(whole)
+        self._map = None
+        self._symbols = []
+        self._symbolIds = {}
+        try:
+            with open(self.symbolsPath) as f:
+                for code in f.read().split():
+                    self._addSymbol(code)
+        except FileNotFoundError:
+            pass
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _addSymbol(self, code):
+        self._symbols.append(code)
+        self._symbolIds[code] = len(self._symbols)
+
+    def _symbolId(self, code):
+        if code is None:
+            return 0
+        if code not in self._symbolIds:
+            with open(self.symbolsPath, 'a') as f:
+                f.write(code + '\n')
+            self._addSymbol(code)
+        return self._symbolIds[code]
+
+    def __len__(self):
+        size = os.fstat(self._file.fileno()).st_size
+        return (size - HEADER_SIZE) // RECORD_SIZE
+
+    def firstIssued(self):
+        """When the oldest forecast in the store was issued, or None."""
+        if len(self) == 0:
+            return None
+        return self._issued(self._view(), 0)
+
+    def lastIssued(self):
+        """When the newest forecast in the store was issued, or None."""
+        count = len(self)
+        if count == 0:
+            return None
+        return self._issued(self._view(), count - 1)
+
+    def append(self, data, issued=None):
+        """Appends the steps of a forecast.Forecast.
+
+        issued defaults to the forecast's updated_at, or now if it has
+        none. Does nothing if that forecast is already the newest one
+        stored, so it is safe to call with every forecast fetched.
+        """
+        if issued is None:
+            issued = (forecast.parseTime(data.updatedAt) if data.updatedAt
+                      else int(time.time()))
+        last = self.lastIssued()
+        if last is not None and issued <= last:
+            return 0
+        records = bytearray()
+        for step in data.steps:
+            values = [math.nan if getattr(step, name) is None
+                      else getattr(step, name) for name in VALUES]
+            records += _RECORD.pack(issued, step.time, *values,
+                                    self._symbolId(step.symbol1h))
+        self._file.seek(0, os.SEEK_END)
+        self._file.write(records)
+        self._file.flush()
+        return len(data.steps)
+
+    def _view(self):
+        # Maps the file again when it has grown since it was last mapped
+        size = os.fstat(self._file.fileno()).st_size
+        if self._map is None or len(self._map) != size:
+            if self._map is not None:
+                self._map.close()
+            self._map = mmap.mmap(self._file.fileno(), size,
+                                  access=mmap.ACCESS_READ)
+        return self._map
+
+    def _issued(self, view, index):
+        return _TIME.unpack_from(view, HEADER_SIZE + index * RECORD_SIZE)[0]
+
+    def _record(self, view, index):
+        fields = _RECORD.unpack_from(view, HEADER_SIZE + index * RECORD_SIZE)
+        record = HistoryRecord()
+        record.issued, record.time = fields[:2]
+        for name, value in zip(VALUES, fields[2:-1]):
+            # float32 turns 4.6 into 4.599999904632568; MET sends 1 decimal
+            setattr(record, name,
+                    None if math.isnan(value) else round(value, 3))
+        symbol = fields[-1]
+        record.symbol1h = self._symbols[symbol - 1] if symbol else None
+        return record
+
+    def _search(self, view, issued):
+        """Index of the first record issued at or after issued."""
+        low, high = 0, (len(view) - HEADER_SIZE) // RECORD_SIZE
+        while low < high:
+            middle = (low + high) // 2
+            if self._issued(view, middle) < issued:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def issuedBetween(self, start, end):
+        """Records of forecasts issued from start up to end, oldest first."""
+        view = self._view()
+        return [self._record(view, index) for index in range(
+            self._search(view, start), self._search(view, end))]
+
+    def validBetween(self, start, end, maxLead=MAX_LEAD):
+        """Records for times from start up to end, in the order issued.
+
+        Gives every forecast made for each hour, so how the forecast for
+        it changed as the time came closer.
+        """
+        view = self._view()
+        records = []
+        for index in range(self._search(view, start - maxLead),
+                           self._search(view, end)):
+            # Only decode the whole record if its time is in range
+            offset = HEADER_SIZE + index * RECORD_SIZE
+            if start <= _TIME.unpack_from(view, offset)[1] < end:
+                records.append(self._record(view, index))
+        return records
+
+    def observed(self, start, end):
+        """The shortest-lead record for each hour from start up to end.
+
+        The forecast issued closest to a time is the nearest thing to an
+        observation the API gives us.
+        """
+        nearest = {}
+        for record in self.validBetween(start, end):
+            best = nearest.get(record.time)
+            if best is None or record.lead <= best.lead:
+                nearest[record.time] = record
+        return [nearest[hour] for hour in sorted(nearest)]
+
+    def prune(self, before):
+        """Drops the forecasts issued before unix time before.
+
+        Copies the rest to a new file, so it takes time in proportion to
+        what is kept; call it now and then rather than on every append.
+        """
+        view = self._view()
+        first = self._search(view, before)
+        if first == 0:
+            return 0
+        temporary = self.path + '.tmp'
+        with open(temporary, 'wb') as f:
+            f.write(view[:HEADER_SIZE])
+            f.write(view[HEADER_SIZE + first * RECORD_SIZE:])
+        self._map.close()
+        self._map = None
+        self._file.close()
+        os.replace(temporary, self.path)
+        self._file = open(self.path, 'a+b')
+        return first
+
+    def expire(self, days, now=None):
+        """Keeps about the last days days, pruning at most once a day."""
+        now = time.time() if now is None else now
+        oldest = self.firstIssued()
+        keepFrom = now - days * 86400
+        if oldest is not None and oldest < keepFrom - 86400:
+            return self.prune(keepFrom)
+        return 0
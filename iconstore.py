@@ -0,0 +1,61 @@
+"""Icons for the weather display, loaded once and kept ready to paste.
+
+Every PNG is opened a single time at startup and converted to mode '1'
+(dithered the same way paste would do it), and the weather symbols are
+also kept pre-scaled to the small size used for the 6 and 12 hour
+forecasts. After that a frame needs no file I/O or resampling, and
+looking up a symbol is a dictionary lookup.
+"""
+
+
+import glob
+import os
+from PIL import Image
+
+
+ICON_DIR = 'icons'
+SMALL_SYMBOL_SIZE = (48, 48)
+
+
+def _loadMonochrome(path, size=None):
+    with Image.open(path) as image:
+        if size is not None:
+            image = image.resize(size)
+        return image.convert('1')
+
+
+class IconStore:
+    """All icons under icons/, in mode '1'.
+
+    symbol() looks up weather symbols by their api.met.no symbol_code,
+    e.g. 'partlycloudy_night', icon() the other icons by file name.
+    """
+
+    def __init__(self, iconDir=ICON_DIR, smallSize=SMALL_SYMBOL_SIZE):
+        self.icons = {}
+        self.symbols = {}
+        self.smallSymbols = {}
+        for path in glob.glob(os.path.join(iconDir, '*.png')):
+            name = os.path.splitext(os.path.basename(path))[0]
+            self.icons[name] = _loadMonochrome(path)
+        for path in glob.glob(os.path.join(iconDir, 'weatherIcons', '*.png')):
+            code = os.path.splitext(os.path.basename(path))[0]
+            self.symbols[code] = _loadMonochrome(path)
+            self.smallSymbols[code] = _loadMonochrome(path, smallSize)
+
+    def icon(self, name):
+        return self.icons[name]
+
+    def symbol(self, symbolCode, small=False):
+        try:
+            return (self.smallSymbols if small else self.symbols)[symbolCode]
+        except KeyError:
+            raise KeyError('No icon for weather symbol {!r}'.format(
+                symbolCode)) from None
+
+    def validate(self, symbolCodes):
+        """Raises KeyError if any of symbolCodes has no icon."""
+        missing = sorted(set(symbolCodes) - set(self.symbols))
+        if missing:
+            raise KeyError('No icons for weather symbols: {}'.format(
+                ', '.join(missing)))
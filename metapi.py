@@ -0,0 +1,504 @@
+"""Cached access to the api.met.no weather API.
+
+Responses are kept on disk together with their Last-Modified and Expires
+headers. A cached response that has not expired yet is used without
+touching the network, and once it has expired the next request is sent
+with If-Modified-Since so that an unchanged forecast costs a 304 instead
+of the whole document.
+
+When a request fails and there is a copy in the cache, that copy is
+returned (marked stale) rather than an error, so the display keeps
+showing the last good forecast, and the request is tried again after a
+jittered exponential backoff, or after the Retry-After the server asked
+for. Without a cached copy the error is raised as RetryLater.
+
+All requests go through one HttpClient, which keeps connections open
+between requests, so each display (or each of many displays in one
+daemon) does a TLS handshake once rather than on every request. It asks
+for gzip, which shrinks a forecast to around a tenth, and decompresses
+responses as they are read, so the compressed body is never held in
+memory either. Responses count the bytes they took on the wire.
+
+Set the MET_API_URL environment variable to point the display at another
+server, for example a local stub while testing.
+"""
+
+
+import contextlib
+import email.utils
+import gzip
+import hashlib
+import http.client
+import json
+import os
+import random
+import shutil
+import threading
+import time
+import urllib.error
+import urllib.parse
+import zlib
+
+
+API_URL = os.environ.get('MET_API_URL', 'https://api.met.no/weatherapi')
+# api.met.no rejects requests without an identifying User-Agent.
+USER_AGENT = 'weather_display/1.0 github.com/NeonSpork/weather_display'
+CACHE_DIR = 'cache'
+# Used when a response comes without an Expires header.
+DEFAULT_TTL = 600
+LEGEND_URL = API_URL + '/weathericon/2.0/legends'
+# Copy of the symbol legend shipped with the code, used until a newer one
+# has been downloaded.
+BUNDLED_LEGEND = 'legends.json'
+# Failed requests are retried after RETRY_BASE seconds, then twice as
+# long after every further failure, up to RETRY_LIMIT.
+RETRY_BASE = 60
+RETRY_LIMIT = 3600
+
+
+def parseHttpDate(value):
+    """Returns an HTTP date header as a unix timestamp, or None."""
+    if not value:
+        return None
+    try:
+        return email.utils.parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+def retryAfter(error):
+    """Seconds an HTTPError's Retry-After header asks for, or None."""
+    headers = getattr(error, 'headers', None)
+    value = headers.get('Retry-After') if headers is not None else None
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        when = parseHttpDate(value)
+        return None if when is None else max(when - time.time(), 0)
+
+
+class Backoff:
+    """Jittered exponential backoff.
+
+    The ceiling doubles with every failure in a row, from base up to
+    limit, and the delay is picked at random from its upper half, so
+    that displays that failed together don't all come back together.
+    """
+
+    def __init__(self, base=RETRY_BASE, limit=RETRY_LIMIT):
+        self.base = base
+        self.limit = limit
+
+    def delay(self, failures, retryAfter=None):
+        """Seconds to wait after failures failures in a row.
+
+        Never less than the server's retryAfter, if it gave one.
+        """
+        ceiling = min(self.limit, self.base * 2 ** (failures - 1))
+        delay = random.uniform(ceiling / 2, ceiling)
+        if retryAfter is not None:
+            delay = max(delay, retryAfter)
+        return delay
+
+
+class RetryLater(Exception):
+    """A request failed, and there is no cached copy to fall back on.
+
+    retryAt is the unix time it is worth trying again at, cause the
+    error the request failed with.
+    """
+
+    def __init__(self, url, retryAt, cause):
+        super().__init__('{} failed ({}), retrying in {:.0f} s'.format(
+            url, cause, max(retryAt - time.time(), 0)))
+        self.url = url
+        self.retryAt = retryAt
+        self.cause = cause
+
+
+class _CountingReader:
+    def __init__(self, stream):
+        self.stream = stream
+        self.count = 0
+
+    def read(self, size=-1):
+        # HTTPResponse.read wants None, not -1, for everything
+        data = self.stream.read(None if size is None or size < 0 else size)
+        self.count += len(data)
+        return data
+
+
+class Response:
+    """A response from HttpClient.get.
+
+    read() returns the body, decompressed on the fly if the server sent
+    it gzipped. wireBytes counts what the request and response took on
+    the connection: request and status lines, headers and the body as
+    sent, compressed or not (TLS framing not included).
+    """
+
+    def __init__(self, raw, requestBytes):
+        self.status = raw.status
+        self.reason = raw.reason
+        self.headers = raw.headers
+        self._raw = _CountingReader(raw)
+        self._headerBytes = (requestBytes + len('HTTP/1.1 000 \r\n') +
+                             len(raw.reason) + len(str(raw.headers)))
+        encoding = raw.headers.get('Content-Encoding', 'identity').lower()
+        if encoding == 'gzip':
+            self._body = gzip.GzipFile(fileobj=self._raw, mode='rb')
+        elif encoding == 'identity':
+            self._body = self._raw
+        else:
+            raise OSError('Unsupported Content-Encoding {}'.format(encoding))
+
+    @property
+    def wireBytes(self):
+        return self._headerBytes + self._raw.count
+
+    def read(self, size=-1):
+        try:
+            return self._body.read(size)
+        except (EOFError, zlib.error) as e:
+            # Truncated or corrupt gzip; OSError like any other bad read
+            raise OSError('Bad gzip response body: {}'.format(e)) from e
+
+
+class HttpClient:
+    """GET requests over kept-alive connections, safe to share by threads.
+
+    Idle connections are pooled per host and reused by the next request
+    to the same host; a connection the server has closed in the meantime
+    is replaced transparently.
+    """
+
+    def __init__(self, timeout=30, maxIdle=4):
+        self.timeout = timeout
+        self.maxIdle = maxIdle
+        self.connectionsOpened = 0
+        self.requests = 0
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def _connect(self, scheme, host, port):
+        with self._lock:
+            idle = self._idle.get((scheme, host, port))
+            if idle:
+                return idle.pop(), True
+            self.connectionsOpened += 1
+        if scheme == 'https':
+            return http.client.HTTPSConnection(
+                host, port, timeout=self.timeout), False
+        return http.client.HTTPConnection(
+            host, port, timeout=self.timeout), False
+
+    def _release(self, key, connection):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.maxIdle:
+                idle.append(connection)
+                return
+        connection.close()
+
+    @contextlib.contextmanager
+    def get(self, url, headers=None):
+        """Sends a GET request, yields a Response.
+
+        Asks for gzip unless headers say otherwise. Responses other than
+        2xx and 304 raise urllib.error.HTTPError, like urlopen does.
+        """
+        parts = urllib.parse.urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        requestHeaders = {'Accept-Encoding': 'gzip'}
+        requestHeaders.update(headers or {})
+        requestBytes = (len('GET  HTTP/1.1\r\nHost: \r\n\r\n') + len(path) +
+                        len(parts.netloc) + sum(
+                            len(name) + len(value) + 4
+                            for name, value in requestHeaders.items()))
+        while True:
+            connection, reused = self._connect(*key)
+            try:
+                connection.request('GET', path, headers=requestHeaders)
+                raw = connection.getresponse()
+                break
+            except (http.client.HTTPException, OSError):
+                connection.close()
+                # The server may have closed a connection that sat idle;
+                # a fresh one either works or raises for real.
+                if not reused:
+                    raise
+        with self._lock:
+            self.requests += 1
+        try:
+            if raw.status >= 300 and raw.status != 304:
+                raise urllib.error.HTTPError(url, raw.status, raw.reason,
+                                             raw.headers, None)
+            response = Response(raw, requestBytes)
+            yield response
+            # Whatever the caller didn't read has to go before the
+            # connection can carry another request.
+            response.read()
+        except BaseException:
+            connection.close()
+            raise
+        if raw.will_close:
+            connection.close()
+        else:
+            self._release(key, connection)
+
+
+# Shared by every ResponseCache that isn't given a client of its own
+CLIENT = HttpClient()
+
+
+class CachedResponse:
+    """A response body stored in the cache.
+
+    modified is False when the body is the same one returned last time,
+    so whatever was parsed from it then is still good. status says how
+    the request went: 'cached' (fresh copy, no request made),
+    'not_modified' (304), 'downloaded', or 'stale' (the request failed
+    or is backing off, error says why, and this is the last good copy).
+    downloaded is how many bytes of body came over the network once
+    decompressed, wireBytes what the request took on the wire.
+    """
+
+    def __init__(self, path, modified, expires, lastModified,
+                 status='cached', downloaded=0, error=None, wireBytes=0):
+        self.path = path
+        self.modified = modified
+        self.expires = expires
+        self.lastModified = lastModified
+        self.status = status
+        self.downloaded = downloaded
+        self.error = error
+        self.wireBytes = wireBytes
+
+    @property
+    def stale(self):
+        return self.status == 'stale'
+
+    def open(self):
+        return open(self.path, 'rb')
+
+    def read(self):
+        with self.open() as f:
+            return f.read()
+
+
+class ResponseCache:
+    """On-disk cache of GET responses, keyed by URL.
+
+    Safe to share between threads. Requests for the same URL are made
+    one at a time, so when several displays ask for the same forecast at
+    once only the first one goes to the network and the others get its
+    fresh copy.
+    """
+
+    def __init__(self, directory=CACHE_DIR, client=None, backoff=None):
+        self.directory = directory
+        self.client = CLIENT if client is None else client
+        self.backoff = Backoff() if backoff is None else backoff
+        # url -> (failures in a row, retry at, last error)
+        self._failures = {}
+        self._urlLocks = {}
+        self._lock = threading.Lock()
+
+    def _paths(self, url):
+        key = hashlib.sha1(url.encode()).hexdigest()[:16]
+        base = os.path.join(self.directory, key)
+        return base + '.body', base + '.meta'
+
+    def _loadMeta(self, url):
+        bodyPath, metaPath = self._paths(url)
+        try:
+            with open(metaPath) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if meta.get('url') != url or not os.path.exists(bodyPath):
+            return None
+        return meta
+
+    def _saveMeta(self, url, meta):
+        metaPath = self._paths(url)[1]
+        with open(metaPath + '.tmp', 'w') as f:
+            json.dump(meta, f)
+        os.replace(metaPath + '.tmp', metaPath)
+
+    def cached(self, url):
+        """Returns the cached response for url, expired or not, or None."""
+        meta = self._loadMeta(url)
+        if meta is None:
+            return None
+        return CachedResponse(self._paths(url)[0], False, meta['expires'],
+                              meta['last_modified'])
+
+    def fetch(self, url, headers=None):
+        """Returns a CachedResponse for url.
+
+        Only goes to the network when there is no cached copy or it has
+        expired, and then only downloads the body if it has changed. If
+        that fails, or the last attempt failed and it is too soon to try
+        again, returns the cached copy marked stale, expiring when it is
+        worth trying again. Raises RetryLater if there is no copy.
+        """
+        with self._lock:
+            urlLock = self._urlLocks.setdefault(url, threading.Lock())
+        with urlLock:
+            meta = self._loadMeta(url)
+            failures, retryAt, error = self._failures.get(
+                url, (0, 0, None))
+            if (meta is None or meta['expires'] <= time.time()) and (
+                    time.time() < retryAt):
+                return self._stale(url, meta, retryAt, error)
+            try:
+                response = self._fetch(url, headers, meta)
+            except (OSError, http.client.HTTPException) as e:
+                failures += 1
+                retryAt = time.time() + self.backoff.delay(
+                    failures, retryAfter(e))
+                self._failures[url] = (failures, retryAt, e)
+                return self._stale(url, meta, retryAt, e)
+            self._failures.pop(url, None)
+            return response
+
+    def _stale(self, url, meta, retryAt, error):
+        if meta is None:
+            raise RetryLater(url, retryAt, error) from error
+        return CachedResponse(self._paths(url)[0], False, retryAt,
+                              meta['last_modified'], 'stale', error=error)
+
+    def _fetch(self, url, headers, meta):
+        os.makedirs(self.directory, exist_ok=True)
+        bodyPath = self._paths(url)[0]
+        now = time.time()
+        if meta is not None and meta['expires'] > now:
+            return CachedResponse(bodyPath, False, meta['expires'],
+                                  meta['last_modified'])
+
+        requestHeaders = {'User-Agent': USER_AGENT}
+        requestHeaders.update(headers or {})
+        if meta is not None and meta['last_modified']:
+            requestHeaders['If-Modified-Since'] = meta['last_modified']
+        with self.client.get(url, requestHeaders) as response:
+            responseHeaders = response.headers
+            modified = response.status != 304
+            downloaded = 0
+            if modified:
+                with open(bodyPath + '.tmp', 'wb') as f:
+                    shutil.copyfileobj(response, f)
+                    downloaded = f.tell()
+                os.replace(bodyPath + '.tmp', bodyPath)
+            elif meta is None:
+                raise urllib.error.HTTPError(
+                    url, 304, 'Not Modified without a cached copy',
+                    responseHeaders, None)
+        wireBytes = response.wireBytes
+
+        expires = parseHttpDate(responseHeaders.get('Expires'))
+        if expires is None:
+            expires = now + DEFAULT_TTL
+        lastModified = responseHeaders.get('Last-Modified')
+        if not modified and not lastModified:
+            lastModified = meta['last_modified']
+        self._saveMeta(url, {
+            'url': url,
+            'expires': expires,
+            'last_modified': lastModified,
+        })
+        return CachedResponse(bodyPath, modified, expires, lastModified,
+                              'downloaded' if modified else 'not_modified',
+                              downloaded, wireBytes=wireBytes)
+
+
+class Legend:
+    """Descriptions of the weather symbols, like 'Light rain showers'.
+
+    Loaded on first use from the cached copy of the legend, or from the
+    bundled one when nothing has been downloaded yet. New versions are
+    fetched in a background thread once the cached one expires, so the
+    legend never holds up startup or a frame. Cached copies are keyed by
+    URL, which carries the version of the legend API.
+    """
+
+    def __init__(self, cache, url=LEGEND_URL, bundled=BUNDLED_LEGEND):
+        self.cache = cache
+        self.url = url
+        self.bundled = bundled
+        self._legend = None
+        self._nextRefresh = 0
+        self._refreshThread = None
+
+    @classmethod
+    def fromFile(cls, path):
+        """A legend read from path and never refreshed, e.g. a recorded
+        one replayed."""
+        legend = cls(None, None, path)
+        with open(path) as f:
+            legend._legend = json.load(f)
+        legend._nextRefresh = float('inf')
+        return legend
+
+    def _load(self):
+        response = self.cache.cached(self.url)
+        if response is not None:
+            try:
+                with response.open() as f:
+                    return json.load(f)
+            except (OSError, ValueError):
+                pass
+        with open(self.bundled) as f:
+            return json.load(f)
+
+    def refresh(self):
+        """Downloads the legend if the cached copy has expired."""
+        try:
+            response = self.cache.fetch(self.url)
+            if response.modified or self._legend is None:
+                with response.open() as f:
+                    self._legend = json.load(f)
+            self._nextRefresh = response.expires
+        except Exception as e:
+            self._nextRefresh = time.time() + DEFAULT_TTL
+            print('Could not refresh the weather symbol legend: {}'.format(e))
+
+    def _refreshInBackground(self):
+        if self._refreshThread is not None and self._refreshThread.is_alive():
+            return
+        self._refreshThread = threading.Thread(target=self.refresh,
+                                               daemon=True)
+        self._refreshThread.start()
+
+    def symbolCodes(self):
+        """All symbol codes in the legend, with their variants."""
+        if self._legend is None:
+            self._legend = self._load()
+        codes = []
+        for name, symbol in self._legend.items():
+            if symbol.get('variants'):
+                codes.extend('{}_{}'.format(name, variant)
+                             for variant in symbol['variants'])
+            else:
+                codes.append(name)
+        return codes
+
+    def description(self, symbolCode):
+        """English description of a symbol code such as 'fair_day'."""
+        if self._legend is None:
+            self._legend = self._load()
+        if time.time() >= self._nextRefresh:
+            self._refreshInBackground()
+        # Variants (_day, _night, _polartwilight) share one description.
+        return self._legend[symbolCode.split('_')[0]]['desc_en']
+
+
+def forecastUrl(latitude, longitude, product='complete'):
+    # api.met.no asks for at most 4 decimals, more just defeats its caching.
+    return '{}/locationforecast/2.0/{}?lat={:.4f}&lon={:.4f}'.format(
+        API_URL, product, latitude, longitude)
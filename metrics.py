@@ -0,0 +1,211 @@
+"""Timings and counters in the Prometheus text format.
+
+A small stand-in for prometheus_client, which isn't on a stock Raspberry
+Pi OS: counters, gauges and histograms with labels, kept in a Registry
+that can be written to a file for node_exporter's textfile collector or
+served over HTTP for Prometheus to scrape directly.
+
+    stageSeconds = REGISTRY.histogram('stage_seconds', 'Time per stage',
+                                      ('stage',))
+    with stageSeconds.time(stage='fetch'):
+        ...
+"""
+
+
+import bisect
+import contextlib
+import http.server
+import os
+import threading
+import time
+
+
+# Seconds, from a millisecond of drawing to a slow download or refresh.
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1, 2.5, 5, 10, 30)
+
+
+def _formatLabels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', r'\\')
+                         .replace('"', r'\"').replace('\n', r'\n'))
+        for name, value in pairs) + '}'
+
+
+def _formatValue(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help, labelNames=()):
+        self.name = name
+        self.help = help
+        self.labelNames = tuple(labelNames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelNames):
+            raise ValueError('{} takes labels {}, got {}'.format(
+                self.name, self.labelNames, tuple(labels)))
+        return tuple(labels[name] for name in self.labelNames)
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help),
+                 '# TYPE {} {}'.format(self.name, self.kind)]
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            lines.extend(self._renderValue(key, value))
+        return lines
+
+    def _renderValue(self, key, value):
+        return ['{}{} {}'.format(self.name,
+                                 _formatLabels(self.labelNames, key),
+                                 _formatValue(value))]
+
+
+class Counter(_Metric):
+    """A total that only goes up, e.g. bytes downloaded."""
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+
+class Gauge(_Metric):
+    """A value that is set, e.g. the time of the last update."""
+
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    """Observed values, counted in cumulative buckets."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelNames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelNames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(
+                key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """Observes how long the with block took, in seconds."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _renderValue(self, key, value):
+        counts, total = value
+        labels = _formatLabels(self.labelNames, key)
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            lines.append('{}_bucket{} {}'.format(
+                self.name,
+                _formatLabels(self.labelNames, key,
+                              [('le', _formatValue(bound))]),
+                cumulative))
+        lines.append('{}_sum{} {}'.format(self.name, labels,
+                                          _formatValue(total)))
+        lines.append('{}_count{} {}'.format(self.name, labels, cumulative))
+        return lines
+
+
+class Registry:
+    """A set of metrics, exported together."""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _add(self, cls, name, *args, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, *args, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError('{} is already a {}'.format(
+                    name, metric.kind))
+            return metric
+
+    def counter(self, name, help, labelNames=()):
+        return self._add(Counter, name, help, labelNames)
+
+    def gauge(self, name, help, labelNames=()):
+        return self._add(Gauge, name, help, labelNames)
+
+    def histogram(self, name, help, labelNames=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram, name, help, labelNames, buckets)
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    def writeTextfile(self, path):
+        """Writes the metrics for node_exporter's textfile collector.
+
+        The file is replaced atomically, so the collector never reads a
+        half-written one.
+        """
+        with open(path + '.tmp', 'w') as f:
+            f.write(self.render())
+        os.replace(path + '.tmp', path)
+
+    def serve(self, port, address=''):
+        """Serves the metrics over HTTP from a background thread."""
+        registry = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type',
+                                 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer((address, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+REGISTRY = Registry()
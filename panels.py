@@ -0,0 +1,157 @@
+"""E-paper panels the driver in epd2in7.py can run, described as data.
+
+A PanelProfile says everything that differs from one model to the next:
+the resolution, the command codes, the registers to set up after a
+reset (before and after powering on) and the waveform tables. The
+driver does the rest the same way for every panel: bulk SPI transfers,
+packing, partial refreshes, and only sending registers that changed.
+Each profile is compiled once, when it is made, into the byte strings
+the driver sends, so nothing is converted byte by byte at run time.
+
+The Waveshare 2.7 inch panel (IL91874 controller) is the only profile
+so far. Adding another means copying its init sequence and LUTs from
+Waveshare's driver for it into a PanelProfile in PROFILES.
+Controllers with the same command set (UC8151/IL0373 and friends) only
+need their geometry, registers and waveforms. Ones that work differently
+(the SSD16xx family, say) need their own commands and have partial
+refreshes turned off (partial=False) until the driver learns theirs.
+"""
+
+
+import collections
+
+
+# Command name -> code. These are the ones the driver sends, the
+# controller's whole set is in epd2in7.py.
+IL91874_COMMANDS = {
+    'powerOn': 0x04,
+    'powerOff': 0x02,
+    'deepSleep': 0x07,
+    'dataStart1': 0x10,
+    'dataStart2': 0x13,
+    'refresh': 0x12,
+    'partialDataStart1': 0x14,
+    'partialDataStart2': 0x15,
+    'partialRefresh': 0x16,
+}
+COMMANDS = tuple(IL91874_COMMANDS)
+DEFAULT_PANEL = '2in7'
+
+
+# One register write: command, data and the key the driver keeps it under
+# to know when the controller already holds it
+Register = collections.namedtuple('Register', ['command', 'data', 'key'])
+
+
+def _compile(registers):
+    """[(command, data)] as Registers with the data in bytes.
+
+    Writes that share a command, like the 2.7 inch panel's 0xF8 ones, are
+    told apart by their first data byte.
+    """
+    commands = [command for command, _ in registers]
+    compiled = []
+    for command, data in registers:
+        data = bytes(data)
+        key = command if commands.count(command) == 1 else (command, data[0])
+        compiled.append(Register(command, data, key))
+    return tuple(compiled)
+
+
+class PanelProfile:
+    """A model of panel, as the driver needs to know it.
+
+    width and height are in pixels, width along the rows the controller
+    is sent (each row padded to a whole byte). commands maps every
+    name in COMMANDS to its code. powerOnRegisters are set before the
+    panel is powered on, registers after it, then luts, each a list of
+    (command, data). deepSleepCheck is the byte deepSleep wants after
+    it. partial says whether the panel does partial refreshes.
+    """
+
+    def __init__(self, name, width, height, commands, powerOnRegisters,
+                 registers, luts, deepSleepCheck=0xA5, partial=True):
+        missing = set(COMMANDS) - set(commands)
+        if missing:
+            raise ValueError('{} has no code for {}'.format(
+                name, ', '.join(sorted(missing))))
+        self.name = name
+        self.width = width
+        self.height = height
+        self.commands = dict(commands)
+        self.powerOnRegisters = _compile(powerOnRegisters)
+        self.registers = _compile(registers)
+        self.luts = _compile(luts)
+        self.deepSleepCheck = deepSleepCheck
+        self.partial = partial
+        # Rows start on a byte, see epd2in7.row_bytes. A full refresh
+        # sends the "old data" plane all white.
+        self.frameBytes = (width + 7) // 8 * height
+        self.whitePlane = b'\xFF' * self.frameBytes
+
+
+# Waveshare 2.7 inch, 176 x 264. LUTs are 42 bytes (44 for VCOM): seven
+# phases of level select, four frame counts and a repeat count.
+PANEL_2IN7 = PanelProfile(
+    '2in7', 176, 264, IL91874_COMMANDS,
+    powerOnRegisters=[
+        # POWER_SETTING: VDS_EN, VDG_EN; VCOM_HV, VGHL_LV; VDH; VDL; VDHR
+        (0x01, [0x03, 0x00, 0x2B, 0x2B, 0x09]),
+        (0x06, [0x07, 0x07, 0x17]),  # BOOSTER_SOFT_START
+        # Power optimization, each pair after command 0xF8
+        (0xF8, [0x60, 0xA5]),
+        (0xF8, [0x89, 0xA5]),
+        (0xF8, [0x90, 0x00]),
+        (0xF8, [0x93, 0x2A]),
+        (0xF8, [0xA0, 0xA5]),
+        (0xF8, [0xA1, 0x00]),
+        (0xF8, [0x73, 0x41]),
+        (0x16, [0x00]),  # PARTIAL_DISPLAY_REFRESH
+    ],
+    registers=[
+        (0x00, [0xAF]),  # PANEL_SETTING: KW-BF KWR-AF BWROTP 0f
+        (0x30, [0x3A]),  # PLL_CONTROL: 3A 100HZ 29 150Hz 39 200HZ 31 171HZ
+        (0x82, [0x12]),  # VCM_DC_SETTING_REGISTER
+    ],
+    luts=[
+        (0x20, [  # LUT_FOR_VCOM
+            0x00, 0x00,
+            0x00, 0x0F, 0x0F, 0x00, 0x00, 0x05,
+            0x00, 0x32, 0x32, 0x00, 0x00, 0x02,
+            0x00, 0x0F, 0x0F, 0x00, 0x00, 0x05,
+        ] + [0x00] * 24),
+        (0x21, [  # LUT_WHITE_TO_WHITE
+            0x50, 0x0F, 0x0F, 0x00, 0x00, 0x05,
+            0x60, 0x32, 0x32, 0x00, 0x00, 0x02,
+            0xA0, 0x0F, 0x0F, 0x00, 0x00, 0x05,
+        ] + [0x00] * 24),
+        (0x22, [  # LUT_BLACK_TO_WHITE
+            0x50, 0x0F, 0x0F, 0x00, 0x00, 0x05,
+            0x60, 0x32, 0x32, 0x00, 0x00, 0x02,
+            0xA0, 0x0F, 0x0F, 0x00, 0x00, 0x05,
+        ] + [0x00] * 24),
+        (0x23, [  # LUT_WHITE_TO_BLACK
+            0xA0, 0x0F, 0x0F, 0x00, 0x00, 0x05,
+            0x60, 0x32, 0x32, 0x00, 0x00, 0x02,
+            0x50, 0x0F, 0x0F, 0x00, 0x00, 0x05,
+        ] + [0x00] * 24),
+        (0x24, [  # LUT_BLACK_TO_BLACK
+            0xA0, 0x0F, 0x0F, 0x00, 0x00, 0x05,
+            0x60, 0x32, 0x32, 0x00, 0x00, 0x02,
+            0x50, 0x0F, 0x0F, 0x00, 0x00, 0x05,
+        ] + [0x00] * 24),
+    ],
+)
+
+PROFILES = {
+    PANEL_2IN7.name: PANEL_2IN7,
+}
+
+
+def profile(name):
+    """The PanelProfile called name, e.g. '2in7'."""
+    try:
+        return PROFILES[name]
+    except KeyError:
+        raise KeyError('No panel profile {!r}, there are: {}'.format(
+            name, ', '.join(PROFILES))) from None
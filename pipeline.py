@@ -0,0 +1,523 @@
+"""Runs the weather display as a pipeline of processes.
+
+weather_display.py fetches, draws and drives the panel from one process,
+so a download stuck in the kernel or a panel that never stops being
+busy can take the whole display down with it. Here each of those is a
+process of its own:
+
+* the fetcher keeps the forecast in the response cache (metapi) up to
+  date and tells the renderer when there is a new one,
+* the renderer parses it, draws a frame when it changed and otherwise
+  on the clock, and publishes the frame in shared memory,
+* the driver puts the newest published frame on the panel.
+
+Frames go from the renderer to the driver through SharedFrames, three
+frame buffers in a memory-mapped file and a sequence number saying which
+one is newest. The driver hands the panel a view of that buffer, so
+frames are never pickled or sent through a pipe.
+
+The supervisor (the process started from the command line) restarts a
+stage that dies, or that stops checking in for longer than its entry in
+STAGE_TIMEOUTS, while the other two keep going: if the fetcher hangs
+the panel still shows the last forecast with a current time, and if
+the driver dies the next frame is waiting for it when it comes back.
+
+    EPD_BACKEND=sim python3 pipeline.py
+"""
+
+
+import contextlib
+import fcntl
+import hashlib
+import mmap
+import multiprocessing
+import os
+import select
+import signal
+import struct
+import sys
+import tempfile
+import time
+import epd2in7
+import forecast
+import history
+import metapi
+import renderer
+import scheduler
+
+
+# Same meaning as in weather_display.py
+LATITUDE = 58.8474
+LONGITUDE = 5.7166
+FULL_REFRESH_INTERVAL = 6
+MIN_UPDATE_INTERVAL = 60
+MAX_UPDATE_INTERVAL = 600
+FIRST_DRAW_DELAY = 10
+HISTORY_FILE = 'cache/history.bin'
+HISTORY_DAYS = 31
+LAST_FRAME_FILE = 'cache/last_frame.sha1'
+POWER_MODE = 'sleep'
+TIMESTAMP_FORMAT = '%d.%m.%y %H:%M'
+# Seconds a stage may go without checking in before it is restarted. A
+# fetch is one HTTP request with a 30 s timeout per read, a refresh of
+# the panel is well under a minute.
+STAGE_TIMEOUTS = {
+    'fetcher': 180,
+    'renderer': 60,
+    'driver': 120,
+}
+# How often a waiting stage checks in, in seconds
+HEARTBEAT_INTERVAL = 5
+# A stage that dies is started again after RESTART_DELAY seconds, twice
+# as long each time it dies within STABLE_SECONDS of starting, up to
+# RESTART_LIMIT.
+RESTART_DELAY = 1
+RESTART_LIMIT = 300
+STABLE_SECONDS = 60
+
+# Where the frames are shared. The file is written with every frame, so
+# it lives in memory (tmpfs) rather than on the SD card: in
+# $XDG_RUNTIME_DIR if there is one, else /dev/shm, else the temporary
+# directory.
+FRAME_FILE = os.path.join(
+    os.environ.get('XDG_RUNTIME_DIR') or
+    ('/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()),
+    'weather-display-frames.bin')
+
+FRAME_BYTES = renderer.panel.frameBytes
+STAGES = tuple(STAGE_TIMEOUTS)
+
+
+class Doorbell:
+    """Wakes a process waiting in wait() when another one calls ring().
+
+    A pipe rather than a multiprocessing.Event, whose set() can block
+    forever once a process waiting on it has been killed.
+    """
+
+    def __init__(self):
+        self._read, self._write = os.pipe()
+        os.set_blocking(self._read, False)
+        os.set_blocking(self._write, False)
+
+    def ring(self):
+        try:
+            os.write(self._write, b'\0')
+        except BlockingIOError:
+            pass  # Plenty of rings already waiting to be heard
+
+    def wait(self, timeout=None):
+        """True if rung since the last wait, waiting up to timeout
+        seconds for it."""
+        ready, _, _ = select.select([self._read], [], [], timeout)
+        if not ready:
+            return False
+        try:
+            while os.read(self._read, 4096):
+                pass
+        except BlockingIOError:
+            pass
+        return True
+
+
+class SharedFrames:
+    """Frame buffers in a memory-mapped file, from one process to another.
+
+    There are three buffers: the one published last, the one the reader
+    is using and one to write the next frame into, so the writer never
+    waits for the reader and never overwrites the frame the reader has
+    taken. The header says which buffer is which and counts the frames
+    published. It is only changed under a lockf() lock, which the kernel
+    lets go of if the process holding it dies.
+
+    Create it before forking the writer and the reader, each of which
+    must use it from one thread.
+    """
+
+    # Frames published, buffer published last, buffer being read (-1 none)
+    _HEADER = struct.Struct('<Qii')
+    BUFFERS = 3
+
+    def __init__(self, path=FRAME_FILE, frameBytes=FRAME_BYTES):
+        self.path = path
+        self.frameBytes = frameBytes
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._file = open(path, 'w+b')
+        self._file.truncate(self._HEADER.size + self.BUFFERS * frameBytes)
+        self._map = mmap.mmap(self._file.fileno(), 0)
+        self._published = Doorbell()
+        self._setHeader(0, -1, -1)
+
+    def close(self):
+        """Unmaps and deletes the file; for the process that made it."""
+        self._map.close()
+        self._file.close()
+        os.remove(self.path)
+
+    @contextlib.contextmanager
+    def _locked(self):
+        fcntl.lockf(self._file, fcntl.LOCK_EX)
+        try:
+            yield self._HEADER.unpack_from(self._map, 0)
+        finally:
+            fcntl.lockf(self._file, fcntl.LOCK_UN)
+
+    def _setHeader(self, sequence, published, reading):
+        self._HEADER.pack_into(self._map, 0, sequence, published, reading)
+
+    def _buffer(self, index):
+        start = self._HEADER.size + index * self.frameBytes
+        return memoryview(self._map)[start:start + self.frameBytes]
+
+    def sequence(self):
+        """How many frames have been published."""
+        with self._locked() as (sequence, _, _):
+            return sequence
+
+    def publish(self, frame):
+        """Copies frame into a free buffer and makes it the newest one.
+
+        Returns its sequence number.
+        """
+        with self._locked() as (_, published, reading):
+            pass
+        index = next(index for index in range(self.BUFFERS)
+                     if index not in (published, reading))
+        with self._buffer(index) as buffer:
+            buffer[:] = frame
+        with self._locked() as (sequence, _, reading):
+            self._setHeader(sequence + 1, index, reading)
+        self._published.ring()
+        return sequence + 1
+
+    def acquire(self, after, timeout=None):
+        """Waits for a frame newer than sequence number after.
+
+        Returns (sequence, view), view being a memoryview of the buffer
+        in the mapped file, or None if there was none within timeout
+        seconds. The buffer is not written to until release().
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            with self._locked() as (sequence, published, _):
+                if sequence > after:
+                    self._setHeader(sequence, published, published)
+                    return sequence, self._buffer(published)
+            remaining = None if deadline is None else max(
+                deadline - time.time(), 0)
+            if not self._published.wait(remaining):
+                return None
+
+    def release(self, view):
+        """Gives back the buffer of a view acquire() returned."""
+        view.release()
+        with self._locked() as (sequence, published, _):
+            self._setHeader(sequence, published, -1)
+
+
+class PipelineState:
+    """What the stages share, made by the supervisor before forking.
+
+    Nothing in it can be left locked by a stage that is killed.
+    """
+
+    def __init__(self):
+        self.frames = SharedFrames()
+        # Unix time each stage (in STAGES order) last checked in
+        self.heartbeats = multiprocessing.RawArray('d', len(STAGES))
+        # Forecasts the fetcher has fetched, and whether the last was stale
+        self.forecasts = multiprocessing.RawValue('Q', 0)
+        self.stale = multiprocessing.RawValue('b', False)
+        self.newForecast = Doorbell()
+        self.url = metapi.forecastUrl(LATITUDE, LONGITUDE,
+                                      renderer.FORECAST_PRODUCT)
+
+    def beat(self, stage):
+        self.heartbeats[STAGES.index(stage)] = time.time()
+
+    def lastBeat(self, stage):
+        return self.heartbeats[STAGES.index(stage)]
+
+    def sleepUntil(self, stage, when, doorbell=None):
+        """Sleeps until unix time when, or until doorbell rings, checking
+        in every HEARTBEAT_INTERVAL seconds. True if it rang."""
+        while True:
+            self.beat(stage)
+            delay = min(when - time.time(), HEARTBEAT_INTERVAL)
+            if delay <= 0:
+                return False
+            if doorbell is None:
+                time.sleep(delay)
+            elif doorbell.wait(delay):
+                return True
+
+
+def fetcher(state):
+    """Keeps the cached forecast current, as weather_display does."""
+    cache = metapi.ResponseCache()
+    while True:
+        started = time.time()
+        state.beat('fetcher')
+        try:
+            response = cache.fetch(state.url)
+        except metapi.RetryLater as e:
+            print('fetcher: no forecast yet ({}), trying again at {}'.format(
+                e.cause, time.strftime('%H:%M:%S',
+                                       time.localtime(e.retryAt))))
+            state.sleepUntil('fetcher', e.retryAt)
+            continue
+        if response.stale:
+            print('fetcher: could not refresh the forecast ({}), trying '
+                  'again at {}'.format(response.error, time.strftime(
+                      '%H:%M:%S', time.localtime(response.expires))))
+        elif response.wireBytes:
+            print('fetcher: {} ({} bytes on the wire)'.format(
+                response.status, response.wireBytes))
+        if response.modified or response.stale != state.stale.value:
+            state.stale.value = response.stale
+            state.forecasts.value += 1
+            state.newForecast.ring()
+        state.sleepUntil('fetcher', max(response.expires,
+                                        started + MIN_UPDATE_INTERVAL))
+
+
+class Renderer:
+    """The renderer stage: parses forecasts and publishes frames."""
+
+    def __init__(self, state):
+        self.state = state
+        self.cache = metapi.ResponseCache()
+        self.legend = metapi.Legend(self.cache)
+        self.history = None
+        self.data = None
+        self.stale = False
+        self.forecasts = 0
+        self.frame = None
+
+    def load(self, response):
+        try:
+            with response.open() as f:
+                self.data = forecast.read(f, renderer.FORECAST_STEPS)
+        except (OSError, ValueError) as e:
+            print('renderer: could not read the forecast: {}'.format(e))
+            return
+        self.recordHistory()
+
+    def recordHistory(self):
+        if HISTORY_FILE is None:
+            return
+        try:
+            if self.history is None:
+                self.history = history.History(HISTORY_FILE)
+            self.history.append(self.data)
+            self.history.expire(HISTORY_DAYS)
+        except (OSError, ValueError) as e:
+            print('renderer: could not save the forecast history: {}'.format(
+                e))
+
+    def update(self):
+        """Takes in whatever the fetcher has fetched since last time."""
+        forecasts = self.state.forecasts.value
+        if forecasts == self.forecasts:
+            return
+        self.forecasts = forecasts
+        self.stale = bool(self.state.stale.value)
+        response = self.cache.cached(self.state.url)
+        if response is not None:
+            self.load(response)
+
+    def draw(self):
+        if self.data is None:
+            return
+        frame = renderer.renderFrame(
+            self.data, self.legend.description(self.data.steps[0].symbol1h),
+            time.strftime(TIMESTAMP_FORMAT), self.stale)
+        # The same frame again would only wake the driver for nothing
+        if frame != self.frame:
+            self.frame = frame
+            self.state.frames.publish(frame)
+
+    def run(self):
+        # Something to show straight away, even before the first fetch
+        response = self.cache.cached(self.state.url)
+        if response is not None:
+            self.load(response)
+            self.stale = response.expires <= time.time()
+        self.state.sleepUntil('renderer', time.time() + FIRST_DRAW_DELAY,
+                              self.state.newForecast)
+        while True:
+            self.state.beat('renderer')
+            self.update()
+            self.draw()
+            self.state.sleepUntil(
+                'renderer', scheduler.nextLocalBoundary(time.time(),
+                                                        MAX_UPDATE_INTERVAL),
+                self.state.newForecast)
+
+
+def renderStage(state):
+    Renderer(state).run()
+
+
+def loadLastFrameFingerprint():
+    """Returns the fingerprint of the frame last sent to the display."""
+    try:
+        with open(LAST_FRAME_FILE) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def saveLastFrameFingerprint(fingerprint):
+    os.makedirs(os.path.dirname(LAST_FRAME_FILE), exist_ok=True)
+    with open(LAST_FRAME_FILE + '.tmp', 'w') as f:
+        f.write(fingerprint)
+    os.replace(LAST_FRAME_FILE + '.tmp', LAST_FRAME_FILE)
+
+
+def driver(state):
+    """Shows every new frame the renderer publishes on the panel."""
+    # Stopping in the middle of a refresh would leave the panel powered,
+    # so SIGTERM only stops the driver once the refresh is done.
+    stopping = []
+    signal.signal(signal.SIGTERM,
+                  lambda signum, frame: stopping.append(signum))
+    epd = epd2in7.EPD(full_refresh_interval=FULL_REFRESH_INTERVAL,
+                      power_mode=POWER_MODE, profile=renderer.panel)
+    epd.init()
+    epd.rest()
+    # The panel keeps its image without power, so a restarted driver
+    # leaves it alone while the renderer publishes the frame it shows
+    shown = loadLastFrameFingerprint()
+    sequence = 0
+    try:
+        while not stopping:
+            state.beat('driver')
+            acquired = state.frames.acquire(sequence, HEARTBEAT_INTERVAL)
+            if acquired is None:
+                continue
+            sequence, view = acquired
+            try:
+                fingerprint = hashlib.sha1(view).hexdigest()
+                if fingerprint == shown:
+                    print('driver: frame {} unchanged, skipped refresh at {}'
+                          .format(sequence, time.strftime('%d%m%y-%H:%M:%S')))
+                    continue
+                refresh = epd.update_frame(view)
+            finally:
+                state.frames.release(view)
+            shown = fingerprint
+            saveLastFrameFingerprint(fingerprint)
+            print('driver: frame {} refreshed ({}) at {}'.format(
+                sequence, refresh, time.strftime('%d%m%y-%H:%M:%S')))
+    finally:
+        # rest() may have put the panel to sleep already. After an error
+        # halfway through a refresh the SPI and GPIO state is anyone's
+        # guess, so failing to put it to sleep must not hide that error.
+        if not epd.asleep:
+            try:
+                epd.sleep()
+            except Exception as e:
+                print('driver: could not put the panel to sleep: {!r}'
+                      .format(e))
+
+
+TARGETS = {
+    'fetcher': fetcher,
+    'renderer': renderStage,
+    'driver': driver,
+}
+
+
+def runStage(stage, state):
+    # ^C in the terminal is for the supervisor, which stops the stages
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    state.beat(stage)
+    TARGETS[stage](state)
+
+
+class Supervisor:
+    """Starts the stages and restarts any that dies or stops checking in."""
+
+    def __init__(self, state, context):
+        self.state = state
+        self.context = context
+        self.processes = {}
+        self.started = {}
+        # stage -> (restart delay, unix time to start it again at)
+        self.restarts = {stage: (RESTART_DELAY, 0) for stage in STAGES}
+
+    def start(self, stage):
+        self.state.beat(stage)
+        process = self.context.Process(target=runStage,
+                                       args=(stage, self.state),
+                                       name=stage, daemon=True)
+        process.start()
+        print('supervisor: started {} (pid {})'.format(stage, process.pid))
+        self.processes[stage] = process
+        self.started[stage] = time.time()
+
+    def stop(self, stage, timeout=30):
+        """Stops stage, giving it timeout seconds to finish what it is
+        doing (the driver a refresh) before killing it."""
+        process = self.processes[stage]
+        process.terminate()
+        process.join(timeout)
+        if process.is_alive():
+            process.kill()
+            process.join()
+        del self.processes[stage]
+
+    def check(self, stage):
+        """Restarts stage if need be."""
+        now = time.time()
+        process = self.processes.get(stage)
+        if process is not None:
+            if process.is_alive():
+                if now - self.state.lastBeat(stage) <= STAGE_TIMEOUTS[stage]:
+                    return
+                print('supervisor: {} has not checked in for {:.0f} s, '
+                      'restarting it'.format(
+                          stage, now - self.state.lastBeat(stage)))
+                # Stuck, so there is nothing to wait for
+                self.stop(stage, timeout=0)
+            else:
+                print('supervisor: {} exited with {}'.format(
+                    stage, process.exitcode))
+                del self.processes[stage]
+            delay, _ = self.restarts[stage]
+            if now - self.started[stage] >= STABLE_SECONDS:
+                delay = RESTART_DELAY
+            self.restarts[stage] = (min(delay * 2, RESTART_LIMIT),
+                                    now + delay)
+        if now >= self.restarts[stage][1]:
+            self.start(stage)
+
+    def run(self):
+        """Runs until interrupted, then stops the stages."""
+        try:
+            while True:
+                for stage in STAGES:
+                    self.check(stage)
+                time.sleep(1)
+        finally:
+            for stage in list(self.processes):
+                self.stop(stage)
+
+
+if __name__ == '__main__':
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    # Forked, the stages inherit the pipes and the mapped file, and start
+    # with renderer's fonts and icons already loaded
+    context = multiprocessing.get_context('fork')
+    renderer.icons.validate(
+        metapi.Legend(metapi.ResponseCache()).symbolCodes())
+    state = PipelineState()
+    try:
+        Supervisor(state, context).run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        state.frames.close()
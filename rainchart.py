@@ -0,0 +1,142 @@
+"""Bar chart of the precipitation to come, over a configurable horizon.
+
+The chart has a bar per hour for the first hourlyHours hours and a bar
+per 6 hours after that, up to hours hours ahead, all the same width, so
+a 48 hour chart still fits the screen. Bars show mm per hour (a 6 hour
+bar is its total divided by 6) so their heights compare: filled for the
+expected amount, outlined for the most that could come.
+
+All the bars' coordinates are worked out in one pass over the amounts,
+and they are drawn as one filled polygon and one line, so a chart costs
+about the same to draw whatever the horizon.
+"""
+
+
+import math
+from PIL import Image
+from PIL import ImageDraw
+import epd2in7
+
+
+HOUR = 3600
+# Columns between the last bar and the right edge of the layout, which is
+# renderer.EPD_WIDTH wide whatever panel renderer.PANEL is (the frame is
+# scaled to fit it afterwards). The axis reaches 2 columns past the bars.
+MARGIN = 2
+
+
+class RainChart:
+    """Geometry and drawing of the precipitation chart.
+
+    Bars sit on the baseline between x = left and right (the first
+    column right of the last bar, by default MARGIN in from the right
+    edge of the layout), and are pixelsPerMm tall per mm of rain an
+    hour, up to maxRate mm. With
+    maxima=False the most that could come is left out, which the
+    'compact' forecast doesn't have.
+    """
+
+    def __init__(self, hours=12, hourlyHours=12, left=10, right=None,
+                 baseline=239, pixelsPerMm=10, maxRate=4, maxima=True):
+        if not 0 <= hourlyHours <= hours or (hours - hourlyHours) % 6:
+            raise ValueError('A {} hour chart cannot have {} hourly bars '
+                             'and the rest in 6 hour ones'.format(
+                                 hours, hourlyHours))
+        self.hours = hours
+        self.baseline = baseline
+        self.pixelsPerMm = pixelsPerMm
+        self.maxRate = maxRate
+        self.maxima = maxima
+        # (hours ahead, hours long) of each bar
+        self.slots = ([(hour, 1) for hour in range(hourlyHours)] +
+                      [(hour, 6) for hour in range(hourlyHours, hours, 6)])
+        if right is None:
+            right = epd2in7.EPD_WIDTH - MARGIN
+        # 14 pixels a bar leaves a 4 pixel gap between the outlines. There
+        # is no gap after the last bar, so the bars end at right whatever
+        # the gap rounds to.
+        count = len(self.slots)
+        gap = max(round((right - 1 - left) / (count - 5 / 14) * 5 / 14), 1)
+        pitch = (right - 1 - left + gap) / count
+        edges = [left + round(i * pitch) for i in range(count + 1)]
+        # Pixel columns of each bar's outline, both included
+        self.bars = [(edges[i], edges[i + 1] - gap)
+                     for i in range(len(self.slots))]
+
+    def fields(self):
+        """The ForecastStep attributes the chart uses."""
+        fields = ['precipitation1h', 'precipitation6h']
+        if self.maxima:
+            fields += ['precipitationMax1h', 'precipitationMax6h']
+        return fields
+
+    def top(self):
+        """The highest row a bar can reach."""
+        return self.baseline - self.maxRate * self.pixelsPerMm
+
+    def rates(self, steps):
+        """Expected and maximum mm per hour for each bar, from steps.
+
+        steps are forecast.ForecastSteps starting now. Bars without a
+        step or a value in the forecast are 0.
+        """
+        byTime = {step.time: step for step in steps}
+        start = steps[0].time
+        amounts = []
+        maxima = []
+        for offset, length in self.slots:
+            step = byTime.get(start + offset * HOUR)
+            if step is None:
+                amount = maximum = None
+            elif length == 1:
+                amount, maximum = step.precipitation1h, step.precipitationMax1h
+            else:
+                amount, maximum = step.precipitation6h, step.precipitationMax6h
+            amounts.append((amount or 0) / length)
+            maxima.append((maximum or 0) / length)
+        return amounts, maxima
+
+    def axis(self):
+        """The axis, as an image to paste at axisPosition().
+
+        Three rows: a line under each bar, ticks between the bars and a
+        line the whole width.
+        """
+        first, last = self.bars[0][0] - 2, self.bars[-1][1] + 2
+        image = Image.new('1', (last - first + 1, 3), 255)
+        draw = ImageDraw.Draw(image)
+        for left, right in self.bars:
+            draw.line((left - first, 0, right - first, 0), fill=0)
+        ticks = {0, last - first}
+        for (_, right), (left, _) in zip(self.bars, self.bars[1:]):
+            middle = (right + left) / 2 - first
+            ticks.update((math.floor(middle), math.ceil(middle)))
+        for x in ticks:
+            image.putpixel((x, 1), 0)
+        draw.line((0, 2, last - first, 2), fill=0)
+        return image
+
+    def axisPosition(self):
+        return self.bars[0][0] - 2, self.baseline
+
+    def draw(self, draw, steps):
+        """Draws the bars for steps with the ImageDraw draw.
+
+        The outlines run along the row under the baseline between bars,
+        so paste axis() back over them afterwards.
+        """
+        amounts, maxima = self.rates(steps)
+        ground = self.baseline + 1
+        scale = self.pixelsPerMm
+        fill = []
+        outline = []
+        for (left, right), amount, maximum in zip(self.bars, amounts, maxima):
+            top = self.baseline - min(amount, self.maxRate) * scale
+            maxTop = self.baseline - min(maximum, self.maxRate) * scale
+            fill += [(left, ground), (left, top),
+                     (right - 1, top), (right - 1, ground)]
+            outline += [(left, ground), (left, maxTop),
+                        (right, maxTop), (right, ground)]
+        draw.polygon(fill, fill=0)
+        if self.maxima:
+            draw.line(outline, fill=0, width=1)
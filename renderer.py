@@ -0,0 +1,265 @@
+"""Draws the weather display's picture of a forecast.
+
+Fonts, icons and the static parts of the layout are loaded once, when
+this module is imported, and shared by everything drawn afterwards. The
+drawing functions only read them, so a process that renders in worker
+processes forked after the import (see daemon.py) shares one copy.
+"""
+
+
+import time
+from PIL import Image
+from PIL import ImageChops
+from PIL import ImageDraw
+import epd2in7
+import forecast
+import iconstore
+import metrics
+import panels
+import rainchart
+import textstore
+
+
+# The panel the frames are for, one of panels.PROFILES
+PANEL = panels.DEFAULT_PANEL
+# The size the layout is drawn at, the 2.7 inch panel's. On a panel of
+# another size the picture is scaled to fit (see fitToPanel).
+EPD_WIDTH = epd2in7.EPD_WIDTH  # 176 pixels
+EPD_HEIGHT = epd2in7.EPD_HEIGHT  # 264 pixels
+# Turns mask upside down, this just happened to work best for my frame
+# with regards to which side the cable came out. The turning is done
+# while packing the frame (see epd2in7.ORIENTATIONS), so 0 and 180 cost
+# the same.
+ROTATION = 180
+# Hours ahead the rain chart covers, e.g. 12, 24 or 48. The first
+# RAIN_CHART_HOURLY_HOURS get a bar per hour, the rest a bar per 6 hours.
+RAIN_CHART_HOURS = 12
+RAIN_CHART_HOURLY_HOURS = 12
+# Outline the most rain that could come over each bar. Needs the larger
+# 'complete' forecast, see FIELDS.
+RAIN_CHART_MAXIMA = True
+
+# Font sizes, in points
+TEENYTINY = 10
+TEENY = 12
+TINY = 14
+SMALL = 18
+NORMAL = 22
+MED = 40
+BIG = 70
+
+stageSeconds = metrics.REGISTRY.histogram(
+    'weather_display_stage_seconds',
+    'Time spent in each stage of an update.', ('stage',))
+# Every icon is loaded once, here, and a missing one stops us right away
+# rather than halfway through drawing a frame.
+with stageSeconds.time(stage='icon_load'):
+    icons = iconstore.IconStore()
+# Text is rendered once per (size, text) and pasted from there on.
+texts = textstore.TextStore()
+panel = panels.profile(PANEL)
+# Only used for packing frames, it never talks to the display
+_packer = epd2in7.EPD(orientation=ROTATION, profile=panel)
+rainChart = rainchart.RainChart(RAIN_CHART_HOURS, RAIN_CHART_HOURLY_HOURS,
+                                maxima=RAIN_CHART_MAXIMA)
+# Timeseries entries to read (forecast.read's maxSteps) for this layout.
+# Entries are at most an hour apart, so one per hour of the chart will do.
+FORECAST_STEPS = max(forecast.DEFAULT_STEPS, RAIN_CHART_HOURS)
+# ForecastStep attributes drawFrame uses. They decide which forecast
+# product to download: 'compact' is much smaller, but doesn't have gusts,
+# rain probability or maxima (forecast.COMPLETE_ONLY). Keep this in step
+# with drawFrame when changing the layout.
+FIELDS = ['airTemperature', 'airTemperatureMax6h', 'symbol1h', 'symbol6h',
+          'symbol12h', 'precipitationProbability1h', 'windSpeed',
+          'windSpeedOfGust'] + rainChart.fields()
+FORECAST_PRODUCT = forecast.product(FIELDS)
+
+# The parts of the layout that change from frame to frame, as (left, top,
+# right, bottom) boxes big enough for anything drawn there. Everything
+# outside them is the same in every frame and drawn once, in the static
+# layer.
+DYNAMIC_REGIONS = {
+    'condition': (0, 0, 96, 96),
+    'temperature': (98, 3, 176, 82),
+    'rainChancePercent': (127, 83, 176, 104),
+    'lastUpdated': (104, 1, 176, 13),
+    'status': (5, 104, 176, 176),
+    'next6h': (22, 144, 70, 192),
+    'next12h': (110, 144, 176, 192),
+    'rainDiagram': (10, 199, 174, 241),
+    'wind': (43, 244, 176, 264),
+}
+STATIC_ICONS = [
+    ('rainChance', (110, 83)),
+    ('refresh', (91, 1)),
+    ('sixhours', (2, 153)),
+    ('twelvehours', (90, 153)),
+    ('windicon', (0, 248)),
+]
+# The rain chart's label, '12' over a clock and a rain cloud
+RAIN_LABEL_ICON = ('twelveHrain', (1, 212))
+# A stale forecast (one that could not be refreshed) is marked by showing
+# the refresh icon white on black, in this box.
+STALE_MARKER_BOX = (90, 0, 101, 11)
+staleMarker = ImageChops.invert(icons.icon('refresh'))
+
+
+def buildStaticLayer():
+    """Draws the parts of the screen that never change.
+
+    Returns the layer and the static icons that overlap a dynamic
+    region. Those were drawn on top of the dynamic content, so they
+    need pasting again after it.
+    """
+    layer = Image.new('1', (EPD_WIDTH, EPD_HEIGHT), 255)
+    # 255: clear the image with white
+    draw = ImageDraw.Draw(layer)
+    overlays = []
+    for name, (x, y) in STATIC_ICONS:
+        icon = icons.icon(name)
+        layer.paste(icon, (x, y))
+        right, bottom = x + icon.width, y + icon.height
+        for left, top, regionRight, regionBottom in DYNAMIC_REGIONS.values():
+            if (x < regionRight and left < right and
+                    y < regionBottom and top < bottom):
+                overlays.append((icon, (x, y)))
+                break
+    drawRainLabel(layer, draw)
+    # The chart's bars draw over the axis, so it always goes back on top
+    axis = rainChart.axis()
+    layer.paste(axis, rainChart.axisPosition())
+    overlays.append((axis, rainChart.axisPosition()))
+    return layer, overlays
+
+
+def drawRainLabel(layer, draw):
+    name, (x, y) = RAIN_LABEL_ICON
+    icon = icons.icon(name)
+    if RAIN_CHART_HOURS == 12:
+        layer.paste(icon, (x, y))
+        return
+    # Keep the clock and cloud, with the chart's hours written up the side
+    # instead of the 12
+    layer.paste(icon.crop((0, 7, icon.width, icon.height)), (x, y + 7))
+    text = texts.bitmap('{}h'.format(RAIN_CHART_HOURS), TEENYTINY)[0]
+    text = text.rotate(90, expand=True)
+    layer.paste(0, (x + (icon.width - text.width) // 2,
+                    y + 5 - text.height), text)
+
+
+staticLayer, staticOverlays = buildStaticLayer()
+
+
+def drawFrame(data, currentStatus, lastUpdated, stale=False):
+    """Draws the forecast onto a copy of the static layer.
+
+    data is a forecast.Forecast, currentStatus the description of the
+    current weather symbol and lastUpdated the time to show. stale marks
+    the forecast as out of date. Icons come from the IconStore and text
+    from the TextStore loaded at import, so nothing is read from disk.
+    Returns the mask, EPD_WIDTH x EPD_HEIGHT and not yet turned or
+    packed for the panel (see packFrame).
+    """
+    drawStart = time.perf_counter()
+    steps = data.steps
+    now = steps[0]
+    # Temperature related variables:
+    # Five total periods: current temperature, and the four next
+    # 6 hour periods. (FirstPeriod, SecondPeriod, etc)
+    currentTemperature = now.airTemperature
+
+    next6hTemp = now.airTemperatureMax6h
+    icon6h = now.symbol6h
+    next12hTemp = steps[11].airTemperature
+    icon12h = now.symbol12h
+
+    # Weather conditions and various icons
+    currentIcon = now.symbol1h
+    rainChancePercent = now.precipitationProbability1h
+
+    conditionIcon = icons.symbol(currentIcon)
+    next6hIcon = icons.symbol(icon6h, small=True)
+    next12hIcon = icons.symbol(icon12h, small=True)
+
+    # Wind information
+    windSpeed = now.windSpeed
+    windMaxGust = now.windSpeedOfGust
+
+    # Coordinates are X, Y:
+    # 0, 0 is top left of screen 176, 264 is bottom right
+    # Start from the static layer and only draw what changes.
+    mask = staticLayer.copy()
+    draw = ImageDraw.Draw(mask)
+
+    mask.paste(conditionIcon, (0, 0))
+    currentTemp = int(currentTemperature)
+    if (currentTemp <= 9) and (currentTemp >= -9):
+        # Centers the temperature when it is single digits
+        texts.draw(mask, (120, 12), '{}'.format(currentTemp), BIG)
+    elif (currentTemp >= 10):
+        texts.draw(mask, (98, 12), '{}'.format(currentTemp), BIG)
+    elif (currentTemp <= -10):
+        # Adds text "BELOW ZERO" underneath, no space for a minus sign
+        negativeCurrentTemp = (currentTemp * -1)
+        texts.draw(mask, (98, 3), '{}'.format(negativeCurrentTemp), BIG)
+        texts.draw(mask, (105, 70), 'BELOW ZERO', TEENYTINY)
+
+    texts.draw(mask, (127, 83), '{}%'.format(int(rainChancePercent)), SMALL)
+
+    texts.draw(mask, (104, 1), '{}'.format(lastUpdated), TEENYTINY)
+    texts.draw(mask, (5, 104), currentStatus, SMALL, wrap=19)
+
+    texts.draw(mask, (22, 162), '{}'.format(next6hTemp), SMALL)
+    mask.paste(next6hIcon, (22, 144))
+    texts.draw(mask, (110, 162), '{}'.format(next12hTemp), SMALL)
+    mask.paste(next12hIcon, (110, 144))
+
+    rainChart.draw(draw, steps)
+
+    texts.draw(mask, (43, 244), '{}-{} m/s'.format(windSpeed, windMaxGust),
+               SMALL)
+
+    # Static icons that dynamic content may have drawn over go on top.
+    for icon, position in staticOverlays:
+        mask.paste(icon, position)
+    if stale:
+        draw.rectangle(STALE_MARKER_BOX, fill=0)
+        mask.paste(staleMarker, (STALE_MARKER_BOX[0] + 1,
+                                 STALE_MARKER_BOX[1] + 1))
+    stageSeconds.observe(time.perf_counter() - drawStart, stage='draw')
+    return mask
+
+
+def fitToPanel(mask):
+    """mask scaled to fill as much of the panel as it can, centred.
+
+    The layout is drawn at EPD_WIDTH x EPD_HEIGHT; on a panel of that
+    size (turned the way ROTATION says) mask is returned as it is.
+    """
+    size = _packer.image_size()
+    if mask.size == size:
+        return mask
+    scale = min(size[0] / mask.width, size[1] / mask.height)
+    # Nearest neighbour keeps the pixels black or white
+    scaled = mask.resize((max(int(mask.width * scale), 1),
+                          max(int(mask.height * scale), 1)), Image.NEAREST)
+    fitted = Image.new('1', size, 255)
+    fitted.paste(scaled, ((size[0] - scaled.width) // 2,
+                          (size[1] - scaled.height) // 2))
+    return fitted
+
+
+def packFrame(mask):
+    """Turns mask the way the display is mounted and packs it for it."""
+    with stageSeconds.time(stage='pack'):
+        return bytes(_packer.get_frame_buffer(fitToPanel(mask)))
+
+
+def renderFrame(data, currentStatus, lastUpdated, stale=False):
+    """drawFrame and packFrame in one go, returns the frame buffer."""
+    return packFrame(drawFrame(data, currentStatus, lastUpdated, stale))
+
+
+def frameImage(frameBuffer):
+    """The picture in frameBuffer, the right way up."""
+    return _packer.get_image(frameBuffer)
@@ -0,0 +1,362 @@
+"""Serves the weather display's frames over HTTP, for displays that can't
+draw them.
+
+A display that only has to show a picture (an ESP32 driving an e-paper
+panel, say) asks for
+
+    GET /frame?lat=58.8474&lon=5.7166&layout=minute&format=raw
+
+and gets the 5808 byte buffer the panel takes, packed and turned the
+way renderer does it for the display on the Pi, or a PNG with
+format=png. Every frame has an ETag: send it back in If-None-Match and
+a frame that hasn't changed costs a 304 without a body. Cache-Control
+says how long until it can change, which is a good time to ask again.
+
+However many clients ask, a frame is drawn once per location, layout,
+forecast and time shown, and kept in a FrameCache. Each location's
+forecast is fetched through the response cache when it expires, as
+weather_display.py does, and a stale one is served (and marked on the
+frame) while the network is down. /metrics has the counters.
+
+    python3 renderservice.py --port 8080
+"""
+
+
+import argparse
+import collections
+import concurrent.futures
+import hashlib
+import http.server
+import io
+import threading
+import time
+import urllib.parse
+import forecast
+import metapi
+import metrics
+import renderer
+import scheduler
+
+
+PORT = 8080
+# layout -> (how the time it was drawn is shown, seconds between changes
+# of it). The hour layout changes only with the forecast or the hour, so
+# clients polling it mostly get 304s.
+LAYOUTS = {
+    'minute': ('%d.%m.%y %H:%M', 60),
+    'hour': ('%d.%m.%y %H:00', 3600),
+}
+DEFAULT_LAYOUT = 'minute'
+# Frames kept, the least recently used dropped first, and for how long
+MAX_FRAMES = 256
+FRAME_TTL = 3600
+# Locations served at once; each has a forecast to keep current
+MAX_LOCATIONS = 64
+# Connections waiting to be accepted, with hundreds of clients polling
+LISTEN_BACKLOG = 256
+
+frameRequests = metrics.REGISTRY.counter(
+    'weather_display_service_requests_total',
+    'Frame requests by format and HTTP status.', ('format', 'status'))
+renders = metrics.REGISTRY.counter(
+    'weather_display_service_renders_total',
+    'Frames drawn for the render service.')
+forecastRequests = metrics.REGISTRY.counter(
+    'weather_display_forecast_requests_total',
+    'Forecast lookups by result: cached, not_modified, downloaded or '
+    'stale.',
+    ('result',))
+
+
+class TooManyLocations(Exception):
+    pass
+
+
+class Location:
+    """A place to forecast and its latest forecast, for every client."""
+
+    def __init__(self, cache, url):
+        self.cache = cache
+        self.url = url
+        # (forecast.Forecast, version, stale), replaced in one go so
+        # readers never see half an update. version goes up with every new
+        # forecast or change of staleness.
+        self.current = (None, 0, False)
+        self.expires = 0
+        self._fetching = threading.Lock()
+
+    def forecast(self):
+        """Returns current, fetching the forecast first if it expired.
+
+        One thread fetches while the others carry on with the forecast
+        there is, unless there is none yet. Raises metapi.RetryLater if
+        there is no forecast and none can be had.
+        """
+        data = self.current[0]
+        if time.time() >= self.expires or data is None:
+            if self._fetching.acquire(blocking=data is None):
+                try:
+                    if time.time() >= self.expires or (
+                            self.current[0] is None):
+                        self._update()
+                finally:
+                    self._fetching.release()
+        return self.current
+
+    def _update(self):
+        response = self.cache.fetch(self.url)
+        forecastRequests.inc(result=response.status)
+        self.expires = response.expires
+        data, version, stale = self.current
+        if response.stale:
+            print('Could not refresh {} ({}), serving the last forecast'
+                  .format(self.url, response.error))
+        if response.modified or data is None:
+            with response.open() as f:
+                data = forecast.read(f, renderer.FORECAST_STEPS)
+            version += 1
+        elif response.stale != stale:
+            version += 1
+        self.current = (data, version, response.stale)
+
+
+class Frame:
+    """A rendered frame, with the PNG of it made on first use."""
+
+    def __init__(self, buffer):
+        self.buffer = buffer
+        self.etag = '"{}"'.format(hashlib.sha1(buffer).hexdigest()[:20])
+        self.pngEtag = self.etag[:-1] + '-png"'
+        self._png = None
+
+    def png(self):
+        if self._png is None:
+            output = io.BytesIO()
+            renderer.frameImage(self.buffer).save(output, 'PNG')
+            self._png = output.getvalue()
+        return self._png
+
+
+class FrameCache:
+    """Frames by key, each drawn once however many threads ask for it.
+
+    Frames are dropped ttl seconds after they were drawn, and the least
+    recently used ones once there are more than maxEntries.
+    """
+
+    def __init__(self, maxEntries=MAX_FRAMES, ttl=FRAME_TTL):
+        self.maxEntries = maxEntries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # key -> (unix time it expires, Frame)
+        self._frames = collections.OrderedDict()
+        # key -> Future of a frame being drawn
+        self._drawing = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, draw):
+        """The frame for key, from draw() if it isn't cached yet."""
+        with self._lock:
+            entry = self._frames.get(key)
+            if entry is not None and entry[0] > time.time():
+                self._frames.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            future = self._drawing.get(key)
+            drawing = future is None
+            if drawing:
+                future = self._drawing[key] = concurrent.futures.Future()
+                self.misses += 1
+        if not drawing:
+            # Someone else is drawing it already
+            return future.result()
+        try:
+            frame = draw()
+        except BaseException as e:
+            with self._lock:
+                del self._drawing[key]
+            future.set_exception(e)
+            raise
+        with self._lock:
+            del self._drawing[key]
+            self._frames[key] = (time.time() + self.ttl, frame)
+            self._frames.move_to_end(key)
+            while len(self._frames) > self.maxEntries:
+                self._frames.popitem(last=False)
+        future.set_result(frame)
+        return frame
+
+
+class RenderService:
+    """Frames for any location and layout, drawn as few times as can be."""
+
+    def __init__(self, cache=None, legend=None, frames=None,
+                 maxLocations=MAX_LOCATIONS):
+        self.cache = metapi.ResponseCache() if cache is None else cache
+        self.legend = metapi.Legend(self.cache) if legend is None else legend
+        self.frames = FrameCache() if frames is None else frames
+        self.maxLocations = maxLocations
+        self._locations = {}
+        self._lock = threading.Lock()
+
+    def location(self, latitude, longitude):
+        url = metapi.forecastUrl(latitude, longitude,
+                                 renderer.FORECAST_PRODUCT)
+        with self._lock:
+            location = self._locations.get(url)
+            if location is None:
+                if len(self._locations) >= self.maxLocations:
+                    raise TooManyLocations('Already serving {} locations'
+                                           .format(self.maxLocations))
+                location = self._locations[url] = Location(self.cache, url)
+            return location
+
+    def frame(self, latitude, longitude, layout=DEFAULT_LAYOUT):
+        """Returns (Frame, seconds until it may change)."""
+        timestampFormat, interval = LAYOUTS[layout]
+        location = self.location(latitude, longitude)
+        data, version, stale = location.forecast()
+        now = time.time()
+        lastUpdated = time.strftime(timestampFormat, time.localtime(now))
+
+        def draw():
+            renders.inc()
+            return Frame(renderer.renderFrame(
+                data, self.legend.description(data.steps[0].symbol1h),
+                lastUpdated, stale))
+
+        frame = self.frames.get(
+            (location.url, layout, version, lastUpdated), draw)
+        # lastUpdated is local time, so it changes on the local clock
+        changes = min(scheduler.nextLocalBoundary(now, interval),
+                      max(location.expires, now))
+        return frame, int(changes - now)
+
+
+def _etagMatches(ifNoneMatch, etag):
+    """Whether an If-None-Match header value matches etag.
+
+    The value is * or a comma separated list of ETags. The comparison is
+    the weak one If-None-Match uses, so W/ in front of a tag is ignored.
+    """
+    for tag in ifNoneMatch.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == '*' or tag == etag:
+            return True
+    return False
+
+
+def _parseQuery(query):
+    """(latitude, longitude, layout, format) from the query string."""
+    fields = urllib.parse.parse_qs(query)
+
+    def field(name, default=None):
+        values = fields.get(name)
+        if not values:
+            if default is None:
+                raise ValueError('{} is missing'.format(name))
+            return default
+        return values[0]
+
+    latitude = float(field('lat'))
+    longitude = float(field('lon'))
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        raise ValueError('No such place')
+    layout = field('layout', DEFAULT_LAYOUT)
+    if layout not in LAYOUTS:
+        raise ValueError('layout must be one of {}'.format(
+            ', '.join(LAYOUTS)))
+    format = field('format', 'raw')
+    if format not in ('raw', 'png'):
+        raise ValueError('format must be raw or png')
+    return latitude, longitude, layout, format
+
+
+class FrameHandler(http.server.BaseHTTPRequestHandler):
+    # Kept-alive connections, so pollers don't reconnect every time
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path == '/frame':
+            self.sendFrame(url.query)
+        elif url.path == '/metrics':
+            self.send(200, metrics.REGISTRY.render().encode(),
+                      {'Content-Type':
+                       'text/plain; version=0.0.4; charset=utf-8'})
+        else:
+            self.send(404, b'Not found\n')
+
+    def sendFrame(self, query):
+        format = 'raw'
+        try:
+            latitude, longitude, layout, format = _parseQuery(query)
+            frame, maxAge = self.server.service.frame(latitude, longitude,
+                                                      layout)
+        except ValueError as e:
+            status = self.send(400, '{}\n'.format(e).encode())
+        except (TooManyLocations, metapi.RetryLater) as e:
+            retryAfter = int(max(getattr(e, 'retryAt', 0) - time.time(), 60))
+            status = self.send(503, '{}\n'.format(e).encode(),
+                               {'Retry-After': str(retryAfter)})
+        except Exception as e:
+            print('Could not serve {}: {!r}'.format(self.path, e))
+            status = self.send(500, b'Could not draw the frame\n')
+        else:
+            etag = frame.etag if format == 'raw' else frame.pngEtag
+            headers = {'ETag': etag,
+                       'Cache-Control': 'max-age={}'.format(maxAge)}
+            if _etagMatches(self.headers.get('If-None-Match', ''), etag):
+                status = self.send(304, b'', headers)
+            elif format == 'raw':
+                headers['Content-Type'] = 'application/octet-stream'
+                status = self.send(200, frame.buffer, headers)
+            else:
+                headers['Content-Type'] = 'image/png'
+                status = self.send(200, frame.png(), headers)
+        frameRequests.inc(format=format, status=status)
+
+    def send(self, status, body, headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        if status != 304:
+            if 'Content-Type' not in (headers or {}):
+                self.send_header('Content-Type', 'text/plain; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        return status
+
+    def log_message(self, format, *args):
+        pass
+
+
+class RenderServer(http.server.ThreadingHTTPServer):
+    request_queue_size = LISTEN_BACKLOG
+    daemon_threads = True
+
+    def __init__(self, address, service):
+        super().__init__(address, FrameHandler)
+        self.service = service
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--address', default='',
+                        help='address to listen on (default: all)')
+    args = parser.parse_args()
+    service = RenderService()
+    renderer.icons.validate(service.legend.symbolCodes())
+    server = RenderServer((args.address, args.port), service)
+    print('Serving frames on port {}'.format(server.server_address[1]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,361 @@
+"""Replays recorded and made-up forecasts through the whole display.
+
+Drawing a frame normally needs the MET API and the panel. This replays
+a corpus of forecasts instead, through every stage weather_display.py
+runs: parsing, drawing, turning and packing, and the transfer to the
+panel, here the simulated one in epdsim.py. The corpus is
+
+* forecasts recorded from the API (with the legend at the time) by
+  `replay.py record NAME`, kept in corpus/recorded/,
+* made-up ones covering what is awkward to draw: -10 degrees and
+  below, every weather symbol, more rain than the chart has room for,
+  a stale forecast, gales. These are generated from CASES, so they
+  don't need storing.
+
+Every frame is compared with its golden copy in corpus/golden/, so a
+change meant to make things faster can be shown to draw exactly the
+same pixels:
+
+    python3 replay.py check             # exits 1 if any frame differs
+    python3 replay.py check --save out  # PNGs of the frames, to look at
+    python3 replay.py bless             # after a change meant to show
+    python3 replay.py bench             # frames/s and latency per stage
+
+The golden frames are for the layout settings renderer.py comes with.
+"""
+
+
+import argparse
+import contextlib
+import glob
+import gzip
+import io
+import json
+import math
+import os
+import sys
+import time
+import epd2in7
+import epdif
+import epdsim
+import forecast
+import metapi
+import renderer
+
+
+CORPUS_DIR = 'corpus'
+# What every frame shows as the time it was drawn, so they can be compared
+LAST_UPDATED = '18.10.26 10:00'
+# Made-up forecasts start at this unix time (2026-10-18 10:00 UTC) and have
+# an entry an hour for this many hours.
+SYNTHETIC_START = 1792317600
+SYNTHETIC_HOURS = 60
+# (amount, most that could come) of rain for each hour, repeated
+RAIN_PATTERN = [(0.0, 0.0), (0.1, 0.3), (0.4, 0.9), (1.2, 2.0), (2.5, 3.6),
+                (0.8, 1.5), (0.0, 0.2), (0.0, 0.0), (0.3, 0.6), (3.9, 5.2),
+                (1.1, 1.8), (0.0, 0.1)]
+# name -> what it changes in syntheticForecast's arguments; a 'stale' key
+# draws the forecast as stale. 'symbol-' cases for every code in the
+# bundled legend are added to these.
+CASES = {
+    'mild': {},
+    'frost-single-digit': {'temperature': -9.4},
+    'frost-ten': {'temperature': -10.0},
+    'frost-deep': {'temperature': -25.3},
+    'warm-single-digit': {'temperature': 9.9},
+    'warm-ten': {'temperature': 10.0},
+    'heat': {'temperature': 35.2},
+    'dry': {'rain': [(0.0, 0.0)], 'probability': 0.0},
+    'rain-max': {'rain': [(9.0, 15.0)], 'probability': 100.0},
+    'rain-uncertain': {'rain': [(0.2, 15.0), (15.0, 15.0)]},
+    'gale': {'wind': (33.5, 45.2)},
+    'stale': {'stale': True},
+}
+STAGES = ('parse', 'draw', 'pack', 'transfer')
+
+
+def _isoTime(unixTime):
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(unixTime))
+
+
+def syntheticForecast(temperature=4.6, symbols=('cloudy', 'rain',
+                                                'partlycloudy_day'),
+                      rain=RAIN_PATTERN, probability=35.0, wind=(5.1, 9.8)):
+    """A locationforecast document, as the API sends it.
+
+    temperature is the temperature now, symbols the codes for the next
+    hour, 6 and 12 hours, rain (amount, maximum) for each hour in turn,
+    repeated as need be, probability the chance of rain (%) and wind
+    the speed and gusts (m/s).
+    """
+    timeseries = []
+    for hour in range(SYNTHETIC_HOURS):
+        amounts = [rain[(hour + i) % len(rain)] for i in range(6)]
+        timeseries.append({
+            'time': _isoTime(SYNTHETIC_START + hour * 3600),
+            'data': {
+                'instant': {'details': {
+                    'air_temperature': round(
+                        temperature + 3 * math.sin(hour / 4), 1),
+                    'wind_speed': wind[0],
+                    'wind_speed_of_gust': wind[1],
+                }},
+                'next_1_hours': {
+                    'summary': {'symbol_code': symbols[0]},
+                    'details': {
+                        'precipitation_amount': amounts[0][0],
+                        'precipitation_amount_max': amounts[0][1],
+                        'probability_of_precipitation': probability,
+                    },
+                },
+                'next_6_hours': {
+                    'summary': {'symbol_code': symbols[1]},
+                    'details': {
+                        'air_temperature_max': round(temperature + 2.5, 1),
+                        'precipitation_amount': round(
+                            sum(amount for amount, _ in amounts), 1),
+                        'precipitation_amount_max': round(
+                            sum(maximum for _, maximum in amounts), 1),
+                    },
+                },
+                'next_12_hours': {
+                    'summary': {'symbol_code': symbols[2]},
+                },
+            },
+        })
+    return {
+        'type': 'Feature',
+        'properties': {
+            'meta': {'updated_at': _isoTime(SYNTHETIC_START - 1800)},
+            'timeseries': timeseries,
+        },
+    }
+
+
+class Case:
+    """A forecast to replay: the body the API sent and the legend to use."""
+
+    def __init__(self, name, body, legend, stale=False):
+        self.name = name
+        self.body = body
+        self.legend = legend
+        self.stale = stale
+
+    @property
+    def goldenPath(self):
+        return os.path.join(CORPUS_DIR, 'golden', self.name + '.fb.gz')
+
+    def golden(self):
+        """The frame this case should come out as, or None."""
+        try:
+            with gzip.open(self.goldenPath) as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def bless(self, frame):
+        os.makedirs(os.path.dirname(self.goldenPath), exist_ok=True)
+        with open(self.goldenPath, 'wb') as f:
+            f.write(gzip.compress(frame, mtime=0))
+
+
+def syntheticCases():
+    legend = metapi.Legend.fromFile(metapi.BUNDLED_LEGEND)
+    codes = legend.symbolCodes()
+    cases = dict(CASES)
+    # Each code as the big symbol once and as both small ones
+    for i, code in enumerate(codes):
+        cases['symbol-' + code] = {'symbols': (
+            code, codes[(i + 1) % len(codes)], codes[(i + 2) % len(codes)])}
+    for name, changes in cases.items():
+        changes = dict(changes)
+        stale = changes.pop('stale', False)
+        body = json.dumps(syntheticForecast(**changes)).encode()
+        yield Case(name, body, legend, stale)
+
+
+def recordedCases():
+    directory = os.path.join(CORPUS_DIR, 'recorded')
+    legendPath = os.path.join(directory, 'legends.json')
+    if not os.path.exists(legendPath):
+        legendPath = metapi.BUNDLED_LEGEND
+    legend = metapi.Legend.fromFile(legendPath)
+    for path in sorted(glob.glob(os.path.join(directory, '*.json'))):
+        if path == legendPath:
+            continue
+        name = os.path.splitext(os.path.basename(path))[0]
+        with open(path, 'rb') as f:
+            yield Case('recorded-' + name, f.read(), legend)
+
+
+def allCases(names=None):
+    cases = list(syntheticCases()) + list(recordedCases())
+    if names:
+        known = {case.name for case in cases}
+        unknown = set(names) - known
+        if unknown:
+            raise KeyError('No such cases: {}'.format(
+                ', '.join(sorted(unknown))))
+        cases = [case for case in cases if case.name in names]
+    return cases
+
+
+def record(name, latitude, longitude):
+    """Saves the forecast for a place and the legend to the corpus."""
+    directory = os.path.join(CORPUS_DIR, 'recorded')
+    os.makedirs(directory, exist_ok=True)
+    headers = {'User-Agent': metapi.USER_AGENT}
+    client = metapi.HttpClient()
+    for url, filename in (
+            (metapi.forecastUrl(latitude, longitude,
+                                renderer.FORECAST_PRODUCT), name + '.json'),
+            (metapi.LEGEND_URL, 'legends.json')):
+        with client.get(url, headers) as response:
+            body = response.read()
+        with open(os.path.join(directory, filename), 'wb') as f:
+            f.write(body)
+        print('Recorded {} ({} bytes)'.format(filename, len(body)))
+
+
+class Timings:
+    """Seconds each stage took, every time it ran."""
+
+    def __init__(self):
+        self.seconds = {stage: [] for stage in STAGES}
+
+    @contextlib.contextmanager
+    def time(self, stage):
+        started = time.perf_counter()
+        yield
+        self.seconds[stage].append(time.perf_counter() - started)
+
+    def report(self):
+        print('  {:10} {:>10} {:>10} {:>10}'.format('stage', 'frames/s',
+                                                    'p50 ms', 'p99 ms'))
+        totals = [sum(times) for times in zip(*self.seconds.values())]
+        for stage, seconds in list(self.seconds.items()) + [
+                ('total', totals)]:
+            ordered = sorted(seconds)
+            print('  {:10} {:10.1f} {:10.3f} {:10.3f}'.format(
+                stage, len(ordered) / sum(ordered),
+                ordered[len(ordered) // 2] * 1000,
+                ordered[min(len(ordered) * 99 // 100, len(ordered) - 1)]
+                * 1000))
+
+
+class Replayer:
+    """Runs cases through the stages, on a simulated panel."""
+
+    def __init__(self):
+        self.panel = epdsim.SimulatedPanel(record=False, image_path=None)
+        previous = epdif.set_backend(self.panel)
+        try:
+            self.epd = epd2in7.EPD()
+            self.epd.init()
+        finally:
+            epdif.set_backend(previous)
+        self.timings = Timings()
+
+    def replay(self, case):
+        """Returns the frame case comes out as."""
+        timings = self.timings
+        with timings.time('parse'):
+            data = forecast.read(io.BytesIO(case.body),
+                                 renderer.FORECAST_STEPS)
+        with timings.time('draw'):
+            mask = renderer.drawFrame(
+                data, case.legend.description(data.steps[0].symbol1h),
+                LAST_UPDATED, case.stale)
+        with timings.time('pack'):
+            frame = renderer.packFrame(mask)
+        previous = epdif.set_backend(self.panel)
+        try:
+            with timings.time('transfer'):
+                self.epd.display_frame(frame)
+        finally:
+            epdif.set_backend(previous)
+        if bytes(self.panel.screen) != frame or self.panel.errors:
+            raise AssertionError('{}: the panel shows something else: {}'
+                                 .format(case.name, self.panel.errors))
+        return frame
+
+
+def differentPixels(frame, other):
+    return bin(int.from_bytes(frame, 'big') ^
+               int.from_bytes(other, 'big')).count('1')
+
+
+def check(cases, save=None):
+    """Replays cases against their golden frames, True if all match."""
+    replayer = Replayer()
+    failed = 0
+    for case in cases:
+        frame = replayer.replay(case)
+        golden = case.golden()
+        if save:
+            os.makedirs(save, exist_ok=True)
+            renderer.frameImage(frame).save(
+                os.path.join(save, case.name + '.png'))
+        if golden is None:
+            print('{}: no golden frame'.format(case.name))
+            failed += 1
+        elif frame != golden:
+            print('{}: {} pixels differ'.format(
+                case.name, differentPixels(frame, golden)))
+            if save:
+                renderer.frameImage(golden).save(
+                    os.path.join(save, case.name + '.golden.png'))
+            failed += 1
+    print('{} of {} frames as they should be'.format(len(cases) - failed,
+                                                    len(cases)))
+    return failed == 0
+
+
+def bless(cases):
+    replayer = Replayer()
+    for case in cases:
+        case.bless(replayer.replay(case))
+    print('Saved {} golden frames'.format(len(cases)))
+
+
+def bench(cases, repeat):
+    replayer = Replayer()
+    # Once to load fonts and cache text, as a running display has
+    for case in cases:
+        replayer.replay(case)
+    replayer.timings = Timings()
+    for _ in range(repeat):
+        for case in cases:
+            replayer.replay(case)
+    print('Replay ({} cases, {} times):'.format(len(cases), repeat))
+    replayer.timings.report()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+    recordCommand = commands.add_parser(
+        'record', help='add the forecast for a place to the corpus')
+    recordCommand.add_argument('name')
+    recordCommand.add_argument('--latitude', type=float, default=58.8474)
+    recordCommand.add_argument('--longitude', type=float, default=5.7166)
+    checkCommand = commands.add_parser(
+        'check', help='compare frames with the golden ones')
+    checkCommand.add_argument('--save', metavar='DIR',
+                              help='save the frames as PNGs here')
+    blessCommand = commands.add_parser(
+        'bless', help='make the frames drawn now the golden ones')
+    benchCommand = commands.add_parser(
+        'bench', help='time every stage')
+    benchCommand.add_argument('--repeat', type=int, default=5)
+    for command in (checkCommand, blessCommand, benchCommand):
+        command.add_argument('cases', nargs='*', help='default: all')
+    args = parser.parse_args()
+    if args.command == 'record':
+        record(args.name, args.latitude, args.longitude)
+    elif args.command == 'check':
+        sys.exit(0 if check(allCases(args.cases), args.save) else 1)
+    elif args.command == 'bless':
+        bless(allCases(args.cases))
+    else:
+        bench(allCases(args.cases), args.repeat)
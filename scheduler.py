@@ -0,0 +1,175 @@
+"""Event loop that keeps the forecast, the picture and the display current.
+
+Fetching and drawing used to run one after the other, followed by a
+fixed sleep, so a slow download held up the display and the panel's
+seconds-long refresh held up the next download. The Scheduler runs them
+as separate asyncio tasks instead:
+
+* the fetcher asks for a new forecast when the current one expires and
+  tells the drawer when it changed,
+* the drawer redraws when told, and otherwise on the clock, at whole
+  multiples of redrawInterval in local time (every 10 minutes on the
+  minute, say, or every hour on the hour in any time zone) so the time
+  on screen doesn't drift. The first frame waits for the first
+  fetch, or only firstDrawDelay seconds when there is already something
+  (say a cached forecast) to draw.
+
+The blocking parts run in executor threads, the panel in a thread of its
+own since SPI and GPIO must not be used from two threads at once, so the
+next forecast can download while the panel is refreshing. Every step has
+a timeout. A step that times out is reported and left to finish in its
+thread, and is not started again until it has, so a stuck download or
+panel can't freeze the rest.
+"""
+
+
+import asyncio
+import concurrent.futures
+import time
+
+
+def nextBoundary(now, interval):
+    """The first whole multiple of interval seconds after unix time now."""
+    return (now // interval + 1) * interval
+
+
+def nextLocalBoundary(now, interval):
+    """nextBoundary on the local clock: the unix time after now when the
+    local time is next a whole multiple of interval seconds, e.g. the
+    next local hour. Differs from nextBoundary in time zones that are not
+    a whole number of intervals from UTC."""
+    offset = time.localtime(now).tm_gmtoff
+    boundary = nextBoundary(now + offset, interval) - offset
+    # The offset changes if summer time starts or ends before then
+    changed = time.localtime(boundary).tm_gmtoff
+    if changed != offset:
+        boundary = max(nextBoundary(now + changed, interval) - changed,
+                       now + 1)
+    return boundary
+
+
+class Scheduler:
+    """Runs fetch, render and display on an asyncio event loop.
+
+    fetch() returns (changed, nextFetch): whether there is a new
+    forecast to draw and the unix time worth fetching again at.
+    render() returns a frame, or None if there is nothing to draw yet,
+    and display(frame) puts it on the panel. onError(exception, step) is
+    called with anything they raise, step being 'fetch', 'render' or
+    'display'. A fetch that fails with an exception that has a retryAt
+    attribute (metapi.RetryLater) is tried again at that unix time,
+    otherwise after retryInterval seconds.
+    """
+
+    def __init__(self, fetch, render, display, onError,
+                 redrawInterval=600, minFetchInterval=60, retryInterval=60,
+                 fetchTimeout=90, renderTimeout=30, displayTimeout=60,
+                 firstDrawDelay=None):
+        self.fetch = fetch
+        self.render = render
+        self.display = display
+        self.onError = onError
+        self.redrawInterval = redrawInterval
+        self.minFetchInterval = minFetchInterval
+        self.retryInterval = retryInterval
+        self.fetchTimeout = fetchTimeout
+        self.renderTimeout = renderTimeout
+        self.displayTimeout = displayTimeout
+        self.firstDrawDelay = firstDrawDelay
+        self._redraw = None
+        self._fetched = None
+        self._running = {}
+        self._panel = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='panel')
+
+    async def _call(self, step, executor, timeout, function, *args):
+        """Runs function in executor, or raises TimeoutError.
+
+        Returns None without calling it if the last call for this step
+        is still running after timing out.
+        """
+        running = self._running.get(step)
+        if running is not None and not running.done():
+            self.onError(TimeoutError(
+                '{} is still stuck from a previous run'.format(step)), step)
+            return None
+        future = asyncio.get_running_loop().run_in_executor(
+            executor, function, *args)
+        self._running[step] = future
+        try:
+            # shield: on timeout stop waiting but leave the future alone, so
+            # the stuck check above can still see whether it finished.
+            return await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError('{} took longer than {} s'.format(
+                step, timeout)) from None
+
+    async def _sleepUntil(self, when, event=None):
+        """Sleeps until unix time when, or until event is set."""
+        delay = max(when - time.time(), 0)
+        if event is None:
+            await asyncio.sleep(delay)
+            return
+        try:
+            await asyncio.wait_for(event.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+
+    async def fetchForever(self):
+        while True:
+            started = time.time()
+            result = None
+            retryAt = None
+            try:
+                result = await self._call('fetch', None, self.fetchTimeout,
+                                          self.fetch)
+            except Exception as e:
+                self.onError(e, 'fetch')
+                retryAt = getattr(e, 'retryAt', None)
+            if result is None:
+                nextFetch = retryAt or time.time() + self.retryInterval
+            else:
+                changed, nextFetch = result
+                if changed:
+                    self._redraw.set()
+            self._fetched.set()
+            await self._sleepUntil(
+                max(nextFetch, started + self.minFetchInterval))
+
+    async def drawForever(self):
+        # Draw once the first forecast is in rather than a blank frame
+        if self.firstDrawDelay is None:
+            await self._fetched.wait()
+        else:
+            await self._sleepUntil(time.time() + self.firstDrawDelay,
+                                   self._fetched)
+        while True:
+            self._redraw.clear()
+            step = 'render'
+            try:
+                frame = await self._call('render', None, self.renderTimeout,
+                                         self.render)
+                if frame is not None:
+                    step = 'display'
+                    await self._call('display', self._panel,
+                                     self.displayTimeout, self.display, frame)
+            except Exception as e:
+                self.onError(e, step)
+            await self._sleepUntil(
+                nextLocalBoundary(time.time(), self.redrawInterval),
+                self._redraw)
+
+    async def run(self):
+        """Runs until cancelled, then waits for the panel to finish."""
+        self._redraw = asyncio.Event()
+        self._fetched = asyncio.Event()
+        tasks = [asyncio.ensure_future(self.fetchForever()),
+                 asyncio.ensure_future(self.drawForever())]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            # Don't cut a refresh off halfway
+            self._panel.shutdown(wait=True)
@@ -0,0 +1,115 @@
+"""Tests for the display driver, run against the simulated panel.
+
+    python3 -m pytest
+"""
+
+
+import random
+import pytest
+from PIL import Image
+import epd2in7
+import epdif
+import epdsim
+import panels
+
+
+@pytest.fixture
+def panel():
+    panel = epdsim.SimulatedPanel(record=False, image_path=None)
+    previous = epdif.set_backend(panel)
+    yield panel
+    epdif.set_backend(previous)
+
+
+def narrow_profile(width=122, height=250):
+    """The 2.7 inch profile at a width that is not a multiple of 8."""
+    panel = panels.PANEL_2IN7
+    return panels.PanelProfile(
+        'narrow', width, height, panel.commands,
+        [register[:2] for register in panel.powerOnRegisters],
+        [register[:2] for register in panel.registers],
+        [register[:2] for register in panel.luts])
+
+
+def noise(size):
+    image = Image.new('1', size)
+    image.putdata([random.choice((0, 255))
+                   for _ in range(size[0] * size[1])])
+    return image
+
+
+def frame(*changed):
+    """A white frame buffer with the bytes at the given offsets black."""
+    buffer = bytearray(b'\xFF' * (epd2in7.EPD_WIDTH * epd2in7.EPD_HEIGHT // 8))
+    for offset in changed:
+        buffer[offset] = 0x00
+    return bytes(buffer)
+
+
+def test_same_frame_is_not_refreshed_without_partial_refreshes(panel):
+    epd = epd2in7.EPD(full_refresh_interval=0)
+    assert epd.update_frame(frame(10)) == 'full'
+    assert epd.update_frame(frame(10)) == 'none'
+    assert panel.refreshes == {'full': 1, 'partial': 0}
+    assert epd.update_frame(frame(20)) == 'full'
+
+
+def test_same_frame_is_not_refreshed_once_partial_budget_is_used(panel):
+    epd = epd2in7.EPD(full_refresh_interval=2)
+    assert epd.update_frame(frame()) == 'full'
+    assert epd.update_frame(frame(10)) == 'partial'
+    assert epd.update_frame(frame(20)) == 'partial'
+    # The budget is used up: the same frame again still costs nothing,
+    # a changed one gets the full refresh that clears the ghosting.
+    assert epd.update_frame(frame(20)) == 'none'
+    assert panel.refreshes == {'full': 1, 'partial': 2}
+    assert epd.update_frame(frame(30)) == 'full'
+    assert panel.screen == frame(30)
+
+
+@pytest.mark.parametrize('orientation', epd2in7.ORIENTATIONS)
+def test_frame_buffer_round_trip_with_width_not_multiple_of_8(orientation):
+    epd = epd2in7.EPD(orientation=orientation, profile=narrow_profile())
+    image = noise(epd.image_size())
+    frame_buffer = epd.get_frame_buffer(image)
+    assert len(frame_buffer) == epd.profile.frameBytes == 16 * 250
+    assert epd.get_image(frame_buffer).tobytes() == image.tobytes()
+
+
+def test_panel_with_width_not_multiple_of_8_shows_the_image(panel):
+    profile = narrow_profile()
+    narrow = epdsim.SimulatedPanel(profile.width, profile.height,
+                                   record=False, image_path=None)
+    epdif.set_backend(narrow)
+    epd = epd2in7.EPD(profile=profile)
+    image = noise(epd.image_size())
+    assert epd.update_frame(epd.get_frame_buffer(image)) == 'full'
+    assert narrow.image().tobytes() == image.tobytes()
+    changed = image.copy()
+    changed.paste(0, (100, 40, 122, 60))
+    assert epd.update_frame(epd.get_frame_buffer(changed)) == 'partial'
+    assert narrow.image().tobytes() == changed.tobytes()
+    assert not narrow.errors
+
+
+def test_changes_far_apart_share_one_partial_refresh(panel):
+    epd = epd2in7.EPD()
+    epd.update_frame(frame())
+    full_seconds = epd.frame_stats.refresh_seconds
+    # A row near the top and one near the bottom, 22 bytes a row
+    assert epd.update_frame(frame(22 * 10, 22 * 20 + 5, 22 * 30)) == 'partial'
+    assert panel.refreshes == {'full': 1, 'partial': 1}
+    assert epd.frame_stats.windows == 1
+    assert epd.frame_stats.refresh_seconds <= full_seconds
+    assert panel.screen == frame(22 * 10, 22 * 20 + 5, 22 * 30)
+
+
+def test_nothing_is_diffed_when_a_full_refresh_is_forced(panel, monkeypatch):
+    epd = epd2in7.EPD(full_refresh_interval=0)
+    epd.update_frame(frame())
+
+    def dirty_rectangles(*args):
+        raise AssertionError('diffed frames for a full refresh')
+
+    monkeypatch.setattr(epd2in7, 'dirty_rectangles', dirty_rectangles)
+    assert epd.update_frame(frame(10)) == 'full'
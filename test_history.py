@@ -0,0 +1,107 @@
+"""Tests for the forecast history file.
+
+    python3 -m pytest
+"""
+
+
+import os
+import time
+import pytest
+import forecast
+import history
+
+
+# 2027-01-15 00:00 UTC
+DAY = 1800000000 - 1800000000 % 86400
+HOUR = 3600
+
+
+def make_forecast(issued, hours=3, temperature=0.0):
+    """A forecast issued at issued for the next hours whole hours.
+
+    The temperature of each step is temperature plus its hour, so tests
+    can tell forecasts apart by their values.
+    """
+    steps = []
+    for hour in range(1, hours + 1):
+        step = forecast.ForecastStep()
+        for name in forecast.FIELDS:
+            setattr(step, name, None)
+        step.time = issued - issued % HOUR + hour * HOUR
+        step.airTemperature = temperature + hour
+        step.symbol1h = 'rain' if hour % 2 else 'fair_day'
+        steps.append(step)
+    return forecast.Forecast(
+        time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(issued)), steps)
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'history.bin')
+
+
+def size(records):
+    return history.HEADER_SIZE + records * history.RECORD_SIZE
+
+
+def test_record_cut_short_is_dropped_on_open(path):
+    with history.History(path) as store:
+        store.append(make_forecast(DAY))
+    with open(path, 'ab') as f:
+        f.write(b'\x00' * (history.RECORD_SIZE - 1))
+    with history.History(path) as store:
+        assert len(store) == 3
+        assert os.path.getsize(path) == size(3)
+        assert store.append(make_forecast(DAY + HOUR)) == 3
+        assert [record.issued for record in store.issuedBetween(0, 2 ** 32)
+                ] == [DAY] * 3 + [DAY + HOUR] * 3
+
+
+def test_append_stores_each_issued_forecast_once(path):
+    with history.History(path) as store:
+        assert store.append(make_forecast(DAY)) == 3
+        assert store.append(make_forecast(DAY)) == 0
+        assert store.append(make_forecast(DAY - HOUR)) == 0
+        assert len(store) == 3
+        assert store.append(make_forecast(DAY + 1800)) == 3
+        assert (store.firstIssued(), store.lastIssued()) == (DAY,
+                                                             DAY + 1800)
+
+
+def test_valid_between_and_observed(path):
+    with history.History(path) as store:
+        # Issued on the hour for the three hours after it, the
+        # temperatures telling the forecasts apart
+        for index in range(3):
+            store.append(make_forecast(DAY + index * HOUR,
+                                       temperature=index * 10))
+        records = store.validBetween(DAY + 2 * HOUR, DAY + 4 * HOUR)
+        assert [(record.issued - DAY, record.time - DAY)
+                for record in records] == [
+            (0, 2 * HOUR), (0, 3 * HOUR),
+            (HOUR, 2 * HOUR), (HOUR, 3 * HOUR),
+            (2 * HOUR, 3 * HOUR)]
+        observed = store.observed(DAY + HOUR, DAY + 4 * HOUR)
+        assert [(record.time - DAY, record.lead, record.airTemperature)
+                for record in observed] == [
+            (HOUR, HOUR, 1.0), (2 * HOUR, HOUR, 11.0),
+            (3 * HOUR, HOUR, 21.0)]
+        assert observed[0].symbol1h == 'rain'
+        assert observed[0].windSpeed is None
+
+
+def test_prune_and_expire_rewrite_the_file(path):
+    with history.History(path) as store:
+        for day in range(5):
+            store.append(make_forecast(DAY + day * 86400))
+        # Pruned at most once a day: nothing is a day past the 3 kept
+        assert store.expire(3, now=DAY + 4 * 86400) == 0
+        assert store.expire(3, now=DAY + 5 * 86400) == 6
+        assert store.firstIssued() == DAY + 2 * 86400
+        assert os.path.getsize(path) == size(9)
+        assert store.prune(DAY + 4 * 86400) == 6
+        assert store.append(make_forecast(DAY + 5 * 86400)) == 3
+    with history.History(path) as store:
+        assert [record.issued - DAY for record in store.issuedBetween(
+            0, 2 ** 32)] == [4 * 86400] * 3 + [5 * 86400] * 3
+        assert store.validBetween(DAY, DAY + 4 * 86400) == []
@@ -0,0 +1,211 @@
+"""Tests for the response cache and HTTP client, against a local server.
+
+    python3 -m pytest
+"""
+
+
+import email.utils
+import gzip
+import http.server
+import threading
+import time
+import pytest
+import metapi
+
+
+NOW = 1800000000
+BODY = b'{"properties": {"timeseries": []}}' * 100
+
+
+class Server:
+    """A stand-in for api.met.no answering with the replies it is given.
+
+    replies is a list of (status, headers, body), one per request. Every
+    request is recorded in requests as (headers, client port), the port
+    telling which connection it came on.
+    """
+
+    def __init__(self):
+        self.replies = []
+        self.requests = []
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                server.requests.append((dict(self.headers),
+                                        self.client_address[1]))
+                status, headers, body = server.replies.pop(0)
+                self.send_response(status)
+                for name, value in headers.items():
+                    if name == 'Connection' and value == 'drop':
+                        # Closed after this response without saying so,
+                        # like a server dropping an idle connection
+                        self.close_connection = True
+                        continue
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                                     Handler)
+        self.url = 'http://127.0.0.1:{}/weatherapi/locationforecast'.format(
+            self.httpd.server_port)
+        threading.Thread(target=self.httpd.serve_forever, args=(0.05,),
+                         daemon=True).start()
+
+    def reply(self, status, body=b'', **headers):
+        self.replies.append((status, {name.replace('_', '-'): value
+                                      for name, value in headers.items()},
+                             body))
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def server():
+    server = Server()
+    yield server
+    server.close()
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """time.time() stands still at clock[0] until a test moves it."""
+    clock = [NOW]
+    monkeypatch.setattr(time, 'time', lambda: clock[0])
+    return clock
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return metapi.ResponseCache(str(tmp_path), metapi.HttpClient(timeout=5),
+                                metapi.Backoff(1, 1))
+
+
+def http_date(when):
+    return email.utils.formatdate(when, usegmt=True)
+
+
+def test_not_modified_reuses_the_cached_body(server, clock, cache):
+    lastModified = http_date(NOW - 60)
+    server.reply(200, BODY, Last_Modified=lastModified,
+                 Expires=http_date(NOW))
+    server.reply(304, Expires=http_date(NOW + 600))
+    first = cache.fetch(server.url)
+    assert (first.status, first.modified) == ('downloaded', True)
+    second = cache.fetch(server.url)
+    assert (second.status, second.modified) == ('not_modified', False)
+    assert second.read() == BODY
+    assert second.lastModified == lastModified
+    assert second.expires == NOW + 600
+    assert 'If-Modified-Since' not in server.requests[0][0]
+    assert server.requests[1][0]['If-Modified-Since'] == lastModified
+
+
+def test_nothing_is_sent_until_the_copy_expires(server, clock, cache):
+    server.reply(200, BODY, Expires=http_date(NOW + 600))
+    server.reply(200, BODY)
+    assert cache.fetch(server.url).expires == NOW + 600
+    clock[0] = NOW + 599
+    assert cache.fetch(server.url).status == 'cached'
+    assert len(server.requests) == 1
+    clock[0] = NOW + 600
+    response = cache.fetch(server.url)
+    assert response.status == 'downloaded'
+    # Without an Expires header the copy is good for DEFAULT_TTL
+    assert response.expires == NOW + 600 + metapi.DEFAULT_TTL
+    assert len(server.requests) == 2
+
+
+def test_gzip_body_is_stored_decompressed(server, clock, cache):
+    compressed = gzip.compress(BODY)
+    server.reply(200, compressed, Content_Encoding='gzip')
+    response = cache.fetch(server.url)
+    assert server.requests[0][0]['Accept-Encoding'] == 'gzip'
+    assert response.read() == BODY
+    assert response.downloaded == len(BODY)
+    assert len(compressed) < response.wireBytes < len(BODY)
+
+
+def test_connections_are_kept_alive_and_replaced_once_dropped(server):
+    client = metapi.HttpClient(timeout=5)
+    server.reply(200, BODY)
+    server.reply(200, BODY, Connection='drop')
+    server.reply(200, BODY)
+    for _ in range(3):
+        with client.get(server.url) as response:
+            assert response.read() == BODY
+    ports = [port for _, port in server.requests]
+    assert ports[0] == ports[1] != ports[2]
+    assert client.connectionsOpened == 2
+    assert client.requests == 3
+
+
+def test_downloaded_then_not_modified_then_too_many_requests(server, clock,
+                                                             cache):
+    server.reply(200, BODY, Last_Modified=http_date(NOW - 60),
+                 Expires=http_date(NOW))
+    server.reply(304, Expires=http_date(NOW))
+    server.reply(429, Retry_After='60')
+    responses = [cache.fetch(server.url) for _ in range(3)]
+    assert [response.status for response in responses] == [
+        'downloaded', 'not_modified', 'stale']
+    assert responses[2].error.code == 429
+    assert responses[2].read() == BODY
+    assert len(server.requests) == 3
+
+
+def test_failed_request_falls_back_to_the_cached_copy(server, clock, cache):
+    server.reply(200, BODY, Expires=http_date(NOW))
+    server.reply(500)
+    cache.fetch(server.url)
+    response = cache.fetch(server.url)
+    assert response.stale and not response.modified
+    assert response.error.code == 500
+    assert response.read() == BODY
+    # Worth trying again once the backoff is over
+    assert NOW < response.expires <= NOW + 1
+
+
+def test_failed_request_without_a_copy_raises_retry_later(server, clock,
+                                                          cache):
+    server.reply(503)
+    with pytest.raises(metapi.RetryLater) as raised:
+        cache.fetch(server.url)
+    assert raised.value.cause.code == 503
+    assert NOW < raised.value.retryAt <= NOW + 1
+    # Asking again before retryAt raises again without a request
+    with pytest.raises(metapi.RetryLater):
+        cache.fetch(server.url)
+    assert len(server.requests) == 1
+
+
+@pytest.mark.parametrize('retryAfter', ['300', http_date(NOW + 300)])
+def test_retry_after_is_honoured(server, clock, cache, retryAfter):
+    server.reply(429, Retry_After=retryAfter)
+    with pytest.raises(metapi.RetryLater) as raised:
+        cache.fetch(server.url)
+    assert raised.value.retryAt == NOW + 300
+
+
+def test_nothing_is_sent_before_retry_at(server, clock, cache):
+    server.reply(200, BODY, Expires=http_date(NOW))
+    server.reply(429, Retry_After='300')
+    server.reply(200, BODY)
+    cache.fetch(server.url)
+    assert cache.fetch(server.url).expires == NOW + 300
+    clock[0] = NOW + 299
+    response = cache.fetch(server.url)
+    assert response.stale and response.expires == NOW + 300
+    assert len(server.requests) == 2
+    clock[0] = NOW + 300
+    assert cache.fetch(server.url).status == 'downloaded'
+    assert len(server.requests) == 3
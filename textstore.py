@@ -0,0 +1,83 @@
+"""Text for the weather display, rendered once and pasted after that.
+
+Most of what the display writes comes from a small set: temperatures,
+wind speeds, the 40-odd weather descriptions and a timestamp that
+changes once a minute. TextStore keeps each piece of text it has drawn
+as a 1-bit bitmap, keyed by font size, wrap width and text, so drawing
+it again is a paste instead of rasterising the glyphs (and wrapping the
+lines) anew. The least recently used bitmaps are dropped once there are
+more than maxEntries.
+
+Fonts are opened the first time a size is used, from the FreeArial.ttf
+that comes with the code.
+"""
+
+
+import collections
+import textwrap
+import threading
+from PIL import Image
+from PIL import ImageDraw
+from PIL import ImageFont
+
+
+FONT_PATH = 'FreeArial.ttf'
+MAX_ENTRIES = 512
+
+
+class TextStore:
+    """Rendered text, by (size, wrap, text), and the fonts to render it."""
+
+    def __init__(self, fontPath=FONT_PATH, maxEntries=MAX_ENTRIES):
+        self.fontPath = fontPath
+        self.maxEntries = maxEntries
+        self.hits = 0
+        self.misses = 0
+        self._fonts = {}
+        self._bitmaps = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def font(self, size):
+        """The font at size points, opened on first use."""
+        font = self._fonts.get(size)
+        if font is None:
+            font = self._fonts[size] = ImageFont.truetype(self.fontPath, size)
+        return font
+
+    def _render(self, text, size):
+        font = self.font(size)
+        scratch = ImageDraw.Draw(Image.new('1', (1, 1)))
+        left, top, right, bottom = scratch.textbbox((0, 0), text, font=font)
+        # Ink is 1, so the bitmap can be used as a paste mask directly
+        bitmap = Image.new('1', (max(right - left, 1), max(bottom - top, 1)))
+        ImageDraw.Draw(bitmap).text((-left, -top), text, font=font, fill=1)
+        return bitmap, (left, top)
+
+    def bitmap(self, text, size, wrap=None):
+        """Returns (bitmap, offset) for text, rendering it if need be.
+
+        bitmap is a mode '1' image with the ink set, offset where its
+        top left corner goes relative to the position the text is drawn
+        at. With wrap, the text is first wrapped to lines of that many
+        characters.
+        """
+        key = (size, wrap, text)
+        with self._lock:
+            entry = self._bitmaps.get(key)
+            if entry is not None:
+                self._bitmaps.move_to_end(key)
+                self.hits += 1
+                return entry
+        lines = text if wrap is None else textwrap.fill(text, wrap)
+        entry = self._render(lines, size)
+        with self._lock:
+            self.misses += 1
+            self._bitmaps[key] = entry
+            if len(self._bitmaps) > self.maxEntries:
+                self._bitmaps.popitem(last=False)
+        return entry
+
+    def draw(self, image, position, text, size, wrap=None):
+        """Draws text in black on the mode '1' image, like ImageDraw.text."""
+        bitmap, (left, top) = self.bitmap(text, size, wrap)
+        image.paste(0, (position[0] + left, position[1] + top), bitmap)
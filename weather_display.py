@@ -10,244 +10,300 @@ modified to fit another size.
 
 
 import time
+startTime = time.time()  # Before the other imports, PIL is slow to load
+import asyncio
 import logging
 import os
-import textwrap
 import epd2in7
-from PIL import Image
-from PIL import ImageFont
-from PIL import ImageDraw
-import urllib.request
-import urllib.error
-import urllib.parse
-import json
+import epdif
+import hashlib
+import metapi
+import forecast
+import history
+import metrics
+import renderer
+import scheduler
 
 
 """Need to initialize the display so the
 Waveshare libraries can do their thing. The 2.7 inch display is
 176 x 264 pixels. This code used the display in portait
-mode. It should be possible to render/draw in
-landscape format and rotate the mask before updating
-the frame. But I had a difficult time getting it to
-work, and preferred a portrait set up for my use case.
+mode. The driver can take landscape (264 x 176) pictures
+too: give epd2in7.EPD orientation=90 or 270 and it turns
+them on their side while packing the frame, see
+renderer.ROTATION. The layout in renderer.py is portrait.
+Other Waveshare panels are described in panels.py; set
+renderer.PANEL to one and the layout is scaled to fit it.
 
 If you want to use another font you need to download it
 in .ttf format and place it in the relevant file.
+
+Only the parts of the screen that changed are refreshed, which avoids the
+full black/white flash on quiet weather days. Partial refreshes leave some
+ghosting behind, so every FULL_REFRESH_INTERVAL updates the whole screen
+is refreshed anyway. Set it to 0 to always do a full refresh.
 """
-epd = epd2in7.EPD()
+FULL_REFRESH_INTERVAL = 6
+# How precisely the "last updated" time is shown, 'minute' or 'hour'.
+# Frames that come out identical to the one on screen are not sent to the
+# display at all, but with 'minute' the clock changes on every update.
+TIMESTAMP_RESOLUTION = 'minute'
+TIMESTAMP_FORMATS = {
+    'minute': '%d.%m.%y %H:%M',
+    'hour': '%d.%m.%y %H:00',
+}
+# Your location. api.met.no uses at most 4 decimals.
+LATITUDE = 58.8474
+LONGITUDE = 5.7166
+# The forecast is fetched again once it expires, which MET says in the
+# response, but at most every MIN_UPDATE_INTERVAL seconds. The screen is
+# redrawn when a new forecast comes in, and otherwise on the clock every
+# MAX_UPDATE_INTERVAL seconds (at :00, :10, :20... with 600).
+MIN_UPDATE_INTERVAL = 60
+MAX_UPDATE_INTERVAL = 600
+# When a fetch fails the last forecast stays on screen, marked as stale,
+# and the fetch is retried with a growing delay (see metapi). At startup
+# the cached forecast is shown if a new one takes longer than
+# FIRST_DRAW_DELAY seconds to arrive.
+FIRST_DRAW_DELAY = 10
+# Every new forecast is kept here (None to keep none) for HISTORY_DAYS days,
+# for trends and for comparing forecasts with what came to pass.
+HISTORY_FILE = 'cache/history.bin'
+HISTORY_DAYS = 31
+# Fingerprint of the frame on screen, kept so a restart doesn't force a refresh
+LAST_FRAME_FILE = 'cache/last_frame.sha1'
+# What the display does between refreshes: 'sleep' (deep sleep, the least
+# power, Waveshare recommend not leaving the panel powered), 'off' (only
+# the panel power is off, so it wakes faster) or None (stays on).
+POWER_MODE = 'sleep'
+# Timings and counters in the Prometheus format, written to this file after
+# every update (point node_exporter's textfile collector at it) and/or
+# served over HTTP on this port. None turns either off.
+METRICS_TEXTFILE = None
+METRICS_PORT = None
+# 'spidev' drives the display, 'sim' the simulated one in epdsim.py (set
+# EPD_SIM_IMAGE=screen.png to see what it shows). None uses $EPD_BACKEND,
+# or spidev if that isn't set either.
+EPD_BACKEND = None
+if EPD_BACKEND is not None:
+    epdif.set_backend(EPD_BACKEND)
+epd = epd2in7.EPD(full_refresh_interval=FULL_REFRESH_INTERVAL,
+                  power_mode=POWER_MODE, profile=renderer.panel)
 epd.init()
-EPD_WIDTH = epd2in7.EPD_WIDTH  # 176 pixels
-EPD_HEIGHT = epd2in7.EPD_HEIGHT  # 264 pixels
-# Fonts
-teenytinyfont = ImageFont.truetype(
-    '/usr/share/fonts/truetype/freefont/FreeArial.ttf', 10)
-teenyfont = ImageFont.truetype(
-    '/usr/share/fonts/truetype/freefont/FreeArial.ttf', 12)
-tinyfont = ImageFont.truetype(
-    '/usr/share/fonts/truetype/freefont/FreeArial.ttf', 14)
-smallfont = ImageFont.truetype(
-    '/usr/share/fonts/truetype/freefont/FreeArial.ttf', 18)
-normalfont = ImageFont.truetype(
-    '/usr/share/fonts/truetype/freefont/FreeArial.ttf', 22)
-medfont = ImageFont.truetype(
-    '/usr/share/fonts/truetype/freefont/FreeArial.ttf', 40)
-bigfont = ImageFont.truetype(
-    '/usr/share/fonts/truetype/freefont/FreeArial.ttf', 70)
-
-# data = 0
-# mask = 0
-
-urlLegend = urllib.request.urlopen(
-    'https://api.met.no/weatherapi/weathericon/2.0/legends')
-legendUrl = urlLegend.read()
-legend = json.loads(legendUrl)
+epd.rest()  # Until there is something to show
+stageSeconds = metrics.REGISTRY.histogram(
+    'weather_display_stage_seconds',
+    'Time spent in each stage of an update.', ('stage',))
+forecastRequests = metrics.REGISTRY.counter(
+    'weather_display_forecast_requests_total',
+    'Forecast lookups by result: cached, not_modified, downloaded or '
+    'stale.',
+    ('result',))
+downloadedBytes = metrics.REGISTRY.counter(
+    'weather_display_downloaded_bytes_total',
+    'Forecast bytes downloaded from api.met.no, decompressed.')
+wireBytes = metrics.REGISTRY.counter(
+    'weather_display_wire_bytes_total',
+    'Bytes forecast requests took on the wire, headers included.')
+spiBytes = metrics.REGISTRY.counter(
+    'weather_display_spi_bytes_total',
+    'Bytes sent to the display over SPI.')
+refreshes = metrics.REGISTRY.counter(
+    'weather_display_refreshes_total',
+    'Frames by what was done with them: full, partial, or none/skipped '
+    'when they were already on screen.', ('kind',))
+errors = metrics.REGISTRY.counter(
+    'weather_display_errors_total',
+    'Updates that failed, by the step that failed.', ('step',))
+lastRefresh = metrics.REGISTRY.gauge(
+    'weather_display_last_refresh_timestamp_seconds',
+    'When a frame last went through to the display.')
+
+# (forecast.Forecast, stale), stale being True while it is an old
+# forecast that could not be refreshed. Fetches run in executor threads
+# while frames are drawn, so the two are replaced together, in one
+# assignment, and a frame never pairs a new forecast with an old flag.
+current = (None, False)
+nextUpdate = 0
+forecastCache = metapi.ResponseCache()
+# 'complete' or 'compact', whichever has what the layout draws
+forecastUrl = metapi.forecastUrl(LATITUDE, LONGITUDE,
+                                 renderer.FORECAST_PRODUCT)
+forecastHistory = None if HISTORY_FILE is None else history.History(
+    HISTORY_FILE)
+
+
+def loadLastFrameFingerprint():
+    """Returns the fingerprint of the frame last sent to the display."""
+    try:
+        with open(LAST_FRAME_FILE) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def saveLastFrameFingerprint(fingerprint):
+    os.makedirs(os.path.dirname(LAST_FRAME_FILE), exist_ok=True)
+    with open(LAST_FRAME_FILE + '.tmp', 'w') as f:
+        f.write(fingerprint)
+    os.replace(LAST_FRAME_FILE + '.tmp', LAST_FRAME_FILE)
+
+
+lastFrameFingerprint = loadLastFrameFingerprint()
+
+legend = metapi.Legend(forecastCache)
+renderer.icons.validate(legend.symbolCodes())
 
 
 def updateWeatherUrl():
-    """Opens the json file from www.yr.no
+    """Opens the json file from api.met.no
 
     Opens url and handles the processing of the json.
     Should be called every time you update
     the frame since the information won't be refreshed unless
     the url is updated.
+
+    Goes through the response cache, so the forecast is only downloaded
+    when MET has published a new one and only parsed when it changed.
+    Also notes when the forecast expires, which is when it is worth
+    asking for a new one. If it can't be refreshed the last one is
+    kept, marked stale, until the cache's next retry. Returns True if
+    the forecast (or whether it is stale) changed.
+    """
+    global current, nextUpdate
+    data, stale = current
+    with stageSeconds.time(stage='fetch'):
+        response = forecastCache.fetch(forecastUrl)
+    forecastRequests.inc(result=response.status)
+    downloadedBytes.inc(response.downloaded)
+    wireBytes.inc(response.wireBytes)
+    if response.wireBytes:
+        print('Forecast request: {} ({} bytes on the wire, {} '
+              'decompressed)'.format(response.status, response.wireBytes,
+                                     response.downloaded))
+    nextUpdate = response.expires
+    # A change of staleness changes the frame too
+    changed = response.stale != stale
+    if response.stale:
+        logError(response.error, 'fetch')
+        print('Could not refresh the forecast ({}), trying again at {}'
+              .format(response.error, time.strftime(
+                  '%H:%M:%S', time.localtime(nextUpdate))))
+    if response.modified or data is None:
+        with stageSeconds.time(stage='parse'), response.open() as f:
+            data = forecast.read(f, renderer.FORECAST_STEPS)
+        current = (data, response.stale)
+        print(('{} Weather data URL successfully opened.'
+              .format(data.updatedAt)))
+        recordHistory(data)
+        return True
+    current = (data, response.stale)
+    print(('{} Weather data unchanged, using cached copy.'
+          .format(data.updatedAt)))
+    return changed
+
+
+def loadCachedForecast():
+    """Starts from the forecast in the cache, if there is one.
+
+    That way there is something to show straight away, even if the
+    network is slow or down at startup.
     """
-    # attempts = 1
-    urlReady = False
-    while not urlReady:
-        url = urllib.request.urlopen(
-            'https://api.met.no/weatherapi/locationforecast/2.0/complete?lat=58.8474&lon=5.7166')
-        # Exchange the link above with your location.
-        # Essentially you just replace the latitude and longitude with the location you want.
-        if(url.getcode() == 200):
-            urlReady = True
-            attempts = 1
-            dataUrl = url.read()
-            global data
-            data = json.loads(dataUrl)
-            print(('{} Weather data URL successfully opened.'
-                  .format(data['properties']['meta']['updated_at'])))
-        else:
-            print(('Error retrieving data', url.getcode()))
-            attempts += 1
-            if attempts <= 100:
-                print(('Retrying in 10 seconds.'
-                      ' (Attempt {} of 100)'.format(attempts)))
-                time.sleep(10)
-            elif attempts > 100:
-                raise RuntimeError('Please check your internet connection '
-                                   'and restart the program.')
+    global current
+    response = forecastCache.cached(forecastUrl)
+    if response is None:
+        return
+    try:
+        with response.open() as f:
+            data = forecast.read(f, renderer.FORECAST_STEPS)
+    except (OSError, ValueError) as e:
+        print('Could not read the cached forecast: {}'.format(e))
+        return
+    current = (data, response.expires <= time.time())
+
+
+def recordHistory(data):
+    """Adds a new forecast to the history, dropping old ones once a day."""
+    if forecastHistory is None:
+        return
+    try:
+        forecastHistory.append(data)
+        forecastHistory.expire(HISTORY_DAYS)
+    except (OSError, ValueError) as e:
+        # Not worth missing a frame over
+        print('Could not save the forecast history: {}'.format(e))
+
+
+def fetchForecast():
+    """Fetch step for the scheduler: (changed, when to fetch again)."""
+    try:
+        changed = updateWeatherUrl()
+        return changed, nextUpdate
+    finally:
+        exportMetrics()
 
 
 def parseJsonAndDrawToMask():
-    """Parses json into strings.
+    """Draws the current forecast and puts it on the E-ink screen."""
+    frameBuffer = renderFrame()
+    if frameBuffer is not None:
+        showFrame(frameBuffer)
 
-    Handles the expansion of the json into their respective variables.
-    Also handles the opening of image files and draws everything to the
-    mask that will be drawn on the E-ink screen.
-    """
-    lastUpdated = time.strftime('%d.%m.%y %H:%M')
-    stats = data['properties']['timeseries']
-    weatherData = stats[0]['data']
-    instantWeatherData = weatherData['instant']['details']
-    oneHourWeatherData = weatherData['next_1_hours']
-    sixHourWeatherData = weatherData['next_6_hours']
-    # Temperature related variables:
-    # Five total periods: current temperature, and the four next
-    # 6 hour periods. (FirstPeriod, SecondPeriod, etc)
-    currentTemperature = instantWeatherData['air_temperature']
-
-    next6hTemp = sixHourWeatherData['details']['air_temperature_max']
-    icon6h = sixHourWeatherData['summary']['symbol_code']
-    next12hTemp = stats[11]['data']['instant']['details']['air_temperature']
-    icon12h = weatherData['next_12_hours']['summary']['symbol_code']
-
-    # Weather conditions and various icons
-    currentIcon = oneHourWeatherData['summary']['symbol_code']
-    iconStatus = currentIcon
-    if(iconStatus[-4:] == '_day'):
-        iconStatus = iconStatus.rstrip(iconStatus[-3:])
-        iconStatus = iconStatus.rstrip('_')
-    if(iconStatus[-6:] == '_night'):
-        iconStatus = iconStatus.rstrip('_night')
-    if(iconStatus[-14:] == '_polartwilight'):
-        iconStatus = iconStatus.rstrip('_polartwilight')
-    currentStatus = legend[iconStatus]['desc_en']
-    rainChancePercent = oneHourWeatherData['details']['probability_of_precipitation']
-
-    conditionIcon = Image.open('icons/weatherIcons/{}.png'.format(currentIcon))
-    refreshIcon = Image.open('icons/refresh.png')
-    windIcon = Image.open('icons/windicon.png')
-    rainLine = Image.open('icons/rainline.png')
-    rainChance = Image.open('icons/rainChance.png')
-    twelveHrain = Image.open('icons/twelveHrain.png')
-    next6hIcon = Image.open('icons/weatherIcons/{}.png'.format(icon6h))
-    sixhours = Image.open('icons/sixhours.png')
-    next12hIcon = Image.open('icons/weatherIcons/{}.png'.format(icon12h))
-    twelvehours = Image.open('icons/twelvehours.png')
-
-    # Wind information
-    windSpeed = instantWeatherData['wind_speed']
-    windMaxGust = instantWeatherData['wind_speed_of_gust']
-
-    # Precipitation info
-    rainAmount = [min(stats[i]['data']['next_1_hours']['details']
-                      ['precipitation_amount'], 4) for i in range(12)]
-
-    rainMaxAmount = [min(stats[i]['data']['next_1_hours']['details']
-                         ['precipitation_amount_max'], 4) for i in range(12)]
-
-    # Coordinates are X, Y:
-    # 0, 0 is top left of screen 176, 264 is bottom right
-    # global mask
-    mask = Image.new('1', (EPD_WIDTH, EPD_HEIGHT), 255)
-    # 255: clear the image with white
-    draw = ImageDraw.Draw(mask)
-
-    mask.paste(conditionIcon, (0, 0))
-    currentTemp = int(currentTemperature)
-    if (currentTemp <= 9) and (currentTemp >= -9):
-        # Centers the temperature when it is single digits
-        draw.text((120, 12), '{}'.format(currentTemp), font=bigfont, fill=0)
-    elif (currentTemp >= 10):
-        draw.text((98, 12), '{}'.format(currentTemp), font=bigfont, fill=0)
-    elif (currentTemp <= -10):
-        # Adds text "BELOW ZERO" underneath, no space for a minus sign
-        negativeCurrentTemp = (currentTemp * -1)
-        draw.text((98, 3), '{}'.format(negativeCurrentTemp),
-                  font=bigfont, fill=0)
-        draw.text((105, 70), 'BELOW ZERO', font=teenytinyfont, fill=0)
-
-    mask.paste(rainChance, (110, 83))
-    draw.text((127, 83), '{}%'.format(
-        int(rainChancePercent)), font=smallfont, fill=0)
-
-    mask.paste(refreshIcon, (91, 1))
-    draw.text((104, 1), '{}'.format(lastUpdated),
-              font=teenytinyfont, fill=0)
-    wrappedStatus = textwrap.fill(currentStatus, 19)
-    draw.text((5, 104), '{}'.format(wrappedStatus), font=smallfont, fill=0)
-
-    mask.paste(sixhours, (2, 153))
-    draw.text((22, 162), '{}'.format(next6hTemp), font=smallfont, fill=0)
-    mask.paste(next6hIcon.resize((48, 48)), (22, 144))
-    mask.paste(twelvehours, (90, 153))
-    draw.text((110, 162), '{}'.format(next12hTemp), font=smallfont, fill=0)
-    mask.paste(next12hIcon.resize((48, 48)), (110, 144))
-
-    # Black fill line for actual rain
-    rainh = [239 - (ra*10) for ra in rainAmount]
-
-    diagram_intervals = [
-        (10, 19),
-        (24, 33),
-        (38, 47),
-        (52, 61),
-        (66, 75),
-        (80, 90),
-        (94, 103),
-        (108, 117),
-        (122, 131),
-        (136, 145),
-        (150, 159),
-        (164, 173),
-    ]
-
-    for rain_amount, interval in zip(rainh, diagram_intervals):
-        for i in range(*interval):
-            draw.line((i, 239, i, rain_amount), fill=0, width=1)
-
-    # Only outline for maximum possible rain
-    # rainMaxH = [239 - (max_rain*10) for max_rain in rainMaxAmount]
-    rainMaxH = map(lambda x: 239 - (x*10), rainMaxAmount)
-
-    for rain_max, interval in zip(rainMaxH, diagram_intervals):
-        draw.line((interval[0], 239, interval[0], rain_max), fill=0, width=1)
-        draw.line((interval[0], 239, interval[1], 239), fill=0, width=1)
-        draw.line((interval[1], 239, interval[1], rain_max), fill=0, width=1)
-        draw.line((interval[0], rain_max, interval[1],
-                  rain_max), fill=0, width=1)
-
-    mask.paste(windIcon, (0, 248))
-    mask.paste(rainLine, (8, 240))
-    mask.paste(twelveHrain, (1, 212))
-    draw.text((43, 244), '{}-{} m/s'.format(windSpeed, windMaxGust),
-              font=smallfont, fill=0)
 
-    print(('Successfully parsed json file and created mask. {}'.format(
-        time.strftime('%d%m%y-%H:%M:%S'))))
-    # epd.display_frame(epd.get_frame_buffer(mask))
+def renderFrame():
+    """Draws the current forecast, packed into a frame buffer.
 
-    # Turns mask upside down, this just happened to work best for my frame
-    # with regards to which side the cable came out.
-    rotatedMask = mask.rotate(180)
-    epd.display_frame(epd.get_frame_buffer(rotatedMask))
-    print(('Weather display successfully refreshed at {}'.format(
+    Returns None before there is a forecast.
+    """
+    data, stale = current
+    if data is None:
+        return None
+    frameBuffer = renderer.renderFrame(
+        data, legend.description(data.steps[0].symbol1h),
+        time.strftime(TIMESTAMP_FORMATS[TIMESTAMP_RESOLUTION]), stale)
+    print(('Successfully parsed json file and created mask. {}'.format(
         time.strftime('%d%m%y-%H:%M:%S'))))
+    return frameBuffer
+
+
+def showFrame(frameBuffer):
+    """Sends frameBuffer to the display, unless it is already on it."""
+    # Nothing to do if this exact frame is already on the screen.
+    global lastFrameFingerprint
+    fingerprint = hashlib.sha1(frameBuffer).hexdigest()
+    if fingerprint == lastFrameFingerprint:
+        refreshes.inc(kind='skipped')
+        print(('Weather display unchanged, skipped refresh at {}'.format(
+            time.strftime('%d%m%y-%H:%M:%S'))))
+        return
+    refresh = epd.update_frame(frameBuffer)
+    refreshes.inc(kind=refresh)
+    if refresh != 'none':
+        stats = epd.frame_stats
+        stageSeconds.observe(stats.wake_seconds, stage='wake')
+        stageSeconds.observe(stats.transfer_seconds, stage='spi')
+        stageSeconds.observe(stats.refresh_seconds, stage='busy')
+        spiBytes.inc(stats.bytes)
+        lastRefresh.set(time.time())
+    lastFrameFingerprint = fingerprint
+    saveLastFrameFingerprint(fingerprint)
+    print(('Weather display successfully refreshed ({}) at {}'.format(
+        refresh, time.strftime('%d%m%y-%H:%M:%S'))))
+    reportColdStart()
 
 
 # def printMaskToEinkScreen():
 
 
+def reportColdStart():
+    """Prints how long it took from startup to the first frame, once."""
+    global startTime
+    if startTime is not None:
+        print('Cold start: first frame {:.2f} s after startup'.format(
+            time.time() - startTime))
+        startTime = None
+
+
 def setUpErrorLogging():
     logging.basicConfig(filename="{}/logs/weather.log".format(os.getcwd()),
                         filemode='w',
@@ -256,28 +312,43 @@ def setUpErrorLogging():
                         )
 
 
-def logError(e):
-    logging.error("{} ({}): {}".format(e.__class__, e.__doc__, e.message))
+def logError(e, step):
+    errors.inc(step=step)
+    logging.error("{} ({}): {}".format(e.__class__, e.__doc__, e))
+
+
+def displayFrame(frameBuffer):
+    """Display step for the scheduler."""
+    try:
+        showFrame(frameBuffer)
+    finally:
+        exportMetrics()
+
+
+def handleError(e, step):
+    logError(e, step)
+    print(e)
+    exportMetrics()
+
+
+def exportMetrics():
+    if METRICS_TEXTFILE is not None:
+        try:
+            metrics.REGISTRY.writeTextfile(METRICS_TEXTFILE)
+        except OSError as e:
+            print('Could not write metrics: {}'.format(e))
 
 
 if __name__ == '__main__':
     setUpErrorLogging()
-    running = True
-    while running:
-        try:
-            updateWeatherUrl()
-        except Exception as e:
-            logError(e)
-            print(e)
-        try:
-            parseJsonAndDrawToMask()
-        except Exception as e:
-            logError(e)
-            print(e)
-        # try:
-        #     printMaskToEinkScreen()
-        # except Exception as e:
-        #     logError (e)
-        #     print(e)
-        time.sleep(600)
-        # Refreshes every 10 minutes
+    if METRICS_PORT is not None:
+        metrics.REGISTRY.serve(METRICS_PORT)
+    loadCachedForecast()
+    try:
+        asyncio.run(scheduler.Scheduler(
+            fetchForecast, renderFrame, displayFrame, handleError,
+            redrawInterval=MAX_UPDATE_INTERVAL,
+            minFetchInterval=MIN_UPDATE_INTERVAL,
+            firstDrawDelay=FIRST_DRAW_DELAY).run())
+    except KeyboardInterrupt:
+        pass